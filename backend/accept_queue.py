@@ -0,0 +1,50 @@
+"""Accept-queue depth of the listening sockets gunicorn hands its workers
+
+A sync worker handles one request at a time, so under load the backlog
+isn't inside the app at all: it's connections the kernel has completed but
+no worker has accept()ed yet. On Linux, TCP_INFO on a listening socket
+reports that queue's current length in tcpi_unacked (and its limit in
+tcpi_sacked). Elsewhere, or for non-TCP listeners, the depth is unknown.
+"""
+import os
+import socket
+import struct
+
+TCP_INFO_SIZE = 104
+_UNACKED_OFFSET = 24  # Eight one-byte fields, then rto, ato, snd_mss and rcv_mss come first
+
+
+class AcceptQueue:
+    """Reads how many connections are waiting to be accepted on a set of listening sockets"""
+
+    def __init__(self, fds):
+        self._sockets = []
+        if not hasattr(socket, 'TCP_INFO'):
+            return
+        for fd in fds:
+            # A duplicate, so closing (or garbage-collecting) ours never closes gunicorn's
+            sock = socket.socket(fileno=os.dup(fd))
+            try:
+                sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+            except OSError:  # Not a TCP socket (a unix socket bind, say)
+                sock.close()
+                continue
+            self._sockets.append(sock)
+
+    @classmethod
+    def from_env(cls, value):
+        """Build from a comma-separated fd list such as gunicorn_config's FIVEMORE_LISTEN_FDS"""
+        return cls(int(fd) for fd in (value or '').split(',') if fd.strip())
+
+    def depth(self):
+        """Connections waiting across all the sockets, or None if that can't be measured"""
+        if not self._sockets:
+            return None
+        total = 0
+        for sock in self._sockets:
+            try:
+                info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+            except OSError:
+                return None
+            total += struct.unpack_from('I', info, _UNACKED_OFFSET)[0]
+        return total
@@ -0,0 +1,137 @@
+"""Prefix/trigram search over action texts
+
+An ActionIndex is built once per catalog and answers autocomplete queries
+without scanning every action: word prefixes map straight to matching
+actions, and a trigram index supplies fuzzy matches for typos. It also
+resolves `similar-to` links into groups (connected components), so every
+action knows all the actions it is interchangeable with.
+"""
+import re
+from collections import defaultdict
+
+MAX_PREFIX_LENGTH = 12  # Longer query words are matched on their first 12 characters
+FUZZY_MIN_SIMILARITY = 0.5  # Share of the query's trigrams an action needs for a fuzzy match
+
+_WORD = re.compile(r'[a-z0-9+]+')
+
+
+def normalize_text(text):
+    """Lowercase and reduce to words, so 'Did Yoga!' and 'did yoga' compare equal"""
+    return ' '.join(_WORD.findall((text or '').lower()))
+
+
+def trigrams(normalized):
+    """Trigrams of each word padded like '  word ', so word starts weigh more"""
+    grams = set()
+    for word in normalized.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class ActionIndex:
+    """Immutable search index over a list of action dicts
+
+    Each action needs 'text'; any other keys are carried through to results.
+    """
+
+    def __init__(self, actions):
+        self.actions = list(actions)
+        self.normalized = [normalize_text(action['text']) for action in self.actions]
+        self.by_normalized = {}
+        self.texts = {action['text'] for action in self.actions}
+        self.prefixes = defaultdict(set)  # word prefix -> action positions
+        self.trigram_index = defaultdict(set)  # trigram -> action positions
+
+        for position, normalized in enumerate(self.normalized):
+            self.by_normalized.setdefault(normalized, position)
+            for word in normalized.split():
+                for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                    self.prefixes[word[:length]].add(position)
+            for gram in trigrams(normalized):
+                self.trigram_index[gram].add(position)
+
+        self.groups = self._build_similar_groups()
+
+    def _build_similar_groups(self):
+        """Union-find over similar-to links; returns text -> sorted group texts"""
+        parent = {}
+
+        def find(text):
+            parent.setdefault(text, text)
+            while parent[text] != text:
+                parent[text] = parent[parent[text]]
+                text = parent[text]
+            return text
+
+        for action in self.actions:
+            find(action['text'])
+            for other in action.get('similar-to') or []:
+                parent[find(other)] = find(action['text'])
+
+        members = defaultdict(list)
+        for text in parent:
+            members[find(text)].append(text)
+        return {text: sorted(members[find(text)]) for text in parent}
+
+    def similar_to(self, text):
+        """Return the other catalog actions in text's similar-to group"""
+        return [other for other in self.groups.get(text, []) if other != text and other in self.texts]
+
+    def find_duplicate(self, text):
+        """Return the action whose text matches ignoring case and punctuation, or None"""
+        position = self.by_normalized.get(normalize_text(text))
+        return None if position is None else self.actions[position]
+
+    def search(self, query, limit=10):
+        """Return up to `limit` (score, action) pairs, best first
+
+        Every query word must prefix some word of the action. Exact matches
+        rank first, then whole-text prefixes, then word-prefix matches, then
+        fuzzy trigram matches when prefixes don't fill the limit.
+        """
+        normalized = normalize_text(query)
+        if not normalized:
+            return []
+
+        candidates = None
+        for word in normalized.split():
+            matches = self.prefixes.get(word[:MAX_PREFIX_LENGTH], set())
+            candidates = matches if candidates is None else candidates & matches
+            if not candidates:
+                break
+
+        # Words longer than the indexed prefixes still have to match in full
+        long_words = [word for word in normalized.split() if len(word) > MAX_PREFIX_LENGTH]
+
+        scored = {}
+        for position in candidates or ():
+            text = self.normalized[position]
+            if long_words and not all(any(text_word.startswith(word) for text_word in text.split())
+                                      for word in long_words):
+                continue
+            if text == normalized:
+                score = 3.0
+            elif text.startswith(normalized):
+                score = 2.0
+            else:
+                score = 1.0
+            scored[position] = score
+
+        if len(scored) < limit:
+            query_grams = trigrams(normalized)
+            overlap = defaultdict(int)
+            for gram in query_grams:
+                for position in self.trigram_index.get(gram, ()):
+                    overlap[position] += 1
+            for position, shared in overlap.items():
+                if position in scored:
+                    continue
+                # Containment rather than Jaccard: a short query shouldn't lose to long texts
+                similarity = shared / len(query_grams)
+                if similarity >= FUZZY_MIN_SIMILARITY:
+                    scored[position] = 0.9 * similarity  # Always below a prefix match
+
+        ranked = sorted(scored.items(),
+                        key=lambda item: (-item[1], len(self.normalized[item[0]]), self.normalized[item[0]]))
+        return [(score, self.actions[position]) for position, score in ranked[:limit]]
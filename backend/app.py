@@ -4,13 +4,88 @@ import hashlib
 import secrets
 import time
 import json
-from datetime import datetime
+import csv
+import io
+import zlib
+import gzip
+import threading
+import mmap
+import struct
+import math
+import fcntl
+import re
+import random
+import logging
+import shutil
+import tempfile
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory, session
-from werkzeug.utils import secure_filename
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from flask import (Flask, Response, g, has_request_context, request, jsonify, send_from_directory, session,
+                   stream_with_context)
+from flask.json.provider import DefaultJSONProvider
+import click
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import check_password_hash, generate_password_hash
+from storage import IdempotencyKeyTaken, MemoryRepository, SQLiteRepository, rebuild_action_stats
+from action_search import ActionIndex
+from day_rollover import MidnightWheel
+from log_pipeline import configure_logging
+from sql_trace import QueryStats, tracing_connection_factory
+from request_profiler import RequestProfile, list_profiles
+from accept_queue import AcceptQueue
+
+try:
+    import orjson
+except ImportError:  # Optional speedup; the stdlib encoder is used without it
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Optional; responses fall back to gzip without it
+    brotli = None
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider for API responses
+
+    Uses orjson when it is installed, always emits compact unsorted output,
+    and accepts sqlite3.Row values so handlers can return query results
+    as-is. Neither encoder knows rows, so default() still turns each one
+    into a dict while encoding; what's saved is the handler-side copy.
+    """
+
+    ensure_ascii = False
+    sort_keys = False
+    compact = True
+
+    orjson_options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, sqlite3.Row):
+            return dict(obj)
+        return DefaultJSONProvider.default(obj)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=self.default, option=self.orjson_options).decode('utf-8')
+        kwargs.setdefault('separators', (',', ':'))
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is not None:
+            body = orjson.dumps(obj, default=self.default, option=self.orjson_options) + b'\n'
+        else:
+            body = self.dumps(obj) + '\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 
 app = Flask(__name__, static_folder='static', static_url_path='')
+app.json = FastJSONProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 
 # Session configuration for development (allows cross-origin cookies)
@@ -22,10 +97,325 @@ app.config['SESSION_COOKIE_SECURE'] = False  # Set to True in production with HT
 BASE_DIR = Path(__file__).parent
 PROJECT_ROOT = BASE_DIR.parent
 DATABASE = Path(os.environ.get('FIVEMORE_DB_PATH', BASE_DIR / 'app.db'))
+STORAGE_ENGINE = os.environ.get('FIVEMORE_STORAGE', 'sqlite')  # 'sqlite' or 'memory' (tests, benchmarks)
+DEFAULT_TIMEZONE = os.environ.get('FIVEMORE_DEFAULT_TIMEZONE', 'UTC')  # For users who haven't sent theirs yet
 UPLOAD_FOLDER = BASE_DIR / 'uploads'
 UPLOAD_FOLDER.mkdir(exist_ok=True)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+MAX_UPLOAD_BYTES = int(os.environ.get('FIVEMORE_MAX_UPLOAD_BYTES', 16 * 1024 * 1024))  # Whole request body
+PROFILE_PICTURE_MAX_BYTES = int(os.environ.get('FIVEMORE_PROFILE_PICTURE_MAX_BYTES', 5 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Bytes read per chunk when streaming uploads to disk
+UPLOAD_SWEEP_INTERVAL_HOURS = float(os.environ.get('FIVEMORE_UPLOAD_SWEEP_INTERVAL_HOURS', 24))  # 0 = no sweeper
+UPLOAD_SWEEP_GRACE_SECONDS = 60 * 60  # Unreferenced files younger than this are left alone
+CONTENT_ADDRESSED_UPLOAD = re.compile(r'^([0-9a-f]{64})\.[a-z]+$')  # <sha256>.<ext>
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 BUTTON_ACTIONS_FILE = PROJECT_ROOT / 'button-actions.json'
+EXPORT_BATCH_SIZE = 500  # Rows pulled per fetchmany() when streaming exports
+IMPORT_CHUNK_SIZE = 2000  # Rows inserted per transaction when importing history
+IMPORT_MAX_ERRORS = 50  # Row errors reported back from an import
+COMPACT_AFTER_DAYS = int(os.environ.get('FIVEMORE_COMPACT_AFTER_DAYS', 90))
+ARCHIVE_DATABASE = os.environ.get('FIVEMORE_ARCHIVE_DB_PATH')  # Optional raw-row archive
+BACKUP_DIR = Path(os.environ.get('FIVEMORE_BACKUP_DIR', BASE_DIR / 'backups'))
+BACKUP_KEEP = int(os.environ.get('FIVEMORE_BACKUP_KEEP', 7))  # Snapshots kept by rotation
+BACKUP_PAGES_PER_STEP = int(os.environ.get('FIVEMORE_BACKUP_PAGES', 256))
+BACKUP_STEP_SLEEP = float(os.environ.get('FIVEMORE_BACKUP_SLEEP', 0.05))  # Seconds between steps
+BACKUP_INTERVAL_HOURS = float(os.environ.get('FIVEMORE_BACKUP_INTERVAL_HOURS', 0))  # 0 = no scheduler
+DAY_ROLLOVER_ENABLED = os.environ.get('FIVEMORE_DAY_ROLLOVER', '1') == '1'
+DAY_ROLLOVER_REFRESH_SECONDS = 300  # How often the rollover thread looks for newly stored timezones
+DAILY_TOTALS_MAX_DAYS = 366
+COMPRESS_MIN_BYTES = int(os.environ.get('FIVEMORE_COMPRESS_MIN_BYTES', 1024))  # Smaller bodies go out as-is
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5
+COMPRESS_CACHE_ENTRIES = 32  # Compressed bodies kept for responses with a strong ETag
+USER_CACHE_SIZE = int(os.environ.get('FIVEMORE_USER_CACHE_SIZE', 1024))  # Cached user profiles
+USER_CACHE_TTL = float(os.environ.get('FIVEMORE_USER_CACHE_TTL', 300))  # Seconds
+RATE_LIMIT_ENABLED = os.environ.get('FIVEMORE_RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_STORE = os.environ.get('FIVEMORE_RATE_LIMIT_STORE', 'memory')  # 'memory' or 'sqlite'
+RATE_LIMIT_DATABASE = Path(os.environ.get('FIVEMORE_RATE_LIMIT_DB_PATH', DATABASE.with_name('ratelimit.db')))
+RATE_LIMIT_MAX_KEYS = 10000  # Buckets kept by the in-memory store
+# Peers whose CF-Connecting-IP / X-Forwarded-For headers are believed (cloudflared connects from localhost)
+TRUSTED_PROXIES = {addr.strip() for addr in os.environ.get('FIVEMORE_TRUSTED_PROXIES', '127.0.0.1,::1').split(',')
+                   if addr.strip()}
+LOG_LEVEL = os.environ.get('FIVEMORE_LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.environ.get('FIVEMORE_LOG_QUEUE_SIZE', 10000))  # Records buffered before new ones are dropped
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('FIVEMORE_ACCESS_LOG_SAMPLE', 1.0))  # Share of requests logged
+ACCESS_LOG_SLOW_MS = float(os.environ.get('FIVEMORE_ACCESS_LOG_SLOW_MS', 1000))  # Slower requests always logged
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')  # Accepted incoming X-Request-ID values
+SQL_TRACE = os.environ.get('FIVEMORE_SQL_TRACE', '0') == '1'  # Time every statement (adds overhead)
+SLOW_QUERY_MS = float(os.environ.get('FIVEMORE_SLOW_QUERY_MS', 50))  # Traced statements logged with their plan
+SQL_METRICS_MAX_STATEMENTS = 500  # Distinct statements tracked by /api/metrics
+SQL_METRICS_TOP_STATEMENTS = 20
+PROFILE_TOKEN = os.environ.get('FIVEMORE_PROFILE_TOKEN')  # Unset = on-demand profiling and /api/profiles are off
+PROFILE_SAMPLE_RATE = float(os.environ.get('FIVEMORE_PROFILE_SAMPLE', 0))  # Share of requests profiled unasked
+PROFILE_DIR = Path(os.environ.get('FIVEMORE_PROFILE_DIR', BASE_DIR / 'profiles'))
+PROFILE_KEEP_PER_ROUTE = int(os.environ.get('FIVEMORE_PROFILE_KEEP', 10))  # Captures kept per route
+PROFILE_STACK_INTERVAL = 0.005  # Seconds between stack samples for the collapsed-stack file
+ADMISSION_CONTROL_ENABLED = os.environ.get('FIVEMORE_ADMISSION_CONTROL', '1') == '1'
+MAX_BACKLOG = int(os.environ.get('FIVEMORE_MAX_BACKLOG', 16))  # Connections waiting for a worker to accept them
+MAX_IN_FLIGHT = int(os.environ.get('FIVEMORE_MAX_IN_FLIGHT', 8))  # Concurrent requests per worker
+MAX_QUEUE_MS = float(os.environ.get('FIVEMORE_MAX_QUEUE_MS', 5000))  # Wait before a worker picked it up
+SHED_RETRY_AFTER_SECONDS = 5
+
+# Token bucket budgets per endpoint: (scope, burst capacity, tokens refilled per second).
+# 'user' buckets fall back to the client IP when nobody is logged in.
+RATE_LIMITS = {
+    'add_time': ('user', 20, 0.5),
+    'login': ('ip', 10, 1 / 6),
+    'register': ('ip', 5, 1 / 60),
+}
+DEFAULT_WRITE_RATE_LIMIT = ('user', 60, 1.0)  # Any other POST/PUT/DELETE under /api/
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('FIVEMORE_IDEMPOTENCY_TTL', 24 * 60 * 60))
+CHANGE_LOG_RETENTION_DAYS = float(os.environ.get('FIVEMORE_CHANGE_LOG_RETENTION_DAYS', 30))  # 0 = keep forever
+IDEMPOTENCY_CACHE_ENTRIES = 2048  # Recent responses kept in memory in front of the table
+ACTION_INDEX_CACHE_ENTRIES = 256  # Compiled search indexes kept for distinct merged catalogs
+ACTION_SEARCH_MAX_RESULTS = 50
+ACTION_STATS_MAX_RESULTS = 100
+RECONCILE_BATCH_SIZE = 200  # Users checked (and repaired) per transaction
+RECONCILE_PAUSE_SECONDS = 0.05  # Between batches, so live writes get the lock in between
+REWEIGHT_CHUNK_SIZE = 5000  # History rows re-priced per transaction
+
+# Share of MAX_BACKLOG / MAX_IN_FLIGHT / MAX_QUEUE_MS each priority may use before it's shed
+# with a 503, so browsing pages go first and logging time goes last
+ADMISSION_SHARES = {'low': 0.5, 'normal': 1.0, 'high': 1.5}
+ADMISSION_PRIORITIES = {
+    'add_time': 'high',
+    'login': 'high',
+    'get_all_users': 'low',
+    'get_user_actions': 'low',
+    'export_user_actions': 'low',
+    'import_actions': 'low',
+    'get_action_stats': 'low',
+    'check_action_stats': 'low',
+    'check_user_totals': 'low',
+    'get_metrics': 'low',
+}
+ADMISSION_EXEMPT = {'health_check', 'readiness_check'}
+# Operator-only routes: 404 without the profiling token, and not profiled themselves
+TOKEN_ENDPOINTS = {'list_request_profiles', 'get_request_profile', 'get_metrics', 'get_action_stats',
+                   'check_action_stats', 'check_user_totals'}
+
+
+def log_context():
+    """Fields added to every log record: the request id when inside a request"""
+    if has_request_context() and 'request_id' in g:
+        return {'request_id': g.request_id}
+    return {}
+
+
+# JSON lines on stdout, written by a background thread (see log_pipeline.py)
+logger = configure_logging('fivemore', LOG_LEVEL, LOG_QUEUE_SIZE, context=log_context)
+
+
+# Registered before any other hooks, so the timer covers them all and the
+# access log line is written after every other after_request has run
+@app.before_request
+def start_request_log():
+    """Tag the request with an id (the client's X-Request-ID if sane) and start its timer"""
+    incoming = request.headers.get('X-Request-ID', '')
+    g.request_id = incoming if REQUEST_ID_PATTERN.match(incoming) else secrets.token_hex(8)
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def log_request(response):
+    """Write a sampled access log line; errors, shed and slow requests are always logged"""
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    started = g.get('request_started')
+    duration_ms = round((time.perf_counter() - started) * 1000, 2) if started is not None else None
+    slow = duration_ms is not None and duration_ms >= ACCESS_LOG_SLOW_MS
+    route = request.url_rule.rule if request.url_rule else None
+    queries = g.get('sql_queries', [])
+    if SQL_TRACE:
+        query_stats.record(route, queries)
+        for query in queries:
+            if 'plan' in query:
+                logger.warning('slow query', extra=dict(query, route=route))
+    if response.status_code < 500 and not slow and random.random() >= ACCESS_LOG_SAMPLE_RATE:
+        return response
+
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'route': route,
+        'status': response.status_code,
+        'duration_ms': duration_ms,
+        'bytes': None if response.is_streamed else response.calculate_content_length(),
+        'ip': client_ip(),
+    }
+    if SQL_TRACE:
+        fields['sql_queries'] = len(queries)
+        fields['sql_ms'] = round(sum(query['ms'] for query in queries), 3)
+    if response.status_code >= 500:
+        fields['error'] = (response.get_json(silent=True) or {}).get('error') if response.is_json else None
+        level = logging.WARNING if g.get('shed') else logging.ERROR
+    else:
+        level = logging.WARNING if slow else logging.INFO
+    logger.log(level, 'request', extra=fields)
+    return response
+
+
+def has_profile_token():
+    """Whether the request carries the profiling token (X-Profile-Token header or ?profile=)"""
+    supplied = request.headers.get('X-Profile-Token') or request.args.get('profile')
+    return bool(PROFILE_TOKEN and supplied and secrets.compare_digest(supplied, PROFILE_TOKEN))
+
+
+@app.before_request
+def require_profile_token():
+    """Answer operator-only routes with a 404 unless the request carries the profiling token"""
+    if request.endpoint in TOKEN_ENDPOINTS and not has_profile_token():
+        return jsonify({'error': 'Not found'}), 404
+    return None
+
+
+# Registered after the access log hooks and require_profile_token, so the
+# profile covers every later hook and the handler, and is saved before the
+# access line is written. A refused operator route never gets this far.
+@app.before_request
+def start_request_profile():
+    """Profile the request if the token asks for it, or if it's picked by the background sample"""
+    if request.endpoint in TOKEN_ENDPOINTS:
+        return
+    if has_profile_token():
+        g.profile_reason = 'requested'
+    elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        g.profile_reason = 'sampled'
+    else:
+        return
+    g.profile = RequestProfile.start(PROFILE_STACK_INTERVAL)
+
+
+@app.after_request
+def save_request_profile(response):
+    """Stop the request's profiler and save its capture under PROFILE_DIR"""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.stop()
+    route = request.url_rule.rule if request.url_rule else None
+    try:
+        name = profile.save(PROFILE_DIR, route, PROFILE_KEEP_PER_ROUTE, method=request.method, path=request.path,
+                            status=response.status_code, reason=g.profile_reason, request_id=g.get('request_id'))
+        if g.profile_reason == 'requested':
+            response.headers['X-Profile'] = name
+    except Exception:
+        logger.exception('Error saving request profile')
+    return response
+
+
+@app.teardown_request
+def discard_request_profile(error=None):
+    """Release the profiler if the request died before after_request could save it"""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+
+
+class AdmissionControl:
+    """Counts a worker's in-flight requests and sheds new ones past the limits
+
+    The deployment runs sync workers, which never have more than one request
+    in flight, so the backlog that matters there is the accept queue: the
+    connections waiting behind this one. Each priority is held to its share
+    of the limits (ADMISSION_SHARES), so when a backlog builds, low-priority
+    requests start failing fast well before the ones that record time do.
+    """
+
+    def __init__(self, max_backlog, max_in_flight, max_queue_ms, shares):
+        self.max_backlog = max_backlog
+        self.max_in_flight = max_in_flight
+        self.max_queue_ms = max_queue_ms
+        self.shares = shares
+        self.in_flight = 0
+        self.shed = {priority: 0 for priority in shares}
+        self._lock = threading.Lock()
+
+    def admit(self, priority, backlog=None, queue_ms=None):
+        """Count the request in and return True, or return False if it should be shed"""
+        share = self.shares[priority]
+        with self._lock:
+            if (self.in_flight >= self.max_in_flight * share
+                    or (backlog is not None and backlog >= self.max_backlog * share)
+                    or (queue_ms is not None and queue_ms >= self.max_queue_ms * share)):
+                self.shed[priority] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+admission = AdmissionControl(MAX_BACKLOG, MAX_IN_FLIGHT, MAX_QUEUE_MS, ADMISSION_SHARES)
+# Set by gunicorn_config.post_fork; empty under the dev server, where the backlog limit doesn't apply
+accept_queue = AcceptQueue.from_env(os.environ.get('FIVEMORE_LISTEN_FDS'))
+
+
+def request_queue_ms():
+    """Milliseconds since the proxy stamped X-Request-Start (t=<seconds, ms or us>), or None"""
+    stamp = request.headers.get('X-Request-Start', '').strip()
+    if stamp.startswith('t='):
+        stamp = stamp[2:]
+    try:
+        started = float(stamp)
+    except ValueError:
+        return None
+    if started > 1e14:  # Microseconds
+        started /= 1e6
+    elif started > 1e11:  # Milliseconds
+        started /= 1e3
+    return max(0.0, (time.time() - started) * 1000)
+
+
+@app.before_request
+def admit_request():
+    """Fail fast with a 503 when the accept queue, in-flight count or queue time is over its limit"""
+    if not ADMISSION_CONTROL_ENABLED or request.endpoint in ADMISSION_EXEMPT:
+        return None
+    priority = ADMISSION_PRIORITIES.get(request.endpoint, 'normal')
+    if not admission.admit(priority, accept_queue.depth(), request_queue_ms()):
+        response = jsonify({'error': 'Server busy, try again shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SHED_RETRY_AFTER_SECONDS)
+        g.shed = True
+        return response
+    g.admitted = True
+    return None
+
+
+@app.teardown_request
+def release_admission(error=None):
+    """Take the request back out of the in-flight count, however it ended"""
+    if g.pop('admitted', False):
+        admission.release()
+
+
+@app.route('/healthz', methods=['GET'])
+def health_check():
+    """Liveness: the worker is up and answering (doesn't touch the database)"""
+    return jsonify({'status': 'ok'}), 200
+
+
+@app.route('/readyz', methods=['GET'])
+def readiness_check():
+    """Readiness: the database answers and the worker has room for more requests"""
+    backlog = accept_queue.depth()
+    body = {'status': 'ok', 'backlog': backlog, 'max_backlog': MAX_BACKLOG,
+            'in_flight': admission.in_flight, 'max_in_flight': MAX_IN_FLIGHT, 'shed': dict(admission.shed)}
+    try:
+        started = time.perf_counter()
+        repo.ping()
+        body['db_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    except Exception as e:
+        body.update(status='unavailable', error=str(e))
+        return jsonify(body), 503
+    if ADMISSION_CONTROL_ENABLED and (admission.in_flight >= MAX_IN_FLIGHT
+                                      or (backlog is not None and backlog >= MAX_BACKLOG)):
+        body['status'] = 'busy'
+        return jsonify(body), 503
+    return jsonify(body), 200
+
 
 # Load button actions from JSON file
 def load_button_actions():
@@ -35,8 +425,8 @@ def load_button_actions():
             with open(BUTTON_ACTIONS_FILE, 'r') as f:
                 data = json.load(f)
                 return data.get('actions', [])
-    except Exception as e:
-        print(f"Error loading button actions: {e}")
+    except Exception:
+        logger.exception('Error loading button actions')
     
     # Fallback to default actions
     return [
@@ -52,67 +442,90 @@ def get_button_minutes_dict():
 
 def get_button_minutes():
     """Get current button actions mapping for the logged-in user"""
-    user_id = session.get('user_id')
+    return get_user_button_minutes(session.get('user_id'))
+
+
+def get_user_button_minutes(user_id):
+    """Get the merged text->minutes mapping (defaults, edits, custom) for a user"""
     button_minutes = get_button_minutes_dict()
     
     # Apply user-specific changes (deletions, edits, custom actions)
     if user_id:
         try:
-            conn = get_db()
-            cursor = conn.cursor()
-            
-            # Get deleted actions (remove from dict)
-            cursor.execute('''
-                SELECT action_text
-                FROM deleted_actions
-                WHERE user_id = ?
-            ''', (user_id,))
-            deleted_actions = cursor.fetchall()
-            for row in deleted_actions:
-                deleted_text = row['action_text']
+            deleted_texts, edited_actions, custom_actions = repo.get_catalog_overlay(user_id)
+
+            # Remove deleted actions
+            for deleted_text in deleted_texts:
                 if deleted_text in button_minutes:
                     del button_minutes[deleted_text]
             
-            # Get edited actions (overrides for default actions)
-            cursor.execute('''
-                SELECT text, minutes
-                FROM edited_actions
-                WHERE user_id = ?
-            ''', (user_id,))
-            edited_actions = cursor.fetchall()
-            
             # Apply edits (overrides) - use edited text as key
             for action in edited_actions:
                 button_minutes[action['text']] = action['minutes']
             
             # Add custom actions
-            cursor.execute('''
-                SELECT text, minutes
-                FROM custom_actions
-                WHERE user_id = ?
-            ''', (user_id,))
-            custom_actions = cursor.fetchall()
-            conn.close()
-            
             for action in custom_actions:
                 button_minutes[action['text']] = action['minutes']
-        except Exception as e:
-            print(f"Error loading actions for button minutes: {e}")
+        except Exception:
+            logger.exception('Error loading actions for button minutes')
     
     return button_minutes
 
 
+def trace_query(query):
+    """Attribute a traced statement to the current request (see log_request)"""
+    if has_request_context():
+        g.setdefault('sql_queries', []).append(query)
+
+
+def trace_slow_query(query):
+    """Log a slow statement run outside a request now; in a request it's logged with its final time"""
+    if not has_request_context():
+        logger.warning('slow query', extra=query)
+
+
+# With FIVEMORE_SQL_TRACE=1 every connection times its statements (see sql_trace.py)
+query_stats = QueryStats(SQL_METRICS_MAX_STATEMENTS)
+connection_factory = (tracing_connection_factory(trace_query, trace_slow_query, SLOW_QUERY_MS)
+                      if SQL_TRACE else sqlite3.Connection)
+
+
 def get_db():
     """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(DATABASE, factory=connection_factory)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
     return conn
 
 
+def get_db_readonly():
+    """Get a read-only database connection
+
+    With the database in WAL mode, readers work from a snapshot and never
+    block (or wait on) the single writer, so GET handlers use these.
+    """
+    conn = sqlite3.connect(f'{DATABASE.resolve().as_uri()}?mode=ro', uri=True, factory=connection_factory)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+# All route handlers go through this repository rather than running SQL
+change_log_retention = int(CHANGE_LOG_RETENTION_DAYS * 24 * 60 * 60) or None
+if STORAGE_ENGINE == 'memory':
+    repo = MemoryRepository(idempotency_ttl=IDEMPOTENCY_TTL_SECONDS, change_log_retention=change_log_retention)
+else:
+    repo = SQLiteRepository(get_db, idempotency_ttl=IDEMPOTENCY_TTL_SECONDS,
+                            connect_readonly=get_db_readonly, change_log_retention=change_log_retention)
+
+
 def init_db():
     """Initialize database schema"""
     conn = get_db()
     cursor = conn.cursor()
+
+    # WAL lets readers run alongside the writer; the mode is stored in the file
+    cursor.execute('PRAGMA journal_mode = WAL')
     
     # Users table
     cursor.execute('''
@@ -123,6 +536,7 @@ def init_db():
             password_hash TEXT NOT NULL,
             display_name TEXT NOT NULL,
             profile_picture TEXT,
+            timezone TEXT,
             total_minutes INTEGER DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
@@ -136,7 +550,8 @@ def init_db():
             action TEXT NOT NULL,
             minutes_added INTEGER NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
+            local_day TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
         )
     ''')
     
@@ -152,7 +567,7 @@ def init_db():
             must_be_logged_at_end_of_day INTEGER DEFAULT 0,
             warning TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
         )
     ''')
     
@@ -163,7 +578,7 @@ def init_db():
             user_id INTEGER NOT NULL,
             action_text TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
             UNIQUE(user_id, action_text)
         )
     ''')
@@ -182,30 +597,316 @@ def init_db():
             warning TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
             UNIQUE(user_id, original_text)
         )
     ''')
-    
+
+    # Daily summaries of compacted (old) time actions
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_action_summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            action TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            minutes_added INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(user_id, day, action)
+        )
+    ''')
+
+    # Per-user totals for each closed local day, written at local midnight
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            user_id INTEGER NOT NULL,
+            local_day TEXT NOT NULL,
+            actions INTEGER NOT NULL,
+            minutes_added INTEGER NOT NULL,
+            closed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, local_day),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Users whose history a reweight-history run changed but whose totals
+    # haven't been recomputed yet; survives an interrupted run
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reweight_pending_users (
+            user_id INTEGER PRIMARY KEY
+        )
+    ''')
+
+    # Idempotency keys for /api/time/add (replayed instead of re-applied)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            response_status INTEGER,
+            response_body TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, key),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created
+        ON idempotency_keys (created_at)
+    ''')
+
+    # Per-user change log feeding /api/sync
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            entity TEXT NOT NULL,
+            entity_key TEXT,
+            op TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_change_log_user_seq
+        ON change_log (user_id, seq)
+    ''')
+
+    # Per-day, per-action counters across all users, kept in step with
+    # time_actions by the repository so popularity never needs a full scan
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'action_stats'")
+    backfill_action_stats = cursor.fetchone() is None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS action_stats (
+            day TEXT NOT NULL,
+            action TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            minutes_added INTEGER NOT NULL,
+            PRIMARY KEY (day, action)
+        )
+    ''')
+
+    # Older databases were created without ON DELETE CASCADE; rebuilding
+    # drops their indexes, so this has to run before the indexes below
+    migrate_cascade_foreign_keys(conn)
+
+    # Columns added after the first release
+    add_missing_column(cursor, 'users', 'timezone', 'TEXT')
+    if add_missing_column(cursor, 'time_actions', 'local_day', 'TEXT'):
+        # Nobody had a stored timezone yet; rows are restamped when a user first sends theirs
+        cursor.execute('UPDATE time_actions SET local_day = date(created_at)')
+
+    # Index for per-user history scans (exports, date ranges)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_time_actions_user_created
+        ON time_actions (user_id, created_at)
+    ''')
+
+    # Index for finding every user in a timezone group at its midnight
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_timezone
+        ON users (timezone)
+    ''')
+
+    # Index for "today" lookups, which match the local day stamped at insert
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_time_actions_user_local_day
+        ON time_actions (user_id, local_day)
+    ''')
+
+    # Covering indexes for the per-user (user_id, text) -> minutes lookups
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_custom_actions_user_text
+        ON custom_actions (user_id, text, minutes)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_edited_actions_user_text
+        ON edited_actions (user_id, text, minutes)
+    ''')
+
+    # Existing history is counted once when the table first appears
+    if backfill_action_stats:
+        rebuild_action_stats(cursor)
+
     conn.commit()
     conn.close()
 
 
+def add_missing_column(cursor, table, column, definition):
+    """Add a column to an existing table if it isn't there yet; returns True if added"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if any(row['name'] == column for row in cursor.fetchall()):
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+CASCADE_TABLES = ['time_actions', 'custom_actions', 'deleted_actions', 'edited_actions', 'daily_action_summaries']
+# The user_id reference however the stored DDL spells it, as long as it has no ON DELETE clause yet
+USERS_REFERENCE = re.compile(r'(REFERENCES\s+["`\[]?users["`\]]?\s*\(\s*["`\[]?id["`\]]?\s*\))(?!\s*ON\s+DELETE)',
+                             re.IGNORECASE)
+
+
+def tables_missing_cascade(cursor, tables):
+    """Return the tables with a foreign key that doesn't cascade deletes"""
+    missing = []
+    for table in tables:
+        cursor.execute(f'PRAGMA foreign_key_list({table})')
+        if any(fk['on_delete'] != 'CASCADE' for fk in cursor.fetchall()):
+            missing.append(table)
+    return missing
+
+
+def migrate_cascade_foreign_keys(conn):
+    """Rebuild per-user tables whose user_id foreign key lacks ON DELETE CASCADE
+
+    SQLite can't alter a constraint in place, so each table is recreated from
+    its stored schema with the cascade added, and its rows and AUTOINCREMENT
+    counter are copied over. The tables are checked again once the write lock
+    is held, so a second worker starting alongside finds nothing left to do,
+    and a rebuild that doesn't come out cascading is rolled back loudly
+    rather than repeated on every start.
+    """
+    cursor = conn.cursor()
+    if not tables_missing_cascade(cursor, CASCADE_TABLES):
+        return
+
+    conn.commit()
+    cursor.execute('PRAGMA foreign_keys = OFF')
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        for table in tables_missing_cascade(cursor, CASCADE_TABLES):
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            create_sql, references = USERS_REFERENCE.subn(r'\1 ON DELETE CASCADE', cursor.fetchone()['sql'])
+            create_sql, renamed = re.subn(rf'^(\s*CREATE\s+TABLE\s+)["`\[]?{table}["`\]]?',
+                                          rf'\g<1>{table}_migrating', create_sql, count=1, flags=re.IGNORECASE)
+            if references != 1 or not renamed:
+                raise RuntimeError(f'Cannot add ON DELETE CASCADE to {table}: unexpected schema {create_sql!r}')
+
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+            sequence = cursor.fetchone()
+
+            cursor.execute(create_sql)
+            cursor.execute(f'INSERT INTO {table}_migrating SELECT * FROM {table}')
+            cursor.execute(f'DROP TABLE {table}')
+            cursor.execute(f'ALTER TABLE {table}_migrating RENAME TO {table}')
+            if sequence:
+                cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?',
+                               (sequence['seq'], table))
+            if tables_missing_cascade(cursor, [table]):
+                raise RuntimeError(f'Rebuilt {table} still lacks ON DELETE CASCADE')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute('PRAGMA foreign_keys = ON')
+
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def save_profile_picture(file, user_id):
-    """Save profile picture and return filename"""
-    if file and allowed_file(file.filename):
-        ext = file.filename.rsplit('.', 1)[1].lower()
-        filename = f'profile_{user_id}_{int(time.time())}.{ext}'
+class UploadTooLarge(Exception):
+    """Raised when an uploaded file is over its size limit"""
+
+
+def save_profile_picture(file):
+    """Save profile picture and return filename
+
+    The upload is streamed to a temp file in chunks while being hashed, then
+    renamed to <sha256>.<ext>, so identical images are stored once. Files
+    may be shared between users, so old pictures are never deleted here;
+    sweep_uploads() removes them once nothing references them.
+    """
+    if not (file and allowed_file(file.filename)):
+        return None
+
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = UPLOAD_FOLDER / f'.upload-{secrets.token_hex(8)}.tmp'
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > PROFILE_PICTURE_MAX_BYTES:
+                    raise UploadTooLarge(
+                        f'Profile picture is larger than {PROFILE_PICTURE_MAX_BYTES // (1024 * 1024)} MB')
+                digest.update(chunk)
+                out.write(chunk)
+
+        filename = f'{digest.hexdigest()}.{ext}'
         filepath = UPLOAD_FOLDER / filename
-        file.save(filepath)
+        if filepath.exists():
+            # Already stored; refresh mtime so a pending sweep doesn't take it
+            os.utime(filepath)
+        else:
+            os.replace(tmp_path, filepath)
         return filename
-    return None
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def sweep_uploads(grace_seconds=UPLOAD_SWEEP_GRACE_SECONDS):
+    """Delete uploaded files no user references any more; return how many were removed
+
+    Files (and abandoned temp files) younger than grace_seconds are kept so
+    uploads that haven't been committed to the database yet survive.
+    """
+    referenced = repo.referenced_profile_pictures()
+
+    cutoff = time.time() - grace_seconds
+    removed = 0
+    for path in UPLOAD_FOLDER.iterdir():
+        if path.name.startswith('.') and not path.name.startswith('.upload-'):
+            continue  # Lock files and the like
+        if not path.is_file() or path.name in referenced:
+            continue
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def start_locked_thread(name, lock_path, run):
+    """Start a daemon thread that calls run() once it holds lock_path
+
+    Every worker starts one, but only the worker holding the lock runs the
+    job; the others wait on the lock and the next one takes over when the
+    holder exits.
+    """
+    def hold_lock_and_run():
+        with open(lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            run()
+
+    thread = threading.Thread(target=hold_lock_and_run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def start_upload_sweeper(interval_hours):
+    """Run sweep_uploads() every interval_hours in a daemon thread"""
+    def run():
+        while True:
+            time.sleep(interval_hours * 3600)
+            try:
+                removed = sweep_uploads()
+                if removed:
+                    logger.info('Removed orphaned uploads', extra={'removed': removed})
+            except Exception:
+                logger.exception('Error sweeping uploads')
+
+    return start_locked_thread('upload-sweeper', UPLOAD_FOLDER / '.sweeper.lock', run)
 
 
 def minutes_to_days_hours_minutes(total_minutes):
@@ -217,6 +918,240 @@ def minutes_to_days_hours_minutes(total_minutes):
     return {'days': days, 'hours': hours, 'minutes': minutes}
 
 
+class UserCache:
+    """Bounded TTL/LRU cache of user profile rows (including total_minutes)
+
+    Entries are keyed by user_id. Every committed write to a user bumps a
+    counter in a small memory-mapped file shared by all workers on the host;
+    an entry is only served while its counter is unchanged, so a worker never
+    returns a profile or total that another worker has since changed.
+    """
+
+    SLOTS = 4096  # Users hash onto this many shared version counters
+
+    def __init__(self, versions_path, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (version, expires_at, profile)
+        self._lock = threading.Lock()
+        self._versions_path = versions_path
+        self._versions = None
+
+    def _versions_map(self):
+        if self._versions is None:
+            with open(self._versions_path, 'a+b') as f:
+                if os.fstat(f.fileno()).st_size < self.SLOTS * 8:
+                    f.truncate(self.SLOTS * 8)
+                self._versions = mmap.mmap(f.fileno(), self.SLOTS * 8)
+        return self._versions
+
+    def version(self, user_id):
+        return struct.unpack_from('Q', self._versions_map(), (user_id % self.SLOTS) * 8)[0]
+
+    def _bump(self, user_id):
+        versions = self._versions_map()
+        offset = (user_id % self.SLOTS) * 8
+        with open(self._versions_path, 'rb') as lock_file:
+            # Serialize the read-modify-write across workers
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                version = struct.unpack_from('Q', versions, offset)[0] + 1
+                struct.pack_into('Q', versions, offset, version)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return version
+
+    def get(self, user_id):
+        """Return a copy of the cached profile, or None if missing or stale"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            version, expires_at, profile = entry
+            if expires_at < time.monotonic() or version != self.version(user_id):
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return dict(profile)
+
+    def put(self, user_id, profile, version=None):
+        """Cache a profile read (or written) at the given shared version"""
+        if version is None:
+            version = self.version(user_id)
+        with self._lock:
+            self._entries[user_id] = (version, time.monotonic() + self.ttl, dict(profile))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Record a committed write: notify other workers and drop our own entry
+
+        The entry isn't patched in place: bumps from different workers can land
+        in a different order than their commits, so a value cached at the new
+        version could already be stale. The next read refills from the database.
+        """
+        self._bump(user_id)
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+user_cache = UserCache(
+    DATABASE.with_name(DATABASE.name + '-user-versions'),
+    max_entries=USER_CACHE_SIZE,
+    ttl=USER_CACHE_TTL,
+)
+
+
+def get_user_profile(user_id):
+    """Get a user's profile and total_minutes, from the cache when possible"""
+    profile = user_cache.get(user_id)
+    if profile is not None:
+        return profile
+
+    # Read the version before the row so a concurrent write can only make us miss
+    version = user_cache.version(user_id)
+    profile = repo.get_user(user_id)
+    if not profile:
+        return None
+    user_cache.put(user_id, profile, version)
+    return profile
+
+
+@lru_cache(maxsize=1024)
+def get_zone(name):
+    """Return the ZoneInfo for an IANA name, loaded once per process"""
+    return ZoneInfo(name)
+
+
+def is_valid_timezone(name):
+    if not name or not isinstance(name, str):
+        return False
+    try:
+        get_zone(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+def parse_utc_timestamp(value):
+    """Parse a stored created_at ('YYYY-MM-DD HH:MM:SS' UTC, or ISO) into an aware datetime"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def local_day(zone_name, created_at=None):
+    """Return the 'YYYY-MM-DD' date in zone_name at created_at (default now)"""
+    moment = parse_utc_timestamp(created_at) if created_at else datetime.now(timezone.utc)
+    return moment.astimezone(get_zone(zone_name)).strftime('%Y-%m-%d')
+
+
+def set_user_timezone(user_id, zone_name):
+    """Store a user's IANA zone
+
+    The first time a user gets a zone their existing rows are restamped in
+    it (they were bucketed by UTC date until then). Later changes, e.g.
+    while travelling, leave logged days where they were.
+    """
+    def restamp(created_at):
+        return local_day(zone_name, created_at)
+
+    user = get_user_profile(user_id)
+    first_zone = bool(user) and not user.get('timezone')
+    repo.set_user_timezone(user_id, zone_name, restamp=restamp if first_zone else None)
+    user_cache.invalidate(user_id)
+
+
+def get_user_timezone(user_id, requested=None):
+    """Return the user's stored zone, adopting `requested` if they don't have one yet"""
+    user = get_user_profile(user_id)
+    if user and user.get('timezone'):
+        return user['timezone']
+    if user and is_valid_timezone(requested):
+        set_user_timezone(user_id, requested)
+        return requested
+    return DEFAULT_TIMEZONE
+
+
+def get_user_today(user_id):
+    """Return the user's current local 'YYYY-MM-DD' day
+
+    Clients may pass their IANA zone as `timezone` (query or JSON body); it's
+    only used to fill in a missing profile zone.
+    """
+    requested = request.args.get('timezone')
+    if requested is None and request.is_json:
+        requested = (request.get_json(silent=True) or {}).get('timezone')
+    return local_day(get_user_timezone(user_id, requested))
+
+
+def close_days(closing):
+    """Close {local day: [timezones]} groups; returns the number of user-days rolled up"""
+    closed = 0
+    for day, zones in closing.items():
+        closed += repo.close_day(day, zones, include_unzoned=DEFAULT_TIMEZONE in zones)
+    return closed
+
+
+def yesterday_by_zone(zone_names, now=None):
+    """Group zones by the local day that ended at their most recent midnight"""
+    now = now or datetime.now(timezone.utc)
+    closing = {}
+    for zone_name in zone_names:
+        day = (now.astimezone(get_zone(zone_name)).date() - timedelta(days=1)).strftime('%Y-%m-%d')
+        closing.setdefault(day, []).append(zone_name)
+    return closing
+
+
+def start_day_rollover():
+    """Close out users' days at their local midnight in a daemon thread
+
+    Stored timezones sit in a MidnightWheel; the thread sleeps until the
+    next midnight (waking every DAY_ROLLOVER_REFRESH_SECONDS to pick up new
+    zones) and closes each due zone group with one repo.close_day() pass.
+    A zone joining the wheel has yesterday closed straight away, which also
+    covers a restart across midnight.
+    """
+    wheel = MidnightWheel(get_zone)
+
+    def run():
+        while True:
+            try:
+                now = datetime.now(timezone.utc)
+                zone_names = {name for name in repo.list_timezones() | {DEFAULT_TIMEZONE}
+                              if name not in wheel and is_valid_timezone(name)}
+                for zone_name in zone_names:
+                    wheel.add(zone_name, now)
+                close_days(yesterday_by_zone(zone_names, now))
+                close_days(wheel.pop_due(now))
+            except Exception:
+                logger.exception('Error closing out days')
+
+            wait = DAY_ROLLOVER_REFRESH_SECONDS
+            next_due = wheel.next_due()
+            if next_due is not None:
+                wait = min(wait, max(0.0, (next_due - datetime.now(timezone.utc)).total_seconds()))
+            time.sleep(wait)
+
+    return start_locked_thread('day-rollover', DATABASE.parent / '.rollover.lock', run)
+
+
+@app.cli.command('close-days')
+@click.option('--day', default=None, help='Local YYYY-MM-DD day to close (default: yesterday in each zone)')
+@click.option('--zone', 'zones', multiple=True, help='Only these timezones (default: every stored zone)')
+def close_days_command(day, zones):
+    """Roll up users' daily totals for a finished day"""
+    zone_names = set(zones) or repo.list_timezones() | {DEFAULT_TIMEZONE}
+    unknown = sorted(name for name in zone_names if not is_valid_timezone(name))
+    if unknown:
+        raise click.ClickException(f"Unknown timezone(s): {', '.join(unknown)}")
+    closing = {day: sorted(zone_names)} if day else yesterday_by_zone(zone_names)
+    closed = close_days(closing)
+    click.echo(f'Closed {closed} user-day(s) across {len(zone_names)} timezone(s)')
+
+
 # Initialize database on app startup
 with app.app_context():
     init_db()
@@ -235,10 +1170,254 @@ def after_request(response):
         response.headers['Access-Control-Allow-Origin'] = origin
         response.headers['Access-Control-Allow-Credentials'] = 'true'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Idempotency-Key'
     
     return response
 
+# Response compression
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/x-ndjson', 'text/html', 'text/css', 'text/csv',
+    'text/plain', 'application/javascript', 'text/javascript', 'image/svg+xml',
+}
+_compressed_cache = OrderedDict()  # (encoding, strong ETag) -> compressed bytes
+_compressed_cache_lock = threading.Lock()
+_static_file_cache = {}  # path -> (mtime, body, etag)
+
+
+def read_static_file(path):
+    """Return (bytes, etag) for a small static file, re-reading only when it changes"""
+    mtime = path.stat().st_mtime
+    cached = _static_file_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+    body = path.read_bytes()
+    etag = hashlib.sha1(body).hexdigest()
+    _static_file_cache[path] = (mtime, body, etag)
+    return body, etag
+
+
+def choose_encoding():
+    """Pick the best supported Content-Encoding the client accepts"""
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_body(body, encoding, etag=None):
+    """Compress a response body, reusing the result for bodies with the same strong ETag
+
+    Only ETagged bodies (the static catalog files) are cached; per-user
+    responses are compressed each time so they can't evict them.
+    """
+    key = (encoding, etag)
+    if etag:
+        with _compressed_cache_lock:
+            compressed = _compressed_cache.get(key)
+            if compressed is not None:
+                _compressed_cache.move_to_end(key)
+                return compressed
+
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(body, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+    if not etag:
+        return compressed
+    with _compressed_cache_lock:
+        _compressed_cache[key] = compressed
+        if len(_compressed_cache) > COMPRESS_CACHE_ENTRIES:
+            _compressed_cache.popitem(last=False)
+    return compressed
+
+
+@app.after_request
+def compress_response(response):
+    """Compress large text responses with gzip or brotli per Accept-Encoding"""
+    if (
+        request.method == 'HEAD'
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.direct_passthrough
+        or response.is_streamed
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    if weak:
+        etag = None
+    response.set_data(compress_body(body, encoding, etag))
+    response.headers['Content-Encoding'] = encoding
+    # A strong ETag must change with the encoding; revalidate against the new one
+    if etag:
+        response.set_etag(f'{etag}-{encoding}')
+        if request.if_none_match:
+            response.make_conditional(request)
+    return response
+
+
+# Rate limiting
+class MemoryRateLimitStore:
+    """Token buckets for this worker, evicting least recently used keys"""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take one token; return 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class SQLiteRateLimitStore:
+    """Token buckets shared by all workers through a small SQLite file
+
+    Kept out of app.db so rate limit bookkeeping never contends with the
+    app's own writes.
+    """
+
+    PRUNE_EVERY = 1000  # Calls between sweeps of idle buckets
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+        conn = self._connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=1)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = OFF')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate):
+        """Take one token; return 0 if allowed, else seconds until one is available"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?', (key,)
+            ).fetchone()
+            tokens, updated_at = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0, now - updated_at) * rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            conn.execute('''
+                INSERT INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+            ''', (key, tokens, now))
+
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                # Buckets idle for an hour have refilled under every budget above
+                conn.execute('DELETE FROM rate_limit_buckets WHERE updated_at < ?', (now - 3600,))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        return retry_after
+
+
+if RATE_LIMIT_STORE == 'sqlite':
+    rate_limit_store = SQLiteRateLimitStore(RATE_LIMIT_DATABASE)
+else:
+    rate_limit_store = MemoryRateLimitStore(RATE_LIMIT_MAX_KEYS)
+
+
+def client_ip():
+    """The real client address behind Cloudflare
+
+    Forwarding headers are only believed from TRUSTED_PROXIES; anyone else
+    could set them to get a fresh rate limit bucket on every request.
+    """
+    remote = request.remote_addr or 'unknown'
+    if remote not in TRUSTED_PROXIES:
+        return remote
+    if request.headers.get('CF-Connecting-IP'):
+        return request.headers['CF-Connecting-IP'].strip()
+    # The nearest hop that isn't one of our proxies; entries left of it came from the client
+    for hop in reversed(request.headers.get('X-Forwarded-For', '').split(',')):
+        hop = hop.strip()
+        if hop and hop not in TRUSTED_PROXIES:
+            return hop
+    return remote
+
+
+@app.before_request
+def enforce_rate_limits():
+    """Reject requests over their endpoint's token bucket budget with a 429"""
+    if not RATE_LIMIT_ENABLED or request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return None
+
+    limit = RATE_LIMITS.get(request.endpoint)
+    if limit is None:
+        if not request.path.startswith('/api/'):
+            return None
+        limit = DEFAULT_WRITE_RATE_LIMIT
+
+    scope, capacity, rate = limit
+    user_id = session.get('user_id') if scope == 'user' else None
+    subject = f'user:{user_id}' if user_id else f'ip:{client_ip()}'
+    bucket = request.endpoint if request.endpoint in RATE_LIMITS else 'write'
+
+    try:
+        retry_after = rate_limit_store.take(f'{bucket}:{subject}', capacity, rate)
+    except sqlite3.OperationalError:
+        # A locked or unwritable limiter file shouldn't take the API down with it: fail open
+        logger.warning('Rate limiter unavailable; request let through', exc_info=True,
+                       extra={'bucket': bucket})
+        return None
+    if retry_after:
+        response = jsonify({'error': 'Too many requests'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+        return response
+    return None
+
+
 # Handle preflight OPTIONS requests
 @app.before_request
 def handle_preflight():
@@ -250,7 +1429,7 @@ def handle_preflight():
             response.headers['Access-Control-Allow-Origin'] = origin
             response.headers['Access-Control-Allow-Credentials'] = 'true'
             response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-            response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Idempotency-Key'
         return response
 
 
@@ -264,39 +1443,30 @@ def register():
         display_name = request.form.get('display_name')
         password = request.form.get('password')
         profile_picture = request.files.get('profile_picture')
+        zone_name = request.form.get('timezone') or None
 
         if not all([username, email, display_name, password]):
             return jsonify({'error': 'Missing required fields'}), 400
 
-        conn = get_db()
-        cursor = conn.cursor()
+        if zone_name is not None and not is_valid_timezone(zone_name):
+            return jsonify({'error': 'Unknown timezone'}), 400
 
         # Check if username or email already exists
-        cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?',
-                      (username, email))
-        if cursor.fetchone():
-            conn.close()
+        if repo.is_username_or_email_taken(username, email):
             return jsonify({'error': 'Username or email already exists'}), 400
 
-        # Create user
-        password_hash = generate_password_hash(password)
-        cursor.execute('''
-            INSERT INTO users (username, email, password_hash, display_name, total_minutes)
-            VALUES (?, ?, ?, ?, 0)
-        ''', (username, email, password_hash, display_name))
-        user_id = cursor.lastrowid
-
-        # Save profile picture if provided
+        # Save profile picture if provided (stored by content hash, so before the user exists)
         profile_pic_filename = None
         if profile_picture:
-            profile_pic_filename = save_profile_picture(profile_picture, user_id)
-            if profile_pic_filename:
-                cursor.execute('''
-                    UPDATE users SET profile_picture = ? WHERE id = ?
-                ''', (profile_pic_filename, user_id))
+            try:
+                profile_pic_filename = save_profile_picture(profile_picture)
+            except UploadTooLarge as e:
+                return jsonify({'error': str(e)}), 413
 
-        conn.commit()
-        conn.close()
+        # Create user
+        password_hash = generate_password_hash(password)
+        user_id = repo.create_user(username, email, password_hash, display_name, profile_pic_filename,
+                                   timezone=zone_name)
 
         # Set session
         session['user_id'] = user_id
@@ -308,9 +1478,12 @@ def register():
                 'email': email,
                 'display_name': display_name,
                 'profile_picture': profile_pic_filename,
+                'timezone': zone_name,
             }
         }), 201
 
+    except RequestEntityTooLarge:
+        raise  # Answered with a 413 by request_too_large
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -326,14 +1499,7 @@ def login():
         if not username or not password:
             return jsonify({'error': 'Username and password required'}), 400
 
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, username, email, display_name, profile_picture, password_hash
-            FROM users WHERE username = ?
-        ''', (username,))
-        user = cursor.fetchone()
-        conn.close()
+        user = repo.get_user_for_login(username)
 
         if not user or not check_password_hash(user['password_hash'], password):
             return jsonify({'error': 'Invalid credentials'}), 401
@@ -347,6 +1513,7 @@ def login():
                 'email': user['email'],
                 'display_name': user['display_name'],
                 'profile_picture': user['profile_picture'],
+                'timezone': user['timezone'],
             }
         }), 200
 
@@ -368,15 +1535,7 @@ def get_current_user():
     if not user_id:
         return jsonify({'error': 'Not authenticated'}), 401
 
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, username, email, display_name, profile_picture
-        FROM users WHERE id = ?
-    ''', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-
+    user = get_user_profile(user_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
@@ -387,6 +1546,7 @@ def get_current_user():
             'email': user['email'],
             'display_name': user['display_name'],
             'profile_picture': user['profile_picture'],
+            'timezone': user.get('timezone'),
         }
     }), 200
 
@@ -399,14 +1559,9 @@ def update_profile():
         return jsonify({'error': 'Not authenticated'}), 401
 
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-
         # Get current user
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
+        user = get_user_profile(user_id)
         if not user:
-            conn.close()
             return jsonify({'error': 'User not found'}), 404
 
         # Update fields
@@ -414,30 +1569,27 @@ def update_profile():
         display_name = request.form.get('display_name', user['display_name'])
         password = request.form.get('password')
         profile_picture = request.files.get('profile_picture')
+        zone_name = request.form.get('timezone') or user.get('timezone')
+
+        if zone_name is not None and not is_valid_timezone(zone_name):
+            return jsonify({'error': 'Unknown timezone'}), 400
 
         # Update password if provided
-        password_hash = user['password_hash']
-        if password:
-            password_hash = generate_password_hash(password)
+        password_hash = generate_password_hash(password) if password else None
 
         # Update profile picture if provided
         profile_pic_filename = user['profile_picture']
         if profile_picture:
-            # Delete old profile picture if exists
-            if profile_pic_filename:
-                old_file = UPLOAD_FOLDER / profile_pic_filename
-                if old_file.exists():
-                    old_file.unlink()
-            profile_pic_filename = save_profile_picture(profile_picture, user_id)
-
-        cursor.execute('''
-            UPDATE users 
-            SET email = ?, display_name = ?, password_hash = ?, profile_picture = ?
-            WHERE id = ?
-        ''', (email, display_name, password_hash, profile_pic_filename, user_id))
+            # The old picture may be shared with other users; the upload sweeper removes it once orphaned
+            try:
+                profile_pic_filename = save_profile_picture(profile_picture)
+            except UploadTooLarge as e:
+                return jsonify({'error': str(e)}), 413
 
-        conn.commit()
-        conn.close()
+        repo.update_user(user_id, email, display_name, password_hash, profile_pic_filename)
+        user_cache.invalidate(user_id)
+        if zone_name != user.get('timezone'):
+            set_user_timezone(user_id, zone_name)
 
         return jsonify({
             'user': {
@@ -446,9 +1598,12 @@ def update_profile():
                 'email': email,
                 'display_name': display_name,
                 'profile_picture': profile_pic_filename,
+                'timezone': zone_name,
             }
         }), 200
 
+    except RequestEntityTooLarge:
+        raise  # Answered with a 413 by request_too_large
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -461,12 +1616,7 @@ def get_time():
     if not user_id:
         return jsonify({'error': 'Not authenticated'}), 401
 
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT total_minutes FROM users WHERE id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-
+    user = get_user_profile(user_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
@@ -476,64 +1626,49 @@ def get_time():
 
 @app.route('/api/time/today', methods=['GET'])
 def get_time_today():
-    """Get time added today (since local midnight)"""
+    """Get time added today (since local midnight in the user's timezone)"""
     user_id = session.get('user_id')
     if not user_id:
         return jsonify({'error': 'Not authenticated'}), 401
 
     try:
-        # Get timezone offset from query parameter (in minutes)
-        timezone_offset = request.args.get('timezone_offset', type=int)
-        if timezone_offset is None:
-            return jsonify({'error': 'Timezone offset required'}), 400
+        # Rows carry the local day they were logged on, so this is one indexed lookup
+        actions = repo.list_time_actions_for_day(user_id, get_user_today(user_id))
+        total_minutes_today = sum(action['minutes_added'] or 0 for action in actions)
 
-        conn = get_db()
-        cursor = conn.cursor()
+        time_data = minutes_to_days_hours_minutes(total_minutes_today)
+        return jsonify(time_data), 200
 
-        # Calculate today's start in UTC based on user's timezone
-        from datetime import datetime, timedelta, timezone
-        
-        # Get current time in user's timezone
-        user_tz = timezone(timedelta(minutes=-timezone_offset))
-        now = datetime.now(user_tz)
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Convert to UTC for comparison with database timestamps
-        today_start_utc = today_start.astimezone(timezone.utc)
-        
-        # Get all time actions for this user with timestamps
-        cursor.execute('''
-            SELECT minutes_added, created_at
-            FROM time_actions
-            WHERE user_id = ?
-        ''', (user_id,))
-        
-        actions = cursor.fetchall()
-        conn.close()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # Sum minutes for actions that occurred today
-        total_minutes_today = 0
-        for action in actions:
-            try:
-                action_str = action['created_at']
-                if 'T' in action_str:
-                    if action_str.endswith('Z'):
-                        action_str = action_str.replace('Z', '+00:00')
-                    elif '+' not in action_str and '-' not in action_str[-6:]:
-                        action_str = action_str + '+00:00'
-                    action_time = datetime.fromisoformat(action_str)
-                else:
-                    action_time = datetime.strptime(action_str, '%Y-%m-%d %H:%M:%S')
-                    action_time = action_time.replace(tzinfo=timezone.utc)
-                
-                if action_time >= today_start_utc:
-                    total_minutes_today += action['minutes_added'] or 0
-            except Exception as e:
-                print(f"Error parsing timestamp {action['created_at']}: {e}")
-                continue
 
-        time_data = minutes_to_days_hours_minutes(total_minutes_today)
-        return jsonify(time_data), 200
+@app.route('/api/time/days', methods=['GET'])
+def get_time_days():
+    """Get per-day totals: today's so far, plus closed days newest first"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    try:
+        try:
+            limit = int(request.args.get('limit', 30))
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        limit = max(1, min(limit, DAILY_TOTALS_MAX_DAYS))
+
+        today = get_user_today(user_id)
+        actions = repo.list_time_actions_for_day(user_id, today)
+
+        # Closed days were rolled up at midnight, so this never touches raw history
+        return jsonify({
+            'today': {
+                'local_day': today,
+                'actions': len(actions),
+                'minutes_added': sum(action['minutes_added'] or 0 for action in actions),
+            },
+            'days': repo.list_daily_totals(user_id, before_day=today, limit=limit),
+        }), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -547,68 +1682,8 @@ def get_today_actions():
         return jsonify({'error': 'Not authenticated'}), 401
 
     try:
-        # Get timezone offset from query parameter (in minutes)
-        timezone_offset = request.args.get('timezone_offset', type=int)
-        if timezone_offset is None:
-            return jsonify({'error': 'Timezone offset required'}), 400
-
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Calculate today's start in UTC based on user's timezone
-        # timezone_offset is in minutes (e.g., -300 for EST which is UTC-5)
-        # We need to find actions that occurred after midnight in user's local time
-        # SQLite stores timestamps in UTC, so we need to adjust
-        
-        # Get all actions for this user
-        cursor.execute('''
-            SELECT action, created_at
-            FROM time_actions
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-        ''', (user_id,))
-        
-        actions = cursor.fetchall()
-        conn.close()
-
-        # Filter actions that occurred today in user's local timezone
-        from datetime import datetime, timedelta, timezone
-        
-        # Get current time in user's timezone
-        # timezone_offset is minutes from UTC (negative for west of UTC, positive for east)
-        # JavaScript getTimezoneOffset() returns negative of what we need
-        user_tz = timezone(timedelta(minutes=-timezone_offset))
-        now = datetime.now(user_tz)
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Convert to UTC for comparison with database timestamps
-        today_start_utc = today_start.astimezone(timezone.utc)
-        
-        actions_today = []
-        for action in actions:
-            # Parse the timestamp (SQLite stores as string in UTC)
-            try:
-                # Handle different timestamp formats
-                action_str = action['created_at']
-                if 'T' in action_str:
-                    # ISO format with or without timezone
-                    if action_str.endswith('Z'):
-                        action_str = action_str.replace('Z', '+00:00')
-                    elif '+' not in action_str and '-' not in action_str[-6:]:
-                        # Assume UTC if no timezone
-                        action_str = action_str + '+00:00'
-                    action_time = datetime.fromisoformat(action_str)
-                else:
-                    # SQLite datetime format: YYYY-MM-DD HH:MM:SS
-                    action_time = datetime.strptime(action_str, '%Y-%m-%d %H:%M:%S')
-                    # Assume UTC
-                    action_time = action_time.replace(tzinfo=timezone.utc)
-                
-                if action_time >= today_start_utc:
-                    actions_today.append(action['action'])
-            except Exception as e:
-                print(f"Error parsing timestamp {action['created_at']}: {e}")
-                continue
+        actions_today = [action['action']
+                         for action in repo.list_time_actions_for_day(user_id, get_user_today(user_id))]
 
         # Count occurrences of each action
         from collections import Counter
@@ -624,75 +1699,49 @@ def get_today_actions():
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/button-actions', methods=['GET'])
-def get_button_actions():
-    """Get button actions configuration with user-specific edits and deletions"""
-    user_id = session.get('user_id')
-    
-    # Load default actions from JSON file (never modified)
-    default_actions = load_button_actions()
-    actions = []
-    
-    # Get user's deleted and edited actions if logged in
+def get_default_catalog():
+    """Return (json bytes, version hash) for the default catalog"""
+    if BUTTON_ACTIONS_FILE.exists():
+        return read_static_file(BUTTON_ACTIONS_FILE)
+    body = json.dumps({'actions': load_button_actions()}).encode('utf-8')
+    return body, hashlib.sha1(body).hexdigest()
+
+
+def override_row_to_action(row):
+    """Convert an edited_actions/custom_actions row to the catalog's action format"""
+    return {
+        'text': row['text'],
+        'minutes': row['minutes'],
+        'similar-to': json.loads(row['similar_to']) if row['similar_to'] else [],
+        'is-repeatable-daily': bool(row['is_repeatable_daily']),
+        'must-be-logged-at-end-of-day': bool(row['must_be_logged_at_end_of_day']),
+        'warning': row['warning'] if row['warning'] else None,
+    }
+
+
+def load_user_catalog_overlay(user_id):
+    """Load a user's catalog changes: (deleted texts, edits by original text, custom actions)"""
     deleted_texts = set()
     edited_actions_map = {}
-    
-    if user_id:
-        try:
-            conn = get_db()
-            cursor = conn.cursor()
-            
-            # Get deleted actions
-            cursor.execute('''
-                SELECT action_text
-                FROM deleted_actions
-                WHERE user_id = ?
-            ''', (user_id,))
-            deleted_actions = cursor.fetchall()
-            deleted_texts = {row['action_text'] for row in deleted_actions}
-            
-            # Get edited actions
-            cursor.execute('''
-                SELECT original_text, text, minutes, similar_to, is_repeatable_daily,
-                       must_be_logged_at_end_of_day, warning
-                FROM edited_actions
-                WHERE user_id = ?
-            ''', (user_id,))
-            edited_actions = cursor.fetchall()
-            for action in edited_actions:
-                edited_actions_map[action['original_text']] = {
-                    'text': action['text'],
-                    'minutes': action['minutes'],
-                    'similar-to': json.loads(action['similar_to']) if action['similar_to'] else [],
-                    'is-repeatable-daily': bool(action['is_repeatable_daily']),
-                    'must-be-logged-at-end-of-day': bool(action['must_be_logged_at_end_of_day']),
-                    'warning': action['warning'] if action['warning'] else None,
-                }
-            
-            # Get custom actions
-            cursor.execute('''
-                SELECT text, minutes, similar_to, is_repeatable_daily, 
-                       must_be_logged_at_end_of_day, warning
-                FROM custom_actions
-                WHERE user_id = ?
-                ORDER BY created_at ASC
-            ''', (user_id,))
-            custom_actions = cursor.fetchall()
-            conn.close()
-            
-            # Add custom actions
-            for action in custom_actions:
-                actions.append({
-                    'text': action['text'],
-                    'minutes': action['minutes'],
-                    'similar-to': json.loads(action['similar_to']) if action['similar_to'] else [],
-                    'is-repeatable-daily': bool(action['is_repeatable_daily']),
-                    'must-be-logged-at-end-of-day': bool(action['must_be_logged_at_end_of_day']),
-                    'warning': action['warning'] if action['warning'] else None,
-                    'is_custom': True,
-                })
-        except Exception as e:
-            print(f"Error loading user actions: {e}")
+    custom_actions_list = []
+
+    try:
+        deleted_texts, edited_actions, custom_actions = repo.get_catalog_overlay(user_id)
+
+        for action in edited_actions:
+            edited_actions_map[action['original_text']] = override_row_to_action(action)
+        
+        for action in custom_actions:
+            custom_actions_list.append({**override_row_to_action(action), 'is_custom': True})
+    except Exception:
+        logger.exception('Error loading user actions', extra={'user_id': user_id})
+
+    return deleted_texts, edited_actions_map, custom_actions_list
+
+
+def merge_catalog(default_actions, deleted_texts, edited_actions_map, custom_actions):
+    """Apply a user's deletions, edits and custom actions to the default catalog"""
+    actions = list(custom_actions)
     
     # Process default actions: filter deleted, apply edits
     for action in default_actions:
@@ -722,17 +1771,177 @@ def get_button_actions():
                 'original_text': original_text,
                 'is_edited': False,
             })
+
+    return actions
+
+
+_action_indexes = OrderedDict()  # (defaults version, overlay hash) -> ActionIndex
+_action_indexes_lock = threading.Lock()
+
+
+def get_action_index(user_id):
+    """Return the compiled search index for a user's merged catalog
+
+    Indexes are cached by catalog content rather than by user, so users
+    without changes share the default catalog's index, and an index is only
+    rebuilt when the defaults or that user's overlay actually change.
+    """
+    deleted_texts, edited_actions_map, custom_actions = set(), {}, []
+    if user_id:
+        deleted_texts, edited_actions_map, custom_actions = load_user_catalog_overlay(user_id)
+
+    _, version = get_default_catalog()
+    overlay = json.dumps([sorted(deleted_texts), edited_actions_map, custom_actions], sort_keys=True)
+    key = (version, hashlib.sha1(overlay.encode('utf-8')).digest())
+
+    with _action_indexes_lock:
+        index = _action_indexes.get(key)
+        if index is not None:
+            _action_indexes.move_to_end(key)
+            return index
+
+    index = ActionIndex(merge_catalog(load_button_actions(), deleted_texts, edited_actions_map, custom_actions))
+    with _action_indexes_lock:
+        _action_indexes[key] = index
+        while len(_action_indexes) > ACTION_INDEX_CACHE_ENTRIES:
+            _action_indexes.popitem(last=False)
+    return index
+
+
+@app.route('/api/actions/search', methods=['GET'])
+def search_actions():
+    """Autocomplete over the current user's merged catalog (defaults, edits, custom)
+
+    Query params:
+        q: text typed so far; every word must prefix a word of the action,
+            with fuzzy matches filling in for typos
+        limit: max results (default 10)
+    """
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), ACTION_SEARCH_MAX_RESULTS)
+
+    try:
+        index = get_action_index(session.get('user_id'))
+        results = []
+        for score, action in index.search(query, limit):
+            results.append({
+                'text': action['text'],
+                'minutes': action['minutes'],
+                'original_text': action.get('original_text'),
+                'is_custom': bool(action.get('is_custom')),
+                'is_edited': bool(action.get('is_edited')),
+                'similar': index.similar_to(action['text']),
+                'score': round(score, 3),
+            })
+        return jsonify({'query': query, 'results': results}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/button-actions', methods=['GET'])
+def get_button_actions():
+    """Get button actions configuration with user-specific edits and deletions
+
+    With ?mode=overlay only the user's changes are returned, along with the
+    version of the default catalog they apply to; the client fetches that
+    catalog from /api/button-actions/defaults and merges them itself.
+    """
+    user_id = session.get('user_id')
+    
+    # Get user's deleted, edited and custom actions if logged in
+    deleted_texts = set()
+    edited_actions_map = {}
+    custom_actions = []
+    if user_id:
+        deleted_texts, edited_actions_map, custom_actions = load_user_catalog_overlay(user_id)
+
+    if request.args.get('mode') == 'overlay':
+        _, version = get_default_catalog()
+        return jsonify({
+            'defaults_version': version,
+            'deleted': sorted(deleted_texts),
+            'edited': edited_actions_map,
+            'custom': custom_actions,
+        }), 200
+
+    # Load default actions from JSON file (never modified)
+    actions = merge_catalog(load_button_actions(), deleted_texts, edited_actions_map, custom_actions)
     
     return jsonify({'actions': actions}), 200
 
 
+@app.route('/api/button-actions/defaults', methods=['GET'])
+def get_default_button_actions():
+    """Get the default catalog; immutable when requested by its current version"""
+    body, version = get_default_catalog()
+    response = Response(body, mimetype='application/json')
+    response.set_etag(version)
+    if request.args.get('v') == version:
+        # Content-addressed URL: any catalog change produces a new one
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+_idempotent_responses = OrderedDict()  # (user_id, key) -> (expires_at, status, body)
+_idempotent_responses_lock = threading.Lock()
+
+
+def remember_idempotent_response(user_id, key, status, body):
+    """Keep a committed keyed response in the in-memory front cache"""
+    with _idempotent_responses_lock:
+        _idempotent_responses[(user_id, key)] = (time.monotonic() + IDEMPOTENCY_TTL_SECONDS, status, body)
+        _idempotent_responses.move_to_end((user_id, key))
+        while len(_idempotent_responses) > IDEMPOTENCY_CACHE_ENTRIES:
+            _idempotent_responses.popitem(last=False)
+
+
+def forget_idempotent_responses(user_id):
+    """Drop a user's keyed responses from the in-memory front cache"""
+    with _idempotent_responses_lock:
+        for cached_key in [cached_key for cached_key in _idempotent_responses if cached_key[0] == user_id]:
+            del _idempotent_responses[cached_key]
+
+
+def replay_idempotent_response(user_id, key):
+    """Return the stored response for an already-applied key, or None"""
+    with _idempotent_responses_lock:
+        cached = _idempotent_responses.get((user_id, key))
+    if cached and cached[0] > time.monotonic():
+        status, body = cached[1], cached[2]
+    else:
+        stored = repo.get_idempotent_response(user_id, key)
+        if not stored:
+            return None
+        status, body = stored
+        remember_idempotent_response(user_id, key, status, body)
+
+    response = app.response_class(body, status=status, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
 @app.route('/api/time/add', methods=['POST'])
 def add_time():
-    """Add time based on action"""
+    """Add time based on action
+
+    Send an Idempotency-Key header to make retries safe: a repeated key
+    returns the original response without adding the time again.
+    """
     user_id = session.get('user_id')
     if not user_id:
         return jsonify({'error': 'Not authenticated'}), 401
 
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None:
+        if not idempotency_key or len(idempotency_key) > 255:
+            return jsonify({'error': 'Invalid Idempotency-Key'}), 400
+        replay = replay_idempotent_response(user_id, idempotency_key)
+        if replay is not None:
+            return replay
+
     try:
         data = request.json
         action = data.get('action')
@@ -744,61 +1953,90 @@ def add_time():
             minutes_to_add = button_minutes[action]
         else:
             # Try to find in edited or custom actions
-            conn = get_db()
-            cursor = conn.cursor()
-            
-            # Check edited actions
-            cursor.execute('''
-                SELECT minutes
-                FROM edited_actions
-                WHERE user_id = ? AND text = ?
-            ''', (user_id, action))
-            edited = cursor.fetchone()
-            
-            if edited:
-                minutes_to_add = edited['minutes']
-            else:
-                # Check custom actions
-                cursor.execute('''
-                    SELECT minutes
-                    FROM custom_actions
-                    WHERE user_id = ? AND text = ?
-                ''', (user_id, action))
-                custom = cursor.fetchone()
-                
-                if custom:
-                    minutes_to_add = custom['minutes']
-            
-            conn.close()
-            
+            minutes_to_add = repo.get_override_minutes(user_id, action)
             if minutes_to_add is None:
                 return jsonify({'error': 'Invalid action'}), 400
 
-        conn = get_db()
-        cursor = conn.cursor()
+        # Record the action and update the total; a keyed request stores its
+        # response in the same transaction
+        response_body = None
 
-        # Update user's total minutes
-        cursor.execute('''
-            UPDATE users 
-            SET total_minutes = total_minutes + ?
-            WHERE id = ?
-        ''', (minutes_to_add, user_id))
+        def render(total_minutes):
+            nonlocal response_body
+            response_body = json.dumps(minutes_to_days_hours_minutes(total_minutes))
+            return 200, response_body
 
-        # Record action
-        cursor.execute('''
-            INSERT INTO time_actions (user_id, action, minutes_added)
-            VALUES (?, ?, ?)
-        ''', (user_id, action, minutes_to_add))
+        try:
+            total_minutes = repo.add_time_action(user_id, action, minutes_to_add,
+                                                 idempotency_key=idempotency_key, render=render,
+                                                 local_day=get_user_today(user_id))
+        except IdempotencyKeyTaken:
+            replay = replay_idempotent_response(user_id, idempotency_key)
+            if replay is not None:
+                return replay
+            return jsonify({'error': 'A request with this Idempotency-Key is in progress'}), 409
 
-        # Get updated total
-        cursor.execute('SELECT total_minutes FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
+        user_cache.invalidate(user_id)
+        if idempotency_key is not None:
+            remember_idempotent_response(user_id, idempotency_key, 200, response_body)
 
-        conn.commit()
-        conn.close()
+        return jsonify(minutes_to_days_hours_minutes(total_minutes)), 200
 
-        time_data = minutes_to_days_hours_minutes(user['total_minutes'])
-        return jsonify(time_data), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/sync', methods=['GET'])
+def sync_changes():
+    """Get everything that changed for the current user since a sync sequence
+
+    Returns upserted rows and deleted keys (tombstones) per resource, plus
+    the sequence to send as ?since= next time. since=0 (or a reset in
+    between) returns a full snapshot with 'full': true, meaning the client
+    should replace its state; so does a since older than the change log's
+    retention window. Resources listed in 'invalidated' changed in bulk
+    (imports, compaction) and should be refetched.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    since = request.args.get('since', 0, type=int)
+
+    try:
+        changes = repo.read_changes(user_id, since)
+
+        profile = get_user_profile(user_id)
+        if not profile:
+            return jsonify({'error': 'User not found'}), 404
+
+        upserted = changes['upserted']
+        deleted = changes['deleted']
+        return jsonify({
+            'seq': changes['seq'],
+            'full': changes['full'],
+            'invalidated': changes['invalidated'],
+            'total_minutes': profile['total_minutes'],
+            'profile': profile if changes['profile_changed'] else None,
+            'time_actions': {
+                'upserted': upserted['time_action'],
+                'deleted': [int(key) for key in deleted['time_action']],
+            },
+            'deleted_actions': {
+                'upserted': [row['action_text'] for row in upserted['deleted_action']],
+                'deleted': deleted['deleted_action'],
+            },
+            'edited_actions': {
+                'upserted': [{**override_row_to_action(row), 'original_text': row['original_text']}
+                             for row in upserted['edited_action']],
+                'deleted': deleted['edited_action'],
+            },
+            'custom_actions': {
+                'upserted': [{**override_row_to_action(row), 'is_custom': True}
+                             for row in upserted['custom_action']],
+                'deleted': deleted['custom_action'],
+            },
+        }), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -807,8 +2045,36 @@ def add_time():
 # File serving endpoint
 @app.route('/api/uploads/<filename>')
 def uploaded_file(filename):
-    """Serve uploaded files"""
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    """Serve uploaded files
+
+    Content-addressed files never change, so they're cached for a year and
+    marked immutable with the hash as ETag. Older timestamp-named files keep
+    the default revalidating caching.
+    """
+    match = CONTENT_ADDRESSED_UPLOAD.match(filename)
+    if not match:
+        return send_from_directory(UPLOAD_FOLDER, filename)
+
+    response = send_from_directory(UPLOAD_FOLDER, filename, etag=match.group(1),
+                                   max_age=365 * 24 * 60 * 60)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    """Return a JSON error for bodies over MAX_CONTENT_LENGTH"""
+    return jsonify({'error': f'Upload is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB'}), 413
+
+
+@app.cli.command('sweep-uploads')
+@click.option('--grace-seconds', type=int, default=UPLOAD_SWEEP_GRACE_SECONDS,
+              help='Keep unreferenced files younger than this')
+def sweep_uploads_command(grace_seconds):
+    """Delete uploaded files no user references"""
+    removed = sweep_uploads(grace_seconds)
+    click.echo(f'Removed {removed} orphaned upload(s)')
 
 
 # Users listing endpoint (hidden page)
@@ -816,58 +2082,193 @@ def uploaded_file(filename):
 def get_all_users():
     """Get all users (for hidden /users page)"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, username, email, display_name, profile_picture, 
-                   total_minutes, created_at
-            FROM users
-            ORDER BY created_at DESC
-        ''')
-        users = cursor.fetchall()
-        conn.close()
+        users = repo.list_users()
 
-        users_list = []
-        for user in users:
-            users_list.append({
-                'id': user['id'],
-                'username': user['username'],
-                'email': user['email'],
-                'display_name': user['display_name'],
-                'profile_picture': user['profile_picture'],
-                'total_minutes': user['total_minutes'],
-                'created_at': user['created_at'],
-            })
+        # The JSON provider converts the rows while encoding
+        return jsonify({'users': users}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Per-route query counts and the costliest statements for this worker (needs the profiling token)
+
+    The counts stay empty unless FIVEMORE_SQL_TRACE=1.
+    """
+    try:
+        metrics = query_stats.snapshot(SQL_METRICS_TOP_STATEMENTS)
+        return jsonify({'sql_trace': SQL_TRACE, 'slow_query_ms': SLOW_QUERY_MS, 'pid': os.getpid(),
+                        'log_dropped': logger.queue_handler.dropped, **metrics}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/profiles', methods=['GET'])
+def list_request_profiles():
+    """List saved request profiles, newest first (needs the profiling token)"""
+    try:
+        return jsonify({'profiles': list_profiles(PROFILE_DIR)}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/profiles/<filename>', methods=['GET'])
+def get_request_profile(filename):
+    """Download one capture file: <name>.pstats, <name>.collapsed or <name>.json (needs the profiling token)"""
+    if not filename.endswith(('.pstats', '.collapsed', '.json')):
+        return jsonify({'error': 'Not found'}), 404
+    return send_from_directory(PROFILE_DIR, filename, as_attachment=True)
+
+
+@app.route('/api/stats/actions', methods=['GET'])
+def get_action_stats():
+    """Most logged actions across all users, for one UTC day or all time (needs the profiling token)"""
+    try:
+        day = request.args.get('day')
+        if day == 'today':
+            day = datetime.utcnow().strftime('%Y-%m-%d')
+        elif day:
+            try:
+                day = datetime.strptime(day, '%Y-%m-%d').strftime('%Y-%m-%d')
+            except ValueError:
+                return jsonify({'error': 'day must be YYYY-MM-DD or "today"'}), 400
+
+        try:
+            limit = int(request.args.get('limit', ACTION_STATS_MAX_RESULTS))
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        limit = max(1, min(limit, ACTION_STATS_MAX_RESULTS))
 
-        return jsonify({'users': users_list}), 200
+        stats = repo.get_action_stats(day or None, limit)
+        return jsonify({'day': day or None, 'actions': stats}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/stats/actions/check', methods=['GET'])
+def check_action_stats():
+    """Compare the popularity counters against the raw history (needs the profiling token)"""
+    try:
+        drift = repo.check_action_stats()
+        return jsonify({'ok': not drift, 'drift': drift}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/stats/totals/check', methods=['GET'])
+def check_user_totals():
+    """Compare one batch of users' total_minutes against their history (needs the profiling token)
+
+    Page through users with ?after=<user id>.
+    """
+    try:
+        try:
+            after = int(request.args.get('after', 0))
+            limit = int(request.args.get('limit', RECONCILE_BATCH_SIZE))
+        except ValueError:
+            return jsonify({'error': 'after and limit must be numbers'}), 400
+        limit = max(1, min(limit, RECONCILE_BATCH_SIZE))
+
+        batch = repo.reconcile_totals(after, limit)
+        return jsonify({'ok': not batch['drift'], 'drift': batch['drift'], 'checked': batch['checked'],
+                        'next_after': batch['last_user_id'] if batch['checked'] == limit else None}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.cli.command('reconcile-totals')
+@click.option('--repair', is_flag=True, help='Correct totals that have drifted')
+@click.option('--batch-size', default=RECONCILE_BATCH_SIZE, show_default=True, help='Users per transaction')
+@click.option('--pause', default=RECONCILE_PAUSE_SECONDS, show_default=True, help='Seconds to sleep between batches')
+def reconcile_totals_command(repair, batch_size, pause):
+    """Check every user's total_minutes against their history, in small batches"""
+    after = checked = drifted = 0
+    while True:
+        batch = repo.reconcile_totals(after, batch_size, repair)
+        if batch['last_user_id'] is None:
+            break
+        for row in batch['drift']:
+            click.echo(f"user {row['user_id']}: total {row['total_minutes']} "
+                       f"(expected {row['expected_total_minutes']})")
+            if repair:
+                user_cache.invalidate(row['user_id'])
+        checked += batch['checked']
+        drifted += len(batch['drift'])
+        after = batch['last_user_id']
+        time.sleep(pause)
+
+    if not drifted:
+        click.echo(f'Checked {checked} user(s); all totals match history')
+    elif repair:
+        click.echo(f'Checked {checked} user(s); repaired {drifted} total(s)')
+    else:
+        raise click.ClickException(f'{drifted} of {checked} user total(s) drifted; rerun with --repair')
+
+
+@app.cli.command('reweight-history')
+@click.option('--dry-run', is_flag=True, help='Report what would change without writing anything')
+@click.option('--user', 'user_id', type=int, help="Only re-price this user's history")
+@click.option('--chunk-size', default=REWEIGHT_CHUNK_SIZE, show_default=True, help='Rows per transaction')
+@click.option('--pause', default=RECONCILE_PAUSE_SECONDS, show_default=True, help='Seconds to sleep between chunks')
+def reweight_history_command(dry_run, user_id, chunk_size, pause):
+    """Re-price logged history at the catalog's current minutes (rerun to resume)"""
+    def progress(table, last_id, max_id):
+        if last_id == max_id:
+            click.echo(f'{table}: scanned through id {max_id}')
+        time.sleep(pause)
+
+    result = repo.reweight_history(get_button_minutes_dict(), user_id, dry_run, chunk_size, progress)
+    for change in result['changes']:
+        click.echo(f"{change['action']!r}: {change['old_minutes']} -> {change['new_minutes']} minutes, "
+                   f"{change['rows']} row(s)")
+    click.echo(f"{'Would re-price' if dry_run else 'Re-priced'} {result['rows']} history row(s) and "
+               f"{result['summary_rows']} summary row(s) for {result['users']} user(s), "
+               f"{result['minutes_delta']:+d} minutes")
+    for changed_user_id in result['recomputed_users']:
+        user_cache.invalidate(changed_user_id)
+
+
+@app.cli.command('rebuild-action-stats')
+def rebuild_action_stats_command():
+    """Recompute the action popularity counters from history"""
+    rows = repo.rebuild_action_stats()
+    click.echo(f'Rebuilt {rows} action stats row(s)')
+
+
+@app.cli.command('check-action-stats')
+@click.option('--repair', is_flag=True, help='Rebuild the counters if any have drifted')
+def check_action_stats_command(repair):
+    """Report action popularity counters that disagree with history"""
+    drift = repo.check_action_stats()
+    for row in drift:
+        click.echo(f"{row['day']} {row['action']!r}: count {row['count']} (expected {row['expected_count']}), "
+                   f"minutes {row['minutes_added']} (expected {row['expected_minutes_added']})")
+    if not drift:
+        click.echo('Action stats match history')
+    elif repair:
+        rows = repo.rebuild_action_stats()
+        click.echo(f'Rebuilt {rows} action stats row(s)')
+    else:
+        raise click.ClickException(f'{len(drift)} action stats row(s) drifted; rerun with --repair')
+
+
 @app.route('/api/users/<int:user_id>/actions', methods=['GET'])
 def get_user_actions(user_id):
     """Get all actions for a specific user"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, action, minutes_added, created_at
-            FROM time_actions
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-        ''', (user_id,))
-        actions = cursor.fetchall()
-        conn.close()
+        # The JSON provider converts the rows while encoding
+        actions_list = list(repo.list_time_actions(user_id))
 
-        actions_list = []
-        for action in actions:
-            actions_list.append({
-                'id': action['id'],
-                'action': action['action'],
-                'minutes_added': action['minutes_added'],
-                'created_at': action['created_at'],
-            })
+        # Compacted history is always older than the raw rows
+        for summary in repo.list_daily_summaries(user_id):
+            actions_list.append(summary_to_action(summary))
 
         return jsonify({'actions': actions_list}), 200
 
@@ -875,86 +2276,482 @@ def get_user_actions(user_id):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/actions/today/reset', methods=['POST'])
-def reset_today_actions():
-    """Reset actions from the current day (since previous midnight)"""
-    user_id = session.get('user_id')
-    if not user_id:
-        return jsonify({'error': 'Not authenticated'}), 401
+def summary_to_action(summary):
+    """Present a compacted daily summary row like a history action"""
+    return {
+        'id': f"summary-{summary['id']}",
+        'action': summary['action'],
+        'minutes_added': summary['minutes_added'],
+        'created_at': f"{summary['day']} 00:00:00",
+        'count': summary['count'],
+        'is_summary': True,
+    }
+
+
+def parse_export_bound(value, end_of_day=False):
+    """Normalize an export date bound to SQLite's 'YYYY-MM-DD HH:MM:SS' format"""
+    value = value.strip().replace('T', ' ')
+    if len(value) == 10:
+        parsed = datetime.strptime(value, '%Y-%m-%d')
+        if end_of_day:
+            return parsed.strftime('%Y-%m-%d') + ' 23:59:59'
+        return parsed.strftime('%Y-%m-%d %H:%M:%S')
+    return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def gzip_stream(chunks):
+    """Gzip an iterable of byte chunks without buffering the whole body"""
+    # wbits=31 writes a gzip header/trailer around the deflate stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route('/api/users/<int:user_id>/actions/export', methods=['GET'])
+def export_user_actions(user_id):
+    """Stream a user's action history as CSV or NDJSON
+
+    Query params:
+        format: 'csv' (default) or 'ndjson'
+        start, end: optional UTC bounds ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS');
+            a date-only end includes that whole day
+        gzip: '1' to gzip the stream
+    """
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Format must be csv or ndjson'}), 400
 
     try:
-        # Get timezone offset from request body or query parameter
-        data = request.get_json() or {}
-        timezone_offset = data.get('timezone_offset') or request.args.get('timezone_offset', type=int)
-        if timezone_offset is None:
-            return jsonify({'error': 'Timezone offset required'}), 400
-
-        conn = get_db()
-        cursor = conn.cursor()
+        start = request.args.get('start')
+        end = request.args.get('end')
+        if start:
+            start = parse_export_bound(start)
+        if end:
+            end = parse_export_bound(end, end_of_day=True)
+    except ValueError:
+        return jsonify({'error': 'Invalid start or end date'}), 400
+
+    use_gzip = request.args.get('gzip') in ('1', 'true')
+
+    def generate_rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(['id', 'action', 'minutes_added', 'created_at', 'count'])
+
+        # Compacted daily summaries come first since they are older than raw rows
+        for rows in repo.iter_history(user_id, start, end, batch_size=EXPORT_BATCH_SIZE):
+            for row in rows:
+                if export_format == 'csv':
+                    writer.writerow([row['id'], row['action'], row['minutes_added'],
+                                     row['created_at'], row['count']])
+                else:
+                    buffer.write(json.dumps({
+                        'id': row['id'],
+                        'action': row['action'],
+                        'minutes_added': row['minutes_added'],
+                        'created_at': row['created_at'],
+                        'count': row['count'],
+                    }))
+                    buffer.write('\n')
+
+            # Flush one batch at a time so memory stays flat
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate(0)
+
+        # Header-only CSV when there are no rows
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+    body = generate_rows()
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f'user_{user_id}_actions.{export_format}'
+    if use_gzip:
+        body = gzip_stream(body)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
-        # Calculate today's start in UTC based on user's timezone
-        from datetime import datetime, timedelta, timezone
-        
-        # Get current time in user's timezone
-        user_tz = timezone(timedelta(minutes=-timezone_offset))
-        now = datetime.now(user_tz)
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Convert to UTC for comparison with database timestamps
-        today_start_utc = today_start.astimezone(timezone.utc)
-        
-        # Get all time actions for this user
-        cursor.execute('''
-            SELECT id, action, minutes_added, created_at
-            FROM time_actions
-            WHERE user_id = ?
-        ''', (user_id,))
-        
-        actions = cursor.fetchall()
 
-        # Find actions from today and calculate total minutes to subtract
-        actions_to_delete = []
-        total_minutes_to_subtract = 0
-        
-        for action in actions:
+def parse_import_timestamp(value):
+    """Parse an imported timestamp into SQLite's UTC 'YYYY-MM-DD HH:MM:SS' format"""
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def read_import_rows(stream, import_format, compressed=False):
+    """Yield dict rows from a binary CSV or NDJSON stream, one line at a time"""
+    if compressed:
+        stream = gzip.GzipFile(fileobj=stream)
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    if import_format == 'csv':
+        for row in csv.DictReader(text):
+            yield row
+    else:
+        for line in text:
+            line = line.strip()
+            if not line:
+                continue
             try:
-                action_str = action['created_at']
-                if 'T' in action_str:
-                    if action_str.endswith('Z'):
-                        action_str = action_str.replace('Z', '+00:00')
-                    elif '+' not in action_str and '-' not in action_str[-6:]:
-                        action_str = action_str + '+00:00'
-                    action_time = datetime.fromisoformat(action_str)
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def import_user_actions(user_id, rows):
+    """Validate and bulk insert historical actions for a user
+
+    Each row needs an 'action' from the user's merged catalog and may carry a
+    'created_at' timestamp (defaults to now). Minutes always come from the
+    catalog. Rows are inserted with executemany() in IMPORT_CHUNK_SIZE
+    transactions so live writers only ever wait on one short chunk, and
+    users.total_minutes is recomputed once at the end, even if the import
+    fails partway, since earlier chunks are already committed.
+    """
+    if not repo.user_exists(user_id):
+        return None
+
+    button_minutes = get_user_button_minutes(user_id)
+    zone_name = get_user_timezone(user_id)
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+    imported = 0
+    skipped = 0
+    errors = []
+    batch = []
+    days = set()
+
+    # Errors are reported against 1-based data row numbers (CSV header excluded)
+    try:
+        for row_number, row in enumerate(rows, start=1):
+            error = None
+            if not isinstance(row, dict):
+                error = 'Malformed row'
+            elif not isinstance(row.get('action'), str):
+                error = f'Unknown action: {row.get("action")!r}'
+            else:
+                action = row['action'].strip()
+                if action not in button_minutes:
+                    error = f'Unknown action: {action!r}'
                 else:
-                    action_time = datetime.strptime(action_str, '%Y-%m-%d %H:%M:%S')
-                    action_time = action_time.replace(tzinfo=timezone.utc)
-                
-                if action_time >= today_start_utc:
-                    actions_to_delete.append(action['id'])
-                    total_minutes_to_subtract += action['minutes_added'] or 0
-            except Exception as e:
-                print(f"Error parsing timestamp {action['created_at']}: {e}")
+                    created_at = now
+                    if row.get('created_at'):
+                        try:
+                            created_at = parse_import_timestamp(str(row['created_at']))
+                        except ValueError:
+                            error = f'Invalid created_at: {row["created_at"]!r}'
+
+            if error:
+                skipped += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append({'row': row_number, 'error': error})
                 continue
 
-        # Delete today's actions
-        if actions_to_delete:
-            placeholders = ','.join(['?'] * len(actions_to_delete))
-            cursor.execute(f'''
-                DELETE FROM time_actions 
-                WHERE id IN ({placeholders})
-            ''', actions_to_delete)
+            day = local_day(zone_name, created_at)
+            days.add(day)
+            batch.append((action, button_minutes[action], created_at, day))
+            if len(batch) >= IMPORT_CHUNK_SIZE:
+                repo.insert_time_actions(user_id, batch)
+                imported += len(batch)
+                batch = []
+
+        if batch:
+            repo.insert_time_actions(user_id, batch)
+            imported += len(batch)
+    finally:
+        if imported:
+            # Recompute the denormalized total once instead of per row
+            repo.recompute_total_minutes(user_id)
+            user_cache.invalidate(user_id)
+
+            # Days that were already closed need their totals redone
+            today = local_day(zone_name)
+            repo.close_user_days(user_id, [day for day in days if day < today])
+
+    return {'imported': imported, 'skipped': skipped, 'errors': errors}
+
+
+def detect_import_format(filename, requested_format=None):
+    """Work out (format, compressed) from an explicit format or the file name"""
+    filename = (filename or '').lower()
+    compressed = filename.endswith('.gz')
+    if compressed:
+        filename = filename[:-3]
+    import_format = (requested_format or '').lower()
+    if not import_format:
+        import_format = 'ndjson' if filename.endswith(('.ndjson', '.jsonl')) else 'csv'
+    return import_format, compressed
+
+
+@app.route('/api/users/<int:user_id>/actions/import', methods=['POST'])
+def import_actions(user_id):
+    """Import a CSV or NDJSON file of historical actions for a user"""
+    session_user_id = session.get('user_id')
+    if not session_user_id:
+        return jsonify({'error': 'Not authenticated'}), 401
+    if session_user_id != user_id:
+        return jsonify({'error': 'Forbidden'}), 403
 
-        # Subtract today's minutes from total
-        if total_minutes_to_subtract > 0:
-            cursor.execute('''
-                UPDATE users 
-                SET total_minutes = MAX(0, total_minutes - ?)
-                WHERE id = ?
-            ''', (total_minutes_to_subtract, user_id))
+    try:
+        upload = request.files.get('file')
+        if not upload:
+            return jsonify({'error': 'File is required'}), 400
 
-        conn.commit()
+        import_format, compressed = detect_import_format(
+            upload.filename, request.form.get('format') or request.args.get('format'))
+        if import_format not in ('csv', 'ndjson'):
+            return jsonify({'error': 'Format must be csv or ndjson'}), 400
+
+        result = import_user_actions(user_id, read_import_rows(upload.stream, import_format, compressed))
+        if result is None:
+            return jsonify({'error': 'User not found'}), 404
+
+        return jsonify(result), 200
+
+    except RequestEntityTooLarge:
+        raise  # Answered with a 413 by request_too_large
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.cli.command('import-actions')
+@click.argument('user_id', type=int)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='File format (inferred from the extension by default)')
+def import_actions_command(user_id, path, import_format):
+    """Import a CSV or NDJSON file of historical actions for USER_ID"""
+    import_format, compressed = detect_import_format(path, import_format)
+    with open(path, 'rb') as f:
+        result = import_user_actions(user_id, read_import_rows(f, import_format, compressed))
+
+    if result is None:
+        raise click.ClickException(f'User {user_id} not found')
+
+    click.echo(f"Imported {result['imported']} actions, skipped {result['skipped']}")
+    for error in result['errors']:
+        click.echo(f"  row {error['row']}: {error['error']}")
+
+
+def compact_history(older_than_days=None, archive_path=None, vacuum=True):
+    """Fold old time_actions rows into per-user, per-day summaries
+
+    Rows created before the cutoff are aggregated into daily_action_summaries
+    (UTC days), optionally copied verbatim into an archive database, and then
+    deleted from time_actions (see Repository.compact_history). Afterwards
+    free pages are handed back to the filesystem.
+    """
+    if older_than_days is None:
+        older_than_days = COMPACT_AFTER_DAYS
+    if archive_path is None:
+        archive_path = ARCHIVE_DATABASE
+
+    # Cut at a UTC day boundary so a day is never split across raw and summary
+    cutoff_day = (datetime.utcnow() - timedelta(days=older_than_days)).strftime('%Y-%m-%d')
+    cutoff = f'{cutoff_day} 00:00:00'
+
+    result = repo.compact_history(cutoff, archive_path or None)
+    if vacuum and result['rows_compacted']:
+        repo.reclaim_space()
+    return dict(result, cutoff=cutoff)
+
+
+@app.cli.command('compact-history')
+@click.option('--older-than-days', type=int, default=None,
+              help=f'Compact rows older than this many days (default {COMPACT_AFTER_DAYS})')
+@click.option('--archive', 'archive_path', type=click.Path(dir_okay=False), default=None,
+              help='SQLite file to keep the raw rows in (default FIVEMORE_ARCHIVE_DB_PATH)')
+@click.option('--no-vacuum', is_flag=True, help='Skip reclaiming free space afterwards')
+def compact_history_command(older_than_days, archive_path, no_vacuum):
+    """Compact old time actions into daily summaries"""
+    result = compact_history(older_than_days, archive_path, vacuum=not no_vacuum)
+    click.echo(f"Compacted {result['rows_compacted']} actions for {result['users']} users "
+               f"(older than {result['cutoff']})")
+
+
+def verify_database_file(path):
+    """Open a database copy read-only and check it is intact and readable"""
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        if result != 'ok':
+            return False, result
+        users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        actions = conn.execute('SELECT COUNT(*) FROM time_actions').fetchone()[0]
+        return True, f'{users} users, {actions} actions'
+    except sqlite3.Error as e:
+        return False, str(e)
+    finally:
         conn.close()
 
+
+def backup_database(backup_dir=None, compress=True, keep=None, verify=True):
+    """Take an online snapshot of the database without stalling live requests
+
+    Uses sqlite3's backup API, copying BACKUP_PAGES_PER_STEP pages at a time
+    and sleeping BACKUP_STEP_SLEEP seconds between steps so writers can get
+    in between. The copy is integrity-checked, optionally gzipped, and old
+    snapshots beyond `keep` are removed. SQLite only: the memory engine has
+    no file to copy.
+    """
+    if STORAGE_ENGINE != 'sqlite':
+        raise RuntimeError(f'Backups copy the SQLite database; FIVEMORE_STORAGE={STORAGE_ENGINE} has none')
+    backup_dir = Path(backup_dir or BACKUP_DIR)
+    keep = BACKUP_KEEP if keep is None else keep
+    backup_dir.mkdir(parents=True, exist_ok=True)
+
+    stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    snapshot = backup_dir / f'{DATABASE.stem}-{stamp}.db'
+    partial = snapshot.with_name(snapshot.name + '.partial')
+
+    source = get_db()
+    target = sqlite3.connect(partial)
+    try:
+        def pace(status, remaining, total):
+            time.sleep(BACKUP_STEP_SLEEP)
+
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=pace)
+        # The copy inherits WAL mode; make it a single self-contained file
+        target.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        target.close()
+        source.close()
+
+    if verify:
+        ok, detail = verify_database_file(partial)
+        if not ok:
+            partial.unlink()
+            raise RuntimeError(f'Backup verification failed: {detail}')
+
+    if compress:
+        compressed = snapshot.with_name(snapshot.name + '.gz')
+        with open(partial, 'rb') as src, gzip.open(compressed, 'wb') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        partial.unlink()
+        snapshot = compressed
+    else:
+        partial.rename(snapshot)
+
+    rotate_backups(backup_dir, keep)
+    return snapshot
+
+
+def rotate_backups(backup_dir, keep):
+    """Delete all but the newest `keep` snapshots in backup_dir"""
+    snapshots = sorted(
+        list(backup_dir.glob(f'{DATABASE.stem}-*.db')) + list(backup_dir.glob(f'{DATABASE.stem}-*.db.gz')),
+        key=lambda p: p.name,
+        reverse=True,
+    )
+    for old in snapshots[keep:]:
+        old.unlink()
+
+
+def verify_backup(path):
+    """Restore a snapshot into a scratch file and verify it"""
+    path = Path(path)
+    with tempfile.TemporaryDirectory() as scratch:
+        restored = Path(scratch) / 'restore.db'
+        if path.suffix == '.gz':
+            with gzip.open(path, 'rb') as src, open(restored, 'wb') as dst:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+        else:
+            shutil.copyfile(path, restored)
+        return verify_database_file(restored)
+
+
+def start_backup_scheduler(interval_hours):
+    """Run backup_database() every interval_hours in a daemon thread"""
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+
+    def run():
+        while True:
+            time.sleep(interval_hours * 3600)
+            try:
+                backup_database()
+            except Exception:
+                logger.exception('Error taking scheduled backup')
+
+    return start_locked_thread('db-backup', BACKUP_DIR / '.scheduler.lock', run)
+
+
+def start_background_jobs():
+    """Start the upload sweeper, backup scheduler and day rollover
+
+    Called from the server process only (gunicorn's post_worker_init hook or
+    the dev server below), so CLI commands and imports don't start them.
+    """
+    if UPLOAD_SWEEP_INTERVAL_HOURS > 0:
+        start_upload_sweeper(UPLOAD_SWEEP_INTERVAL_HOURS)
+    if BACKUP_INTERVAL_HOURS > 0 and STORAGE_ENGINE == 'sqlite':
+        start_backup_scheduler(BACKUP_INTERVAL_HOURS)
+    if DAY_ROLLOVER_ENABLED:
+        start_day_rollover()
+
+
+@app.cli.command('backup-db')
+@click.option('--dir', 'backup_dir', type=click.Path(file_okay=False), default=None,
+              help='Directory for snapshots (default FIVEMORE_BACKUP_DIR)')
+@click.option('--keep', type=int, default=None, help=f'Snapshots to keep (default {BACKUP_KEEP})')
+@click.option('--no-compress', is_flag=True, help='Store the snapshot uncompressed')
+def backup_db_command(backup_dir, keep, no_compress):
+    """Take an online, verified snapshot of the database"""
+    try:
+        snapshot = backup_database(backup_dir, compress=not no_compress, keep=keep)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Backup written to {snapshot}')
+
+
+@app.cli.command('verify-backup')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def verify_backup_command(path):
+    """Test-restore a snapshot and check its integrity"""
+    ok, detail = verify_backup(path)
+    if not ok:
+        raise click.ClickException(f'Backup is not usable: {detail}')
+    click.echo(f'Backup OK ({detail})')
+
+
+@app.route('/api/actions/today/reset', methods=['POST'])
+def reset_today_actions():
+    """Reset actions from the current day (since local midnight)"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    try:
+        # Find actions from today
+        actions_to_delete = [action['id']
+                             for action in repo.list_time_actions_for_day(user_id, get_user_today(user_id))]
+
+        # Delete today's actions and subtract their minutes from the total
+        total_minutes_to_subtract = repo.delete_time_actions(user_id, actions_to_delete)
+
+        if total_minutes_to_subtract > 0:
+            user_cache.invalidate(user_id)
+
         return jsonify({
             'message': 'Today\'s actions reset successfully',
             'actions_deleted': len(actions_to_delete),
@@ -965,6 +2762,13 @@ def reset_today_actions():
         return jsonify({'error': str(e)}), 500
 
 
+def reset_user_data(user_id):
+    """Clear a user's history and catalog overrides (restoring the default actions)"""
+    repo.reset_user(user_id)
+    forget_idempotent_responses(user_id)
+    user_cache.invalidate(user_id)
+
+
 @app.route('/api/auth/reset', methods=['POST'])
 def reset_current_user():
     """Reset the current user's actions and total minutes, and restore default actions"""
@@ -973,30 +2777,7 @@ def reset_current_user():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Delete all time actions for this user
-        cursor.execute('DELETE FROM time_actions WHERE user_id = ?', (user_id,))
-
-        # Reset total minutes to 0
-        cursor.execute('''
-            UPDATE users 
-            SET total_minutes = 0
-            WHERE id = ?
-        ''', (user_id,))
-
-        # Delete all custom actions
-        cursor.execute('DELETE FROM custom_actions WHERE user_id = ?', (user_id,))
-        
-        # Delete all deleted actions (restore defaults)
-        cursor.execute('DELETE FROM deleted_actions WHERE user_id = ?', (user_id,))
-        
-        # Delete all edited actions (restore defaults)
-        cursor.execute('DELETE FROM edited_actions WHERE user_id = ?', (user_id,))
-
-        conn.commit()
-        conn.close()
+        reset_user_data(user_id)
 
         return jsonify({'message': 'User reset successfully'}), 200
 
@@ -1025,23 +2806,8 @@ def delete_action():
         if action_text not in default_texts:
             return jsonify({'error': 'Can only delete default actions'}), 400
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Add to deleted_actions (or update if exists)
-        cursor.execute('''
-            INSERT OR REPLACE INTO deleted_actions (user_id, action_text)
-            VALUES (?, ?)
-        ''', (user_id, action_text))
-        
-        # If this action was edited, remove the edit
-        cursor.execute('''
-            DELETE FROM edited_actions 
-            WHERE user_id = ? AND original_text = ?
-        ''', (user_id, action_text))
-        
-        conn.commit()
-        conn.close()
+        # Hide it (dropping any edit of it)
+        repo.delete_default_action(user_id, action_text)
         
         return jsonify({'message': 'Action deleted successfully'}), 200
         
@@ -1079,34 +2845,15 @@ def edit_action():
         if original_text not in default_texts:
             return jsonify({'error': 'Can only edit default actions'}), 400
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Remove from deleted_actions if it was deleted
-        cursor.execute('''
-            DELETE FROM deleted_actions 
-            WHERE user_id = ? AND action_text = ?
-        ''', (user_id, original_text))
-        
-        # Insert or update edited action
-        cursor.execute('''
-            INSERT OR REPLACE INTO edited_actions 
-            (user_id, original_text, text, minutes, similar_to, is_repeatable_daily,
-             must_be_logged_at_end_of_day, warning, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (
-            user_id,
-            original_text,
-            text,
-            minutes,
-            json.dumps(similar_to) if similar_to else None,
-            1 if is_repeatable_daily else 0,
-            1 if must_be_logged_at_end_of_day else 0,
-            warning if warning else None
-        ))
-        
-        conn.commit()
-        conn.close()
+        # Insert or update the edit (un-deleting the action if it was deleted)
+        repo.edit_default_action(user_id, original_text, {
+            'text': text,
+            'minutes': minutes,
+            'similar_to': similar_to,
+            'is_repeatable_daily': is_repeatable_daily,
+            'must_be_logged_at_end_of_day': must_be_logged_at_end_of_day,
+            'warning': warning,
+        })
         
         return jsonify({
             'message': 'Action edited successfully',
@@ -1139,17 +2886,8 @@ def restore_action():
         if not action_text:
             return jsonify({'error': 'Action text is required'}), 400
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
         # Remove from deleted_actions
-        cursor.execute('''
-            DELETE FROM deleted_actions 
-            WHERE user_id = ? AND action_text = ?
-        ''', (user_id, action_text))
-        
-        conn.commit()
-        conn.close()
+        repo.restore_default_action(user_id, action_text)
         
         return jsonify({'message': 'Action restored successfully'}), 200
         
@@ -1171,17 +2909,8 @@ def delete_custom_action_by_text():
         if not action_text:
             return jsonify({'error': 'Action text is required'}), 400
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
         # Delete the custom action
-        cursor.execute('''
-            DELETE FROM custom_actions 
-            WHERE user_id = ? AND text = ?
-        ''', (user_id, action_text))
-        
-        conn.commit()
-        conn.close()
+        repo.delete_custom_action(user_id, action_text)
         
         return jsonify({'message': 'Custom action deleted successfully'}), 200
         
@@ -1212,39 +2941,18 @@ def edit_custom_action():
         if not isinstance(minutes, int) or minutes < 0:
             return jsonify({'error': 'Minutes must be a non-negative integer'}), 400
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Verify the action exists and belongs to this user
-        cursor.execute('''
-            SELECT id FROM custom_actions 
-            WHERE user_id = ? AND text = ?
-        ''', (user_id, original_text))
-        
-        if not cursor.fetchone():
-            conn.close()
+        # Update the custom action (it must exist and belong to this user)
+        updated = repo.update_custom_action(user_id, original_text, {
+            'text': text,
+            'minutes': minutes,
+            'similar_to': similar_to,
+            'is_repeatable_daily': is_repeatable_daily,
+            'must_be_logged_at_end_of_day': must_be_logged_at_end_of_day,
+            'warning': warning,
+        })
+        if not updated:
             return jsonify({'error': 'Custom action not found'}), 404
         
-        # Update the custom action
-        cursor.execute('''
-            UPDATE custom_actions 
-            SET text = ?, minutes = ?, similar_to = ?, is_repeatable_daily = ?,
-                must_be_logged_at_end_of_day = ?, warning = ?
-            WHERE user_id = ? AND text = ?
-        ''', (
-            text,
-            minutes,
-            json.dumps(similar_to) if similar_to else None,
-            1 if is_repeatable_daily else 0,
-            1 if must_be_logged_at_end_of_day else 0,
-            warning if warning else None,
-            user_id,
-            original_text
-        ))
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({
             'message': 'Custom action updated successfully',
             'action': {
@@ -1283,37 +2991,25 @@ def create_custom_action():
         if not isinstance(minutes, int) or minutes < 0:
             return jsonify({'error': 'Minutes must be a non-negative integer'}), 400
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Check if user already has an action with this text
-        cursor.execute('''
-            SELECT id FROM custom_actions 
-            WHERE user_id = ? AND text = ?
-        ''', (user_id, text))
-        if cursor.fetchone():
-            conn.close()
+        # Reject near-identical copies (case and punctuation aside) of any action in the catalog
+        duplicate = get_action_index(user_id).find_duplicate(text)
+        if duplicate:
+            return jsonify({
+                'error': f'You already have an action with this text: "{duplicate["text"]}"'
+            }), 400
+        
+        # Insert new custom action unless the user already has one with this text
+        created = repo.create_custom_action(user_id, {
+            'text': text,
+            'minutes': minutes,
+            'similar_to': similar_to,
+            'is_repeatable_daily': is_repeatable_daily,
+            'must_be_logged_at_end_of_day': must_be_logged_at_end_of_day,
+            'warning': warning,
+        })
+        if not created:
             return jsonify({'error': 'You already have an action with this text'}), 400
         
-        # Insert new custom action
-        cursor.execute('''
-            INSERT INTO custom_actions 
-            (user_id, text, minutes, similar_to, is_repeatable_daily, 
-             must_be_logged_at_end_of_day, warning)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            text,
-            minutes,
-            json.dumps(similar_to) if similar_to else None,
-            1 if is_repeatable_daily else 0,
-            1 if must_be_logged_at_end_of_day else 0,
-            warning if warning else None
-        ))
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({
             'message': 'Custom action created successfully',
             'action': {
@@ -1334,30 +3030,7 @@ def create_custom_action():
 def reset_user(user_id):
     """Reset a user's actions and total minutes, and restore default actions"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Delete all time actions for this user
-        cursor.execute('DELETE FROM time_actions WHERE user_id = ?', (user_id,))
-
-        # Reset total minutes to 0
-        cursor.execute('''
-            UPDATE users 
-            SET total_minutes = 0
-            WHERE id = ?
-        ''', (user_id,))
-
-        # Delete all custom actions
-        cursor.execute('DELETE FROM custom_actions WHERE user_id = ?', (user_id,))
-        
-        # Delete all deleted actions (restore defaults)
-        cursor.execute('DELETE FROM deleted_actions WHERE user_id = ?', (user_id,))
-        
-        # Delete all edited actions (restore defaults)
-        cursor.execute('DELETE FROM edited_actions WHERE user_id = ?', (user_id,))
-
-        conn.commit()
-        conn.close()
+        reset_user_data(user_id)
 
         return jsonify({'message': 'User reset successfully'}), 200
 
@@ -1371,9 +3044,13 @@ def serve_button_actions():
     """Serve button actions JSON file"""
     try:
         if BUTTON_ACTIONS_FILE.exists():
-            return send_from_directory(PROJECT_ROOT, 'button-actions.json')
-    except Exception as e:
-        print(f"Error serving button actions: {e}")
+            # Served from memory so the compressed copy can be cached too
+            body, etag = read_static_file(BUTTON_ACTIONS_FILE)
+            response = Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            return response.make_conditional(request)
+    except Exception:
+        logger.exception('Error serving button actions')
     
     # Fallback response
     return jsonify({
@@ -1406,5 +3083,6 @@ def serve_spa(path):
 
 if __name__ == '__main__':
     init_db()
+    start_background_jobs()
     app.run(debug=True, host='127.0.0.1', port=5000)
 
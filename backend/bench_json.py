@@ -0,0 +1,99 @@
+"""Microbenchmark JSON serialization for the largest API responses
+
+Seeds a throwaway database, then times building and serializing each
+endpoint's payload the old way (dict per row built in the handler, Flask's
+default provider) and the new way (sqlite3.Row values handed to
+FastJSONProvider, which makes the dicts while encoding). Run from the backend
+directory:
+
+    python bench_json.py [--repeats 200] [--users 200] [--actions 5000]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+
+def seed(app_module, users, actions):
+    """Create `users` users, the first one with `actions` history rows"""
+    conn = sqlite3.connect(app_module.DATABASE)
+    conn.executemany('''
+        INSERT INTO users (username, email, password_hash, display_name, total_minutes)
+        VALUES (?, ?, 'x', ?, 0)
+    ''', [(f'user{i}', f'user{i}@example.com', f'User {i}') for i in range(users)])
+    texts = list(app_module.get_button_minutes_dict().items())
+    conn.executemany('''
+        INSERT INTO time_actions (user_id, action, minutes_added)
+        VALUES (1, ?, ?)
+    ''', [texts[i % len(texts)] for i in range(actions)])
+    conn.commit()
+    conn.close()
+
+
+def time_serialization(app, provider, build_payload, repeats):
+    """Return the mean milliseconds to build a payload and serialize it"""
+    with app.app_context():
+        provider.response(build_payload())  # Warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            provider.response(build_payload())
+    return (time.perf_counter() - start) * 1000 / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--actions', type=int, default=5000)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp()
+    os.environ['FIVEMORE_DB_PATH'] = os.path.join(scratch, 'bench.db')
+
+    import app as app_module
+    from flask.json.provider import DefaultJSONProvider
+
+    seed(app_module, args.users, args.actions)
+    app = app_module.app
+
+    # Fetch the catalog once as a logged-in user so the per-user merge runs too
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+    catalog = client.get('/api/button-actions').get_json()
+
+    conn = app_module.get_db()
+    users = conn.execute('''
+        SELECT id, username, email, display_name, profile_picture, total_minutes, created_at
+        FROM users ORDER BY created_at DESC
+    ''').fetchall()
+    actions = conn.execute('''
+        SELECT id, action, minutes_added, created_at
+        FROM time_actions WHERE user_id = 1 ORDER BY created_at DESC
+    ''').fetchall()
+    conn.close()
+
+    # (endpoint, payload as the old handlers built it, payload as handlers build it now)
+    cases = [
+        ('/api/button-actions', lambda: catalog, lambda: catalog),
+        ('/api/users',
+         lambda: {'users': [{key: user[key] for key in user.keys()} for user in users]},
+         lambda: {'users': users}),
+        ('/api/users/1/actions',
+         lambda: {'actions': [{key: action[key] for key in action.keys()} for action in actions]},
+         lambda: {'actions': list(actions)}),
+    ]
+    default_provider = DefaultJSONProvider(app)
+    fast_provider = app_module.FastJSONProvider(app)
+
+    print(f"orjson: {'yes' if app_module.orjson else 'no'}")
+    print(f"{'endpoint':<24}{'default ms':>12}{'fast ms':>12}{'speedup':>10}")
+    for path, build_dicts, build_rows in cases:
+        default_ms = time_serialization(app, default_provider, build_dicts, args.repeats)
+        fast_ms = time_serialization(app, fast_provider, build_rows, args.repeats)
+        print(f"{path:<24}{default_ms:>12.3f}{fast_ms:>12.3f}{default_ms / fast_ms:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
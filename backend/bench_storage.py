@@ -0,0 +1,64 @@
+"""Microbenchmark the storage engines behind the route handlers
+
+Runs the same workload (register users, log actions, read totals, history
+and catalog overlays) against SQLiteRepository on a throwaway database and
+against MemoryRepository. Run from the backend directory:
+
+    python bench_storage.py [--users 20] [--actions 200]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+
+def run_workload(repo, users, actions):
+    """Return the seconds spent on each part of the workload"""
+    timings = {}
+
+    start = time.perf_counter()
+    user_ids = [repo.create_user(f'user{i}', f'user{i}@example.com', 'x', f'User {i}')
+                for i in range(users)]
+    timings['create users'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        for i in range(actions):
+            repo.add_time_action(user_id, 'skipped a drink!', 22)
+    timings['add actions'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        repo.get_user(user_id)
+        repo.list_time_actions(user_id)
+        repo.get_catalog_overlay(user_id)
+    timings['read back'] = time.perf_counter() - start
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--actions', type=int, default=200)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp()
+    os.environ['FIVEMORE_DB_PATH'] = os.path.join(scratch, 'bench.db')
+
+    import app as app_module
+    from storage import MemoryRepository, SQLiteRepository
+
+    engines = [
+        ('sqlite', SQLiteRepository(app_module.get_db, idempotency_ttl=app_module.IDEMPOTENCY_TTL_SECONDS)),
+        ('memory', MemoryRepository(idempotency_ttl=app_module.IDEMPOTENCY_TTL_SECONDS)),
+    ]
+    results = {name: run_workload(repo, args.users, args.actions) for name, repo in engines}
+
+    print(f"{'step':<16}" + ''.join(f'{name + " ms":>12}' for name, _ in engines))
+    for step in results['sqlite']:
+        print(f'{step:<16}' + ''.join(f'{results[name][step] * 1000:>12.1f}' for name, _ in engines))
+
+
+if __name__ == '__main__':
+    main()
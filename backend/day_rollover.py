@@ -0,0 +1,72 @@
+"""Local-midnight timer wheel for closing out users' days
+
+Every timezone is filed under the UTC instant of its next local midnight.
+Zones whose midnights coincide (every UTC-5 zone, say) share one slot, so a
+tick hands back whole groups and the caller can close all of their users'
+days in one set-based pass instead of one query per user.
+"""
+import heapq
+from datetime import datetime, time, timedelta, timezone
+
+
+def next_local_midnight(zone, after):
+    """Return the first local midnight in `zone` strictly after the aware datetime `after`, in UTC"""
+    local_date = after.astimezone(zone).date()
+    while True:
+        local_date += timedelta(days=1)
+        # A midnight skipped by a DST jump resolves to the first instant of that day
+        midnight = datetime.combine(local_date, time(0), tzinfo=zone).astimezone(timezone.utc)
+        if midnight > after:
+            return midnight
+
+
+class MidnightWheel:
+    """Timezone names bucketed by their next local midnight
+
+    `get_zone` maps a zone name to a tzinfo (app.get_zone, which caches
+    ZoneInfo objects). Not thread-safe; it's owned by the rollover thread.
+    """
+
+    def __init__(self, get_zone):
+        self.get_zone = get_zone
+        self._slots = {}  # UTC midnight -> {zone names}
+        self._due = []  # heap of slot keys
+        self._zones = {}  # zone name -> its slot key
+
+    def __contains__(self, zone_name):
+        return zone_name in self._zones
+
+    def __len__(self):
+        return len(self._zones)
+
+    def add(self, zone_name, now):
+        """Schedule a zone at its next local midnight after `now` (no-op if already scheduled)"""
+        if zone_name in self._zones:
+            return
+        due = next_local_midnight(self.get_zone(zone_name), now)
+        if due not in self._slots:
+            self._slots[due] = set()
+            heapq.heappush(self._due, due)
+        self._slots[due].add(zone_name)
+        self._zones[zone_name] = due
+
+    def next_due(self):
+        """Return the UTC instant of the earliest scheduled midnight, or None"""
+        return self._due[0] if self._due else None
+
+    def pop_due(self, now):
+        """Remove every slot due at or before `now` and reschedule its zones
+
+        Returns {closed local 'YYYY-MM-DD' day: [zone names]}; zones that share
+        a midnight but sit on opposite sides of the date line close different
+        days, so they're grouped by day rather than by slot.
+        """
+        closing = {}
+        while self._due and self._due[0] <= now:
+            due = heapq.heappop(self._due)
+            for zone_name in self._slots.pop(due):
+                del self._zones[zone_name]
+                day = (due - timedelta(seconds=1)).astimezone(self.get_zone(zone_name)).strftime('%Y-%m-%d')
+                closing.setdefault(day, []).append(zone_name)
+                self.add(zone_name, due)
+        return {day: sorted(zones) for day, zones in closing.items()}
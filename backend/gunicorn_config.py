@@ -2,14 +2,27 @@
 import os
 
 bind = "127.0.0.1:5000"
-workers = 1
+# SQLite runs in WAL mode, so extra workers add read throughput while writes stay serialized
+workers = int(os.environ.get('FIVEMORE_WORKERS', 1))
 worker_class = "sync"
 timeout = 120
 keepalive = 5
-accesslog = "-"
+# The app writes sampled JSON access logs from a background thread (FIVEMORE_ACCESS_LOG_SAMPLE),
+# so gunicorn's synchronous access log stays off
+accesslog = None
 errorlog = "-"
 loglevel = "info"
 
 # Handle reverse proxy headers
 forwarded_allow_ips = "*"
 
+
+def post_fork(server, worker):
+    """Tell the app which sockets this worker accepts on, so it can shed load by accept-queue depth"""
+    os.environ['FIVEMORE_LISTEN_FDS'] = ','.join(str(sock.fileno()) for sock in worker.sockets)
+
+
+def post_worker_init(worker):
+    """Start the app's background jobs in each worker; lock files keep one copy of each running"""
+    import app
+    app.start_background_jobs()
@@ -0,0 +1,113 @@
+"""Structured JSON logging that never blocks a request
+
+Records go onto a bounded queue through a QueueHandler and are formatted
+and written by a QueueListener thread, so a request thread only pays for
+building the record. If the sink falls behind and the queue fills up, new
+records are dropped rather than making requests wait; the number dropped
+rides along on the next record that gets through.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else was passed in `extra` and becomes a JSON field
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, then the record's extra fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # Only the cheap, thread-bound parts happen here: merging args (they
+        # may be mutated after we return) and rendering a live traceback
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        with self._lock:
+            if self.dropped > self._reported:
+                record.dropped = self.dropped - self._reported
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self._reported = self.dropped
+
+
+class _Listener(logging.handlers.QueueListener):
+    def stop(self):
+        # Safe to call twice (explicitly and again at exit)
+        if self._thread is not None:
+            super().stop()
+
+
+def configure_logging(name, level='INFO', queue_size=10000, stream=None, context=None):
+    """Return logger `name` writing JSON lines to stream (stdout) through a background thread
+
+    `context` is an optional callable returning a dict of fields (e.g. the
+    current request id) that is merged into every record on the calling
+    thread. The logger doesn't propagate, so gunicorn's and werkzeug's own
+    logging is left alone.
+    """
+    log_queue = queue.Queue(queue_size)
+    sink = logging.StreamHandler(stream or sys.stdout)
+    sink.setFormatter(JSONFormatter())
+    listener = _Listener(log_queue, sink, respect_handler_level=True)
+
+    handler = DroppingQueueHandler(log_queue)
+    if context is not None:
+        def add_context(record):
+            for key, value in context().items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+            return True
+        handler.addFilter(add_context)
+
+    logger = logging.getLogger(name)
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener.start()
+    atexit.register(listener.stop)  # Flush what's queued on shutdown
+    logger.queue_handler = handler
+    logger.queue_listener = listener
+    return logger
@@ -0,0 +1,130 @@
+"""Per-request profiling: cProfile stats plus sampled, flamegraph-ready stacks
+
+cProfile gives exact call counts and times but only caller/callee pairs, so
+a second thread samples the request thread's stack every few milliseconds
+to build collapsed stacks ('outer;inner;leaf count' lines, the input format
+of flamegraph.pl and speedscope). Only one request per process is profiled
+at a time; a request that asks while another is being profiled runs
+normally.
+"""
+import cProfile
+import json
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+_active = threading.Lock()
+_UNSAFE = re.compile(r'[^A-Za-z0-9]+')
+
+
+def route_slug(route):
+    """'/api/users/<int:user_id>/actions' -> 'api_users_int_user_id_actions'"""
+    return _UNSAFE.sub('_', route or 'unmatched').strip('_') or 'root'
+
+
+class StackSampler(threading.Thread):
+    """Counts the stacks one thread is seen in, sampled every `interval` seconds"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{Path(code.co_filename).name}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        """Return the samples as collapsed-stack text"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class RequestProfile:
+    """Profiles the calling thread between start() and stop()"""
+
+    def __init__(self, sample_interval=0.005):
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), sample_interval)
+        self.started = None
+        self.duration_ms = None
+
+    @classmethod
+    def start(cls, sample_interval=0.005):
+        """Start profiling this thread, or return None if another request is already being profiled"""
+        if not _active.acquire(blocking=False):
+            return None
+        profile = cls(sample_interval)
+        try:
+            profile.sampler.start()
+            profile.started = time.perf_counter()
+            profile.profiler.enable()
+        except ValueError:  # Another profiler (a debugger, say) already owns the process
+            profile.sampler.stop()
+            _active.release()
+            return None
+        return profile
+
+    def stop(self):
+        try:
+            self.profiler.disable()
+            self.duration_ms = round((time.perf_counter() - self.started) * 1000, 2)
+            self.sampler.stop()
+        finally:
+            _active.release()
+
+    def save(self, directory, route, keep, **meta):
+        """Write <slug>.<timestamp>.{pstats,collapsed,json} and prune the route to `keep` captures
+
+        Returns the capture's base name.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        slug = route_slug(route)
+        now = time.time()
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)) + f'{int(now * 1000) % 1000:03d}'
+        name = f'{slug}.{stamp}.{meta.get("request_id") or "-"}'
+        self.profiler.dump_stats(directory / f'{name}.pstats')
+        (directory / f'{name}.collapsed').write_text(self.sampler.collapsed())
+        # Written last: listing goes by the .json files, so a capture shows up complete
+        (directory / f'{name}.json').write_text(json.dumps(
+            dict(meta, name=name, route=route, duration_ms=self.duration_ms, samples=sum(self.sampler.stacks.values()),
+                 created_at=datetime.fromtimestamp(now, timezone.utc).isoformat(timespec='milliseconds'))))
+        prune_profiles(directory, slug, keep)
+        return name
+
+
+def list_profiles(directory):
+    """Return the metadata of every saved capture, newest first"""
+    captures = []
+    for path in Path(directory).glob('*.json'):
+        try:
+            captures.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue  # Pruned by another worker mid-listing, or half-written
+    return sorted(captures, key=lambda capture: capture.get('created_at', ''), reverse=True)
+
+
+def prune_profiles(directory, slug, keep):
+    """Delete all but the newest `keep` captures for one route"""
+    metas = sorted(Path(directory).glob(f'{slug}.*.json'), key=lambda path: path.name, reverse=True)
+    for meta in metas[keep:]:
+        name = meta.name[:-len('.json')]
+        for suffix in ('.json', '.pstats', '.collapsed'):
+            (meta.parent / f'{name}{suffix}').unlink(missing_ok=True)
@@ -0,0 +1,176 @@
+"""Opt-in per-statement SQL tracing for sqlite3 connections
+
+sqlite3's trace callback reports a statement's text but not how long it
+took, so tracing connections hand out cursors that time their own execute
+and fetch calls. A progress handler counts the virtual machine steps each
+statement costs, which separates "did a lot of work" from "waited on a
+lock". A statement whose time crosses the slow threshold has its EXPLAIN
+QUERY PLAN captured on the spot, while the connection is still open.
+"""
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+PROGRESS_STEPS = 1000  # VM instructions between progress handler calls
+
+_WHITESPACE = re.compile(r'\s+')
+_EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'replace', 'with')
+
+
+def normalize_sql(sql):
+    """Collapse whitespace so the same statement always reads (and groups) the same"""
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def explain_query_plan(conn, sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement, or [] if it has none"""
+    if not sql.lstrip().lower().startswith(_EXPLAINABLE):
+        return []
+    # A plain cursor, so explaining isn't itself traced
+    rows = sqlite3.Cursor(conn).execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    return [row[3] for row in rows]
+
+
+def tracing_connection_factory(on_query, on_slow, slow_ms):
+    """Return a sqlite3.Connection subclass (for sqlite3.connect's `factory`) that traces statements
+
+    `on_query(query)` is called when a statement is executed, with a dict of
+    sql, ms, rows and vm_steps that keeps being updated as its rows are
+    fetched. `on_slow(query)` is called once, when its time first reaches
+    `slow_ms`; by then query['plan'] holds the query plan.
+    """
+
+    class TracingCursor(sqlite3.Cursor):
+        query = None
+        _explain_params = None
+
+        def _run(self, method, sql, params, explain_params):
+            conn = self.connection
+            ticks, started = conn.vm_ticks, time.perf_counter()
+            result = method(sql, params)
+            self.query = {'sql': normalize_sql(sql), 'ms': 0.0, 'rows': 0, 'vm_steps': 0}
+            self._explain_params = explain_params
+            on_query(self.query)
+            self._account(ticks, started, max(self.rowcount, 0))
+            return result
+
+        def _account(self, ticks, started, rows):
+            query = self.query
+            query['ms'] = round(query['ms'] + (time.perf_counter() - started) * 1000, 3)
+            query['rows'] += rows
+            query['vm_steps'] += (self.connection.vm_ticks - ticks) * PROGRESS_STEPS
+            if query['ms'] >= slow_ms and 'plan' not in query:
+                try:
+                    query['plan'] = ([] if self._explain_params is None else
+                                     explain_query_plan(self.connection, query['sql'], self._explain_params))
+                except sqlite3.Error as e:
+                    query['plan'] = [f'unavailable: {e}']
+                on_slow(query)
+
+        def _fetch(self, fetch, *args):
+            if self.query is None:
+                return fetch(*args)
+            ticks, started = self.connection.vm_ticks, time.perf_counter()
+            rows = fetch(*args)
+            self._account(ticks, started, len(rows))
+            return rows
+
+        def execute(self, sql, params=()):
+            return self._run(super().execute, sql, params, params)
+
+        def executemany(self, sql, seq_of_params):
+            # The parameter sequence may be a one-shot iterator, so it isn't replayed for the plan
+            return self._run(super().executemany, sql, seq_of_params, None)
+
+        def fetchone(self):
+            if self.query is None:
+                return super().fetchone()
+            ticks, started = self.connection.vm_ticks, time.perf_counter()
+            row = super().fetchone()
+            self._account(ticks, started, 0 if row is None else 1)
+            return row
+
+        def fetchmany(self, size=None):
+            return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+        def fetchall(self):
+            return self._fetch(super().fetchall)
+
+        def __next__(self):
+            row = self.fetchone()
+            if row is None:
+                raise StopIteration
+            return row
+
+    class TracingConnection(sqlite3.Connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.vm_ticks = 0
+            self.set_progress_handler(self._tick, PROGRESS_STEPS)
+
+        def _tick(self):
+            self.vm_ticks += 1
+            return 0  # Non-zero would abort the statement
+
+        def cursor(self, factory=TracingCursor):
+            return super().cursor(factory)
+
+        # Connection.execute* build their cursors internally, bypassing cursor()
+        def execute(self, sql, params=()):
+            return self.cursor().execute(sql, params)
+
+        def executemany(self, sql, seq_of_params):
+            return self.cursor().executemany(sql, seq_of_params)
+
+    return TracingConnection
+
+
+class QueryStats:
+    """Per-route and per-statement query totals for one worker process
+
+    Statements are keyed by their normalized text; the least recently seen
+    ones are evicted past `max_statements` so ad-hoc SQL can't grow it
+    without bound.
+    """
+
+    def __init__(self, max_statements=500):
+        self.max_statements = max_statements
+        self._routes = {}
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, route, queries):
+        """Add one request's traced queries under its route"""
+        sql_ms = sum(query['ms'] for query in queries)
+        with self._lock:
+            totals = self._routes.setdefault(route, {'requests': 0, 'queries': 0, 'sql_ms': 0.0,
+                                                     'max_queries': 0, 'slow_queries': 0})
+            totals['requests'] += 1
+            totals['queries'] += len(queries)
+            totals['sql_ms'] += sql_ms
+            totals['max_queries'] = max(totals['max_queries'], len(queries))
+            for query in queries:
+                statement = self._statements.pop(query['sql'], None) or {
+                    'sql': query['sql'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'vm_steps': 0}
+                statement['count'] += 1
+                statement['total_ms'] += query['ms']
+                statement['max_ms'] = max(statement['max_ms'], query['ms'])
+                statement['rows'] += query['rows']
+                statement['vm_steps'] += query['vm_steps']
+                if 'plan' in query:
+                    totals['slow_queries'] += 1
+                    statement['plan'] = query['plan']
+                self._statements[query['sql']] = statement
+            while len(self._statements) > self.max_statements:
+                self._statements.popitem(last=False)
+
+    def snapshot(self, limit=20):
+        """Return {'routes': {route: totals}, 'statements': top `limit` statements by total time}"""
+        with self._lock:
+            routes = {route: dict(totals, sql_ms=round(totals['sql_ms'], 3))
+                      for route, totals in self._routes.items()}
+            statements = sorted(self._statements.values(), key=lambda s: -s['total_ms'])[:limit]
+            statements = [dict(s, total_ms=round(s['total_ms'], 3)) for s in statements]
+        return {'routes': routes, 'statements': statements}
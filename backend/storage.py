@@ -0,0 +1,2103 @@
+"""Data access for users, time actions and catalog overrides
+
+Route handlers in app.py only talk to a Repository. SQLiteRepository is the
+production engine; MemoryRepository keeps the same data in plain Python
+structures for fast test runs and benchmarks. Rows come back as sqlite3.Row
+or dict values with the table's column names, so callers index them the
+same way for either engine.
+
+Every mutation writes its change_log entries in the same transaction, which
+is what /api/sync reads.
+"""
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+
+class IdempotencyKeyTaken(Exception):
+    """Raised when an Idempotency-Key has already been claimed"""
+
+
+def override_columns(fields):
+    """Map an action's fields to edited_actions/custom_actions column values"""
+    return {
+        'text': fields['text'],
+        'minutes': fields['minutes'],
+        'similar_to': json.dumps(fields['similar_to']) if fields.get('similar_to') else None,
+        'is_repeatable_daily': 1 if fields.get('is_repeatable_daily', True) else 0,
+        'must_be_logged_at_end_of_day': 1 if fields.get('must_be_logged_at_end_of_day') else 0,
+        'warning': fields.get('warning') or None,
+    }
+
+
+def collapse_changes(since, changes, pruned_through=0):
+    """Reduce change log entries to (full, invalidated entities, {(entity, key): last op})
+
+    A client whose `since` is older than the pruned part of the log
+    (`pruned_through`) may have missed entries, so it gets a full sync.
+    """
+    full = since <= 0 or since < pruned_through or any(change['op'] == 'reset' for change in changes)
+    invalidated = sorted({change['entity'] for change in changes if change['op'] == 'invalidate'})
+    last_ops = {}
+    for change in changes:
+        if change['op'] in ('upsert', 'delete'):
+            last_ops[(change['entity'], change['entity_key'])] = change['op']
+    return full, invalidated, last_ops
+
+
+def compacted_local_days(local_days, summary_days):
+    """Return the local days that compaction may have taken raw rows from
+
+    Summaries are keyed by UTC day and no timezone puts a local day more
+    than a day off UTC, so a local day counts as compacted when the user has
+    a summary on that UTC day or either neighbour. Those days' daily_totals
+    rows can't be rebuilt from raw history and keep what they were closed with.
+    """
+    near = set()
+    for day in summary_days:
+        utc_day = date.fromisoformat(day)
+        near.update(str(utc_day + timedelta(days=offset)) for offset in (-1, 0, 1))
+    return {local_day for local_day in local_days if local_day in near}
+
+
+def keys_with_op(last_ops, entity, op):
+    return [key for (e, key), o in last_ops.items() if e == entity and o == op]
+
+
+SYNC_ENTITIES = ('time_action', 'deleted_action', 'edited_action', 'custom_action')
+
+# What action_stats should hold: raw history plus compacted summaries, per UTC day
+ACTION_STATS_SOURCE = '''
+    SELECT day, action, SUM(count) AS count, SUM(minutes_added) AS minutes_added
+    FROM (
+        SELECT date(created_at) AS day, action, COUNT(*) AS count, SUM(minutes_added) AS minutes_added
+        FROM time_actions
+        GROUP BY date(created_at), action
+        UNION ALL
+        SELECT day, action, count, minutes_added
+        FROM daily_action_summaries
+    )
+    GROUP BY day, action
+'''
+
+# What users.total_minutes should be (in a query over users): raw history plus compacted summaries
+EXPECTED_TOTAL_MINUTES = '''
+    COALESCE((SELECT SUM(minutes_added) FROM time_actions WHERE user_id = users.id), 0)
+    + COALESCE((SELECT SUM(minutes_added) FROM daily_action_summaries WHERE user_id = users.id), 0)
+'''
+
+
+ARCHIVE_TIME_ACTIONS = '''
+    CREATE TABLE IF NOT EXISTS {schema}time_actions (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        minutes_added INTEGER NOT NULL,
+        created_at TIMESTAMP
+    )
+'''
+
+
+class ReweightReport:
+    """Tallies what Repository.reweight_history changed (or would change)"""
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.changes = {}  # (action, old_minutes, new_minutes) -> rows, for time_actions
+        self.rows = 0
+        self.summary_rows = 0
+        self.minutes_delta = 0
+        self.user_ids = set()
+        self.recomputed_users = []
+
+    def add(self, table, tally):
+        """Add rows of (user_id, action, old_minutes, new_minutes, rows) for one chunk of `table`"""
+        for row in tally:
+            self.user_ids.add(row['user_id'])
+            self.minutes_delta += (row['new_minutes'] - (row['old_minutes'] or 0)) * row['rows']
+            if table == 'time_actions':
+                self.rows += row['rows']
+                key = (row['action'], row['old_minutes'], row['new_minutes'])
+                self.changes[key] = self.changes.get(key, 0) + row['rows']
+            else:
+                self.summary_rows += row['rows']
+
+    def result(self):
+        changes = [{'action': action, 'old_minutes': old, 'new_minutes': new, 'rows': rows}
+                   for (action, old, new), rows in self.changes.items()]
+        changes.sort(key=lambda change: (-change['rows'], change['action']))
+        return {'dry_run': self.dry_run, 'rows': self.rows, 'summary_rows': self.summary_rows,
+                'users': len(self.user_ids), 'minutes_delta': self.minutes_delta, 'changes': changes,
+                'recomputed_users': self.recomputed_users}
+
+
+def rebuild_action_stats(cursor):
+    """Recompute action_stats from the history tables; returns the number of rows"""
+    cursor.execute('DELETE FROM action_stats')
+    cursor.execute(f'''
+        INSERT INTO action_stats (day, action, count, minutes_added)
+        SELECT day, action, count, minutes_added FROM ({ACTION_STATS_SOURCE})
+    ''')
+    return cursor.rowcount
+
+
+def action_stats_drift(stored, expected):
+    """Compare {(day, action): (count, minutes)} maps; returns the rows that differ"""
+    drift = []
+    for day, action in sorted(set(stored) | set(expected)):
+        have = stored.get((day, action), (0, 0))
+        want = expected.get((day, action), (0, 0))
+        if have != want:
+            drift.append({'day': day, 'action': action,
+                          'count': have[0], 'expected_count': want[0],
+                          'minutes_added': have[1], 'expected_minutes_added': want[1]})
+    return drift
+
+
+class Repository(ABC):
+    """Storage interface used by the route handlers
+
+    Users are returned as dicts/rows with id, username, email, display_name,
+    profile_picture, timezone and total_minutes. Catalog override "fields" are dicts
+    with text, minutes, similar_to (list), is_repeatable_daily,
+    must_be_logged_at_end_of_day and warning.
+    """
+
+    # Users
+
+    @abstractmethod
+    def get_user(self, user_id):
+        """Return a user's profile and total_minutes, or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user_for_login(self, username):
+        """Return a user's profile plus password_hash, or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_username_or_email_taken(self, username, email):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_user(self, username, email, password_hash, display_name, profile_picture=None,
+                    timezone=None):
+        """Insert a user with a zero total and return its id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user(self, user_id, email, display_name, password_hash, profile_picture):
+        """Update profile fields; a password_hash of None keeps the current one"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_user_timezone(self, user_id, timezone, restamp=None):
+        """Store a user's IANA timezone
+
+        With restamp, every history row's local_day is recomputed as
+        restamp(created_at); otherwise existing rows keep the day they were
+        logged on.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_users(self):
+        """Return all users (with created_at), newest first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def user_exists(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def referenced_profile_pictures(self):
+        """Return the set of profile picture filenames in use"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def reset_user(self, user_id):
+        """Clear a user's history, catalog overrides and idempotency keys and zero their total"""
+        raise NotImplementedError
+
+    # Time actions
+
+    @abstractmethod
+    def add_time_action(self, user_id, action, minutes, idempotency_key=None, render=None,
+                        local_day=None):
+        """Record an action, add its minutes and return the new total
+
+        local_day is the user's 'YYYY-MM-DD' date when it was logged (the UTC
+        date if omitted). With an idempotency_key the key is claimed in the same transaction
+        (IdempotencyKeyTaken if it already was) and render(total) is stored
+        as the key's (status, body) response.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_idempotent_response(self, user_id, key):
+        """Return the stored (status, body) for an unexpired key, or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_time_actions(self, user_id):
+        """Return a user's raw history rows, newest first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_time_actions_for_day(self, user_id, local_day):
+        """Return a user's history rows logged on a local 'YYYY-MM-DD' day, newest first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_daily_summaries(self, user_id):
+        """Return a user's compacted daily summaries, newest day first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_time_actions(self, user_id, action_ids):
+        """Delete history rows, subtract their minutes and return the minutes subtracted"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_history(self, user_id, start=None, end=None, batch_size=500):
+        """Yield batches of history rows (id, action, minutes_added, created_at, count), oldest first
+
+        Compacted summaries come first with an id of None. start and end are
+        inclusive 'YYYY-MM-DD HH:MM:SS' UTC bounds.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert_time_actions(self, user_id, rows):
+        """Insert (action, minutes, created_at, local_day) rows in one transaction without touching the total"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def recompute_total_minutes(self, user_id):
+        """Recompute total_minutes from history after bulk changes and return it"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def reweight_history(self, default_minutes, user_id=None, dry_run=False, chunk_size=5000, on_chunk=None):
+        """Re-price logged history at the actions' current minutes
+
+        Each row of time_actions (and each compacted summary, per count) gets
+        the minutes its action is worth now: the user's edit or custom action
+        of that text, the edit of a renamed default it was logged under, or
+        `default_minutes` (text -> minutes). Actions the user deleted, or that
+        no longer exist, keep what they were logged at. Rows are rewritten in
+        id chunks, one short transaction each (action stats move with them),
+        then affected users' totals and closed days are recomputed in one
+        pass, again in short batches; rerunning after an interruption
+        resumes where it stopped. on_chunk(table, last_id,
+        max_id) is called after each chunk. Returns the rows changed (or, with
+        dry_run, that would change), grouped by action and old/new minutes.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def reconcile_totals(self, after_user_id=0, limit=100, repair=False):
+        """Compare total_minutes with history for the next `limit` users by id
+
+        Returns {'checked', 'last_user_id', 'drift'}: drift lists user_id,
+        total_minutes and expected_total_minutes for the users that disagree,
+        and last_user_id is where the next batch starts (None once every user
+        has been checked). With repair, drifted totals are corrected in the
+        same short transaction.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_timezones(self):
+        """Return the set of timezones stored on user profiles"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def close_day(self, local_day, timezones, include_unzoned=False):
+        """Roll up local_day for every user in `timezones` into daily_totals
+
+        One set-based pass for the whole zone group; include_unzoned also
+        covers users without a stored zone. Returns the number of users with
+        activity that day.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def close_user_days(self, user_id, local_days):
+        """Recompute a user's daily_totals for these days after history changed under them
+
+        Days that compaction has reached (see compacted_local_days) are left
+        as they were closed.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_daily_totals(self, user_id, before_day=None, limit=None):
+        """Return a user's closed days (local_day, actions, minutes_added, closed_at), newest first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_changes(self, user_id, since):
+        """Return what changed for a user after change sequence `since`
+
+        The result has the new 'seq', 'full' (client should replace its
+        state, also when `since` predates the retained log), 'invalidated'
+        entities, 'profile_changed', and per sync entity the 'upserted' rows
+        and 'deleted' keys.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def prune_change_log(self):
+        """Delete change log entries older than the retention period and return how many
+
+        Also runs every CHANGE_LOG_PRUNE_EVERY logged changes. A no-op without
+        a change_log_retention.
+        """
+        raise NotImplementedError
+
+    # Catalog overrides
+
+    @abstractmethod
+    def get_catalog_overlay(self, user_id):
+        """Return (deleted default texts, edited_actions rows, custom_actions rows oldest first)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_override_minutes(self, user_id, text):
+        """Return the minutes of an edited or custom action with this text, or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_default_action(self, user_id, text):
+        """Hide a default action, dropping any edit of it"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def edit_default_action(self, user_id, original_text, fields):
+        """Override a default action, un-hiding it if it was deleted"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def restore_default_action(self, user_id, text):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_custom_action(self, user_id, fields):
+        """Add a custom action; False if the user already has one with this text"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_custom_action(self, user_id, original_text, fields):
+        """Update a custom action; False if it doesn't exist"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_custom_action(self, user_id, text):
+        raise NotImplementedError
+
+    # Action popularity
+
+    @abstractmethod
+    def get_action_stats(self, day=None, limit=None):
+        """Return (action, count, minutes_added) rows, most logged first
+
+        Counts cover one UTC 'YYYY-MM-DD' day, or all time when day is None.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rebuild_action_stats(self):
+        """Recompute the counters from history and return the number of rows"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def check_action_stats(self):
+        """Return the (day, action) counters that disagree with history"""
+        raise NotImplementedError
+
+    # Maintenance
+
+    @abstractmethod
+    def compact_history(self, cutoff, archive_path=None):
+        """Fold history rows created before `cutoff` into daily_action_summaries
+
+        cutoff is a 'YYYY-MM-DD 00:00:00' UTC bound, so a day is never split
+        between raw rows and its summary. Rows are summed per user, UTC day
+        and action, optionally copied verbatim into the SQLite file at
+        archive_path, and deleted, one user per transaction. Totals and
+        action stats don't change. Returns {'users', 'rows_compacted'}.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def reclaim_space(self):
+        """Hand free pages back to the filesystem after bulk deletes (a no-op where nothing is on disk)"""
+        raise NotImplementedError
+
+    # Health
+
+    @abstractmethod
+    def ping(self):
+        """Make a cheap round trip to the store; raises if it can't be reached"""
+        raise NotImplementedError
+
+
+class SQLiteRepository(Repository):
+    """Repository over the app's SQLite database
+
+    `connect` returns a new read-write connection with sqlite3.Row rows and
+    foreign keys enabled (app.get_db). Read-only methods use
+    `connect_readonly` instead (app.get_db_readonly), so under WAL they
+    never take the write lock or wait on writers.
+    """
+
+    USER_RESET_TABLES = ['time_actions', 'daily_action_summaries', 'daily_totals', 'custom_actions',
+                         'deleted_actions', 'edited_actions', 'idempotency_keys']
+    IDEMPOTENCY_PURGE_EVERY = 500  # Keyed writes between sweeps of expired keys
+    CHANGE_LOG_PRUNE_EVERY = 500  # Logged changes between prunes of expired entries
+    CHANGE_LOG_PRUNE_BATCH = 5000  # Most entries one prune looks at, so the write it rides on stays short
+    REWEIGHT_USER_BATCH = 200  # Users whose totals are recomputed per transaction after a reweight
+
+    def __init__(self, connect, idempotency_ttl, connect_readonly=None, change_log_retention=None):
+        self.connect = connect
+        self.connect_readonly = connect_readonly or connect
+        self.idempotency_ttl = idempotency_ttl
+        self.change_log_retention = change_log_retention  # Seconds; None keeps every entry
+        self._keyed_writes = 0
+        self._logged_changes = 0
+
+    def _log_change(self, cursor, user_id, entity, key, op):
+        cursor.execute('''
+            INSERT INTO change_log (user_id, entity, entity_key, op)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, entity, None if key is None else str(key), op))
+        self._logged_changes += 1
+        if self._logged_changes % self.CHANGE_LOG_PRUNE_EVERY == 0:
+            self._prune_change_log(cursor)
+
+    def _prune_change_log(self, cursor):
+        if not self.change_log_retention:
+            return 0
+        # Entries are written in seq order, so the expired ones are a prefix of the log:
+        # only a bounded window at its head is ever examined
+        cursor.execute('''
+            DELETE FROM change_log
+            WHERE seq <= (SELECT MIN(seq) FROM change_log) + ?
+              AND created_at < datetime('now', ?)
+        ''', (self.CHANGE_LOG_PRUNE_BATCH, f'-{self.change_log_retention} seconds'))
+        return cursor.rowcount
+
+    def _fetch_by_keys(self, cursor, query, user_id, keys, chunk_size=500):
+        """Run `query` (with a {placeholders} slot) for keys in chunks under SQLite's variable limit"""
+        rows = []
+        keys = list(keys)
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            cursor.execute(query.format(placeholders=','.join(['?'] * len(chunk))), [user_id, *chunk])
+            rows.extend(cursor.fetchall())
+        return rows
+
+    def _bump_action_stats(self, cursor, deltas):
+        """Add (day, action, count, minutes) deltas to action_stats, dropping emptied rows"""
+        cursor.executemany('''
+            INSERT INTO action_stats (day, action, count, minutes_added)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(day, action) DO UPDATE SET
+                count = count + excluded.count,
+                minutes_added = minutes_added + excluded.minutes_added
+        ''', deltas)
+        if any(delta[2] < 0 for delta in deltas):
+            cursor.execute('DELETE FROM action_stats WHERE count <= 0')
+
+    def _rollup_user_days(self, cursor, user_id, local_days):
+        """Replace a user's daily_totals rows for these days with fresh aggregates, skipping compacted days"""
+        summary_days = [row['day'] for row in cursor.execute(
+            'SELECT DISTINCT day FROM daily_action_summaries WHERE user_id = ?', (user_id,))]
+        local_days = sorted(set(local_days) - compacted_local_days(local_days, summary_days))
+        for i in range(0, len(local_days), 500):
+            chunk = local_days[i:i + 500]
+            placeholders = ','.join(['?'] * len(chunk))
+            cursor.execute(f'''
+                DELETE FROM daily_totals WHERE user_id = ? AND local_day IN ({placeholders})
+            ''', [user_id, *chunk])
+            cursor.execute(f'''
+                INSERT INTO daily_totals (user_id, local_day, actions, minutes_added)
+                SELECT user_id, local_day, COUNT(*), SUM(minutes_added)
+                FROM time_actions
+                WHERE user_id = ? AND local_day IN ({placeholders})
+                GROUP BY local_day
+            ''', [user_id, *chunk])
+
+    # Users
+
+    def get_user(self, user_id):
+        conn = self.connect_readonly()
+        try:
+            user = conn.execute('''
+                SELECT id, username, email, display_name, profile_picture, timezone, total_minutes
+                FROM users WHERE id = ?
+            ''', (user_id,)).fetchone()
+            return dict(user) if user else None
+        finally:
+            conn.close()
+
+    def get_user_for_login(self, username):
+        conn = self.connect_readonly()
+        try:
+            return conn.execute('''
+                SELECT id, username, email, display_name, profile_picture, timezone, password_hash
+                FROM users WHERE username = ?
+            ''', (username,)).fetchone()
+        finally:
+            conn.close()
+
+    def is_username_or_email_taken(self, username, email):
+        conn = self.connect_readonly()
+        try:
+            return conn.execute('SELECT id FROM users WHERE username = ? OR email = ?',
+                                (username, email)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def create_user(self, username, email, password_hash, display_name, profile_picture=None,
+                    timezone=None):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO users (username, email, password_hash, display_name, profile_picture,
+                                   timezone, total_minutes)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+            ''', (username, email, password_hash, display_name, profile_picture, timezone))
+            conn.commit()
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def update_user(self, user_id, email, display_name, password_hash, profile_picture):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE users
+                SET email = ?, display_name = ?, password_hash = COALESCE(?, password_hash),
+                    profile_picture = ?
+                WHERE id = ?
+            ''', (email, display_name, password_hash, profile_picture, user_id))
+            self._log_change(cursor, user_id, 'profile', None, 'upsert')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def set_user_timezone(self, user_id, timezone, restamp=None):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE users SET timezone = ? WHERE id = ?', (timezone, user_id))
+            if restamp is not None:
+                cursor.execute('SELECT id, created_at, local_day FROM time_actions WHERE user_id = ?', (user_id,))
+                rows = cursor.fetchall()
+                restamped = [(restamp(row['created_at']), row['id']) for row in rows]
+                cursor.executemany('UPDATE time_actions SET local_day = ? WHERE id = ?', restamped)
+                # Closed days on both sides of the move are recomputed
+                self._rollup_user_days(cursor, user_id, [row['local_day'] for row in rows] +
+                                       [day for day, _ in restamped])
+                self._log_change(cursor, user_id, 'time_action', None, 'invalidate')
+            self._log_change(cursor, user_id, 'profile', None, 'upsert')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def list_users(self):
+        conn = self.connect_readonly()
+        try:
+            return conn.execute('''
+                SELECT id, username, email, display_name, profile_picture,
+                       total_minutes, created_at
+                FROM users
+                ORDER BY created_at DESC
+            ''').fetchall()
+        finally:
+            conn.close()
+
+    def user_exists(self, user_id):
+        conn = self.connect_readonly()
+        try:
+            return conn.execute('SELECT id FROM users WHERE id = ?', (user_id,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def referenced_profile_pictures(self):
+        conn = self.connect_readonly()
+        try:
+            return {row['profile_picture'] for row in conn.execute(
+                'SELECT DISTINCT profile_picture FROM users WHERE profile_picture IS NOT NULL')}
+        finally:
+            conn.close()
+
+    def reset_user(self, user_id):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            # Take the write lock up front so the reset can't fail halfway on a busy database
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT date(created_at) AS day, action, COUNT(*) AS count, SUM(minutes_added) AS minutes_added
+                FROM time_actions WHERE user_id = ?
+                GROUP BY date(created_at), action
+                UNION ALL
+                SELECT day, action, count, minutes_added
+                FROM daily_action_summaries WHERE user_id = ?
+            ''', (user_id, user_id))
+            self._bump_action_stats(cursor, [(row['day'], row['action'], -row['count'], -row['minutes_added'])
+                                             for row in cursor.fetchall()])
+            for table in self.USER_RESET_TABLES:
+                cursor.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+            cursor.execute('UPDATE users SET total_minutes = 0 WHERE id = ?', (user_id,))
+            # Sync clients drop everything they have for this user
+            cursor.execute('DELETE FROM change_log WHERE user_id = ?', (user_id,))
+            self._log_change(cursor, user_id, 'user', None, 'reset')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    # Time actions
+
+    def _claim_idempotency_key(self, cursor, user_id, key):
+        ttl = f'-{self.idempotency_ttl} seconds'
+        # An expired key may be reused
+        cursor.execute('''
+            DELETE FROM idempotency_keys
+            WHERE user_id = ? AND key = ? AND created_at < datetime('now', ?)
+        ''', (user_id, key, ttl))
+        try:
+            cursor.execute('INSERT INTO idempotency_keys (user_id, key) VALUES (?, ?)', (user_id, key))
+        except sqlite3.IntegrityError:
+            return False
+
+        self._keyed_writes += 1
+        if self._keyed_writes % self.IDEMPOTENCY_PURGE_EVERY == 0:
+            cursor.execute('''
+                DELETE FROM idempotency_keys WHERE created_at < datetime('now', ?)
+            ''', (ttl,))
+        return True
+
+    def add_time_action(self, user_id, action, minutes, idempotency_key=None, render=None,
+                        local_day=None):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            if idempotency_key is not None:
+                # Claim the key in the same transaction as the write. A concurrent
+                # request with the same key waits on the write lock, then finds it taken.
+                cursor.execute('BEGIN IMMEDIATE')
+                if not self._claim_idempotency_key(cursor, user_id, idempotency_key):
+                    conn.rollback()
+                    raise IdempotencyKeyTaken(idempotency_key)
+
+            cursor.execute('''
+                UPDATE users
+                SET total_minutes = total_minutes + ?
+                WHERE id = ?
+            ''', (minutes, user_id))
+            cursor.execute('''
+                INSERT INTO time_actions (user_id, action, minutes_added, local_day)
+                VALUES (?, ?, ?, COALESCE(?, date('now')))
+            ''', (user_id, action, minutes, local_day))
+            action_id = cursor.lastrowid
+            self._log_change(cursor, user_id, 'time_action', action_id, 'upsert')
+            # Count it under the same UTC day as the row's own timestamp
+            cursor.execute('''
+                INSERT INTO action_stats (day, action, count, minutes_added)
+                SELECT date(created_at), action, 1, minutes_added
+                FROM time_actions WHERE id = ?
+                ON CONFLICT(day, action) DO UPDATE SET
+                    count = count + 1,
+                    minutes_added = minutes_added + excluded.minutes_added
+            ''', (action_id,))
+
+            cursor.execute('SELECT total_minutes FROM users WHERE id = ?', (user_id,))
+            total_minutes = cursor.fetchone()['total_minutes']
+
+            if idempotency_key is not None:
+                status, body = render(total_minutes)
+                cursor.execute('''
+                    UPDATE idempotency_keys
+                    SET response_status = ?, response_body = ?
+                    WHERE user_id = ? AND key = ?
+                ''', (status, body, user_id, idempotency_key))
+
+            conn.commit()
+            return total_minutes
+        finally:
+            conn.close()
+
+    def get_idempotent_response(self, user_id, key):
+        conn = self.connect_readonly()
+        try:
+            row = conn.execute('''
+                SELECT response_status, response_body
+                FROM idempotency_keys
+                WHERE user_id = ? AND key = ? AND created_at >= datetime('now', ?)
+                  AND response_body IS NOT NULL
+            ''', (user_id, key, f'-{self.idempotency_ttl} seconds')).fetchone()
+            return (row['response_status'], row['response_body']) if row else None
+        finally:
+            conn.close()
+
+    def list_time_actions(self, user_id):
+        conn = self.connect_readonly()
+        try:
+            return conn.execute('''
+                SELECT id, action, minutes_added, created_at
+                FROM time_actions
+                WHERE user_id = ?
+                ORDER BY created_at DESC
+            ''', (user_id,)).fetchall()
+        finally:
+            conn.close()
+
+    def list_time_actions_for_day(self, user_id, local_day):
+        conn = self.connect_readonly()
+        try:
+            return conn.execute('''
+                SELECT id, action, minutes_added, created_at
+                FROM time_actions
+                WHERE user_id = ? AND local_day = ?
+                ORDER BY created_at DESC
+            ''', (user_id, local_day)).fetchall()
+        finally:
+            conn.close()
+
+    def list_daily_summaries(self, user_id):
+        conn = self.connect_readonly()
+        try:
+            return conn.execute('''
+                SELECT id, day, action, count, minutes_added
+                FROM daily_action_summaries
+                WHERE user_id = ?
+                ORDER BY day DESC, action ASC
+            ''', (user_id,)).fetchall()
+        finally:
+            conn.close()
+
+    def delete_time_actions(self, user_id, action_ids):
+        action_ids = list(action_ids)
+        if not action_ids:
+            return 0
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            minutes = 0
+            for i in range(0, len(action_ids), 500):
+                chunk = action_ids[i:i + 500]
+                placeholders = ','.join(['?'] * len(chunk))
+                cursor.execute(f'''
+                    SELECT date(created_at) AS day, action, COUNT(*) AS count, SUM(minutes_added) AS minutes_added
+                    FROM time_actions
+                    WHERE user_id = ? AND id IN ({placeholders})
+                    GROUP BY date(created_at), action
+                ''', [user_id, *chunk])
+                removed = cursor.fetchall()
+                minutes += sum(row['minutes_added'] for row in removed)
+                self._bump_action_stats(cursor, [(row['day'], row['action'], -row['count'], -row['minutes_added'])
+                                                 for row in removed])
+                cursor.execute(f'''
+                    DELETE FROM time_actions
+                    WHERE user_id = ? AND id IN ({placeholders})
+                ''', [user_id, *chunk])
+            cursor.executemany('''
+                INSERT INTO change_log (user_id, entity, entity_key, op)
+                VALUES (?, 'time_action', ?, 'delete')
+            ''', [(user_id, str(action_id)) for action_id in action_ids])
+
+            if minutes > 0:
+                cursor.execute('''
+                    UPDATE users
+                    SET total_minutes = MAX(0, total_minutes - ?)
+                    WHERE id = ?
+                ''', (minutes, user_id))
+            conn.commit()
+            return minutes
+        finally:
+            conn.close()
+
+    def iter_history(self, user_id, start=None, end=None, batch_size=500):
+        summary_query = '''
+            SELECT NULL AS id, action, minutes_added, day || ' 00:00:00' AS created_at, count
+            FROM daily_action_summaries
+            WHERE user_id = ?
+        '''
+        query = '''
+            SELECT id, action, minutes_added, created_at, 1 AS count
+            FROM time_actions
+            WHERE user_id = ?
+        '''
+        summary_params = [user_id]
+        params = [user_id]
+        if start:
+            summary_query += ' AND day >= ?'
+            summary_params.append(start[:10])
+            query += ' AND created_at >= ?'
+            params.append(start)
+        if end:
+            summary_query += ' AND day <= ?'
+            summary_params.append(end[:10])
+            query += ' AND created_at <= ?'
+            params.append(end)
+        summary_query += ' ORDER BY day ASC, action ASC'
+        query += ' ORDER BY created_at ASC, id ASC'
+
+        conn = self.connect_readonly()
+        try:
+            for sql, sql_params in ((summary_query, summary_params), (query, params)):
+                cursor = conn.cursor()
+                cursor.execute(sql, sql_params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+        finally:
+            conn.close()
+
+    def insert_time_actions(self, user_id, rows):
+        rows = list(rows)
+        deltas = {}
+        for action, minutes, created_at, _ in rows:
+            count, total = deltas.get((created_at[:10], action), (0, 0))
+            deltas[(created_at[:10], action)] = (count + 1, total + minutes)
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO time_actions (user_id, action, minutes_added, created_at, local_day)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(user_id, action, minutes, created_at, local_day)
+                  for action, minutes, created_at, local_day in rows])
+            self._bump_action_stats(cursor, [(day, action, count, total)
+                                             for (day, action), (count, total) in deltas.items()])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def recompute_total_minutes(self, user_id):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            self._log_change(cursor, user_id, 'time_action', None, 'invalidate')
+            cursor.execute(f'UPDATE users SET total_minutes = {EXPECTED_TOTAL_MINUTES} WHERE id = ?', (user_id,))
+            cursor.execute('SELECT total_minutes FROM users WHERE id = ?', (user_id,))
+            row = cursor.fetchone()
+            conn.commit()
+            return row['total_minutes'] if row else 0
+        finally:
+            conn.close()
+
+    def _reweighted_rows(self, table, user_id):
+        """SELECT of one id range of time_actions/daily_action_summaries with each row's new minutes"""
+        count, day = ('1', 'date(r.created_at)') if table == 'time_actions' else ('r.count', 'r.day')
+        return f'''
+            SELECT r.id, r.user_id, r.action, {day} AS day, r.minutes_added AS old_minutes,
+                   {count} * CASE WHEN o.user_id IS NOT NULL THEN o.minutes ELSE d.minutes END AS new_minutes
+            FROM {table} r
+            LEFT JOIN temp.reweight_overrides o ON o.user_id = r.user_id AND o.action = r.action
+            LEFT JOIN temp.reweight_defaults d ON d.action = r.action
+            WHERE r.id > ? AND r.id <= ?{'' if user_id is None else ' AND r.user_id = ?'}
+        '''
+
+    def reweight_history(self, default_minutes, user_id=None, dry_run=False, chunk_size=5000, on_chunk=None):
+        report = ReweightReport(dry_run)
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('CREATE TEMP TABLE reweight_defaults (action TEXT PRIMARY KEY, minutes INTEGER NOT NULL)')
+            cursor.execute('''
+                CREATE TEMP TABLE reweight_overrides (
+                    user_id INTEGER NOT NULL,
+                    action TEXT NOT NULL,
+                    minutes INTEGER,
+                    PRIMARY KEY (user_id, action)
+                )
+            ''')
+            cursor.executemany('INSERT INTO temp.reweight_defaults (action, minutes) VALUES (?, ?)',
+                               list(default_minutes.items()))
+            # Lowest precedence first, so later sources replace earlier ones.
+            # NULL minutes (a deleted default) leave the rows alone.
+            for source in ('SELECT user_id, action_text, NULL FROM deleted_actions',
+                           'SELECT user_id, original_text, minutes FROM edited_actions',
+                           'SELECT user_id, text, minutes FROM custom_actions',
+                           'SELECT user_id, text, minutes FROM edited_actions'):
+                cursor.execute(f'INSERT OR REPLACE INTO temp.reweight_overrides (user_id, action, minutes) {source}')
+            conn.commit()
+
+            for table in ('time_actions', 'daily_action_summaries'):
+                rows = self._reweighted_rows(table, user_id)
+                changed = 'new_minutes IS NOT NULL AND old_minutes IS NOT new_minutes'
+                max_id = cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                for low in range(0, max_id, chunk_size):
+                    params = [low, low + chunk_size] + ([] if user_id is None else [user_id])
+                    cursor.execute('BEGIN' if dry_run else 'BEGIN IMMEDIATE')
+                    cursor.execute(f'''
+                        SELECT user_id, action, day, old_minutes, new_minutes, COUNT(*) AS rows
+                        FROM ({rows})
+                        WHERE {changed}
+                        GROUP BY user_id, action, day, old_minutes, new_minutes
+                    ''', params)
+                    tally = cursor.fetchall()
+                    report.add(table, tally)
+                    if tally and not dry_run:
+                        cursor.executemany('INSERT OR IGNORE INTO reweight_pending_users (user_id) VALUES (?)',
+                                           {(row['user_id'],) for row in tally})
+                        # Popularity counters move with the rows; totals are recomputed at the end
+                        stats = {}
+                        for row in tally:
+                            delta = (row['new_minutes'] - (row['old_minutes'] or 0)) * row['rows']
+                            stats[(row['day'], row['action'])] = stats.get((row['day'], row['action']), 0) + delta
+                        self._bump_action_stats(cursor, [(day, action, 0, minutes)
+                                                         for (day, action), minutes in stats.items()])
+                        cursor.execute(f'''
+                            UPDATE {table}
+                            SET minutes_added = w.new_minutes
+                            FROM ({rows}) AS w
+                            WHERE {table}.id = w.id AND w.new_minutes IS NOT NULL
+                              AND w.old_minutes IS NOT w.new_minutes
+                        ''', params)
+                    conn.commit()
+                    if on_chunk:
+                        on_chunk(table, min(low + chunk_size, max_id), max_id)
+
+            if not dry_run:
+                report.recomputed_users = self._finish_reweight(conn)
+            return report.result()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _finish_reweight(self, conn):
+        """Recompute totals and closed days for the pending users, a batch per transaction; returns their ids"""
+        cursor = conn.cursor()
+        user_ids = []
+        while True:
+            cursor.execute('BEGIN IMMEDIATE')
+            batch = [row['user_id'] for row in cursor.execute(
+                'SELECT user_id FROM reweight_pending_users ORDER BY user_id LIMIT ?', (self.REWEIGHT_USER_BATCH,))]
+            if not batch:
+                conn.commit()
+                return user_ids
+            placeholders = ','.join(['?'] * len(batch))
+            cursor.execute(f'UPDATE users SET total_minutes = {EXPECTED_TOTAL_MINUTES} WHERE id IN ({placeholders})',
+                           batch)
+            # Days compaction has reached keep the total they were closed with (see compacted_local_days)
+            cursor.execute(f'''
+                UPDATE daily_totals
+                SET minutes_added = days.minutes_added
+                FROM (
+                    SELECT t.user_id, t.local_day, SUM(t.minutes_added) AS minutes_added
+                    FROM daily_totals d
+                    JOIN time_actions t ON t.user_id = d.user_id AND t.local_day = d.local_day
+                    WHERE d.user_id IN ({placeholders})
+                      AND NOT EXISTS (
+                          SELECT 1 FROM daily_action_summaries s
+                          WHERE s.user_id = d.user_id
+                            AND s.day BETWEEN date(d.local_day, '-1 day') AND date(d.local_day, '+1 day')
+                      )
+                    GROUP BY t.user_id, t.local_day
+                ) AS days
+                WHERE daily_totals.user_id = days.user_id AND daily_totals.local_day = days.local_day
+            ''', batch)
+            for pending_user_id in batch:
+                self._log_change(cursor, pending_user_id, 'time_action', None, 'invalidate')
+            cursor.execute(f'DELETE FROM reweight_pending_users WHERE user_id IN ({placeholders})', batch)
+            conn.commit()
+            user_ids += batch
+
+    def reconcile_totals(self, after_user_id=0, limit=100, repair=False):
+        conn = self.connect() if repair else self.connect_readonly()
+        try:
+            cursor = conn.cursor()
+            # Repairs take the write lock up front, for one batch only
+            cursor.execute('BEGIN IMMEDIATE' if repair else 'BEGIN')
+            cursor.execute(f'''
+                SELECT id AS user_id, total_minutes, {EXPECTED_TOTAL_MINUTES} AS expected_total_minutes
+                FROM users
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (after_user_id, limit))
+            rows = cursor.fetchall()
+            drift = [dict(row) for row in rows if row['total_minutes'] != row['expected_total_minutes']]
+            if repair and drift:
+                cursor.executemany('UPDATE users SET total_minutes = ? WHERE id = ?',
+                                   [(row['expected_total_minutes'], row['user_id']) for row in drift])
+            conn.commit()
+            return {'checked': len(rows), 'last_user_id': rows[-1]['user_id'] if rows else None, 'drift': drift}
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def list_timezones(self):
+        conn = self.connect_readonly()
+        try:
+            return {row['timezone'] for row in conn.execute(
+                'SELECT DISTINCT timezone FROM users WHERE timezone IS NOT NULL')}
+        finally:
+            conn.close()
+
+    def close_day(self, local_day, timezones, include_unzoned=False):
+        timezones = list(timezones)
+        where = f"u.timezone IN ({','.join(['?'] * len(timezones))})" if timezones else '0'
+        if include_unzoned:
+            where += ' OR u.timezone IS NULL'
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            # Users are found through idx_users_timezone, then each one's day
+            # through idx_time_actions_user_local_day
+            cursor.execute(f'''
+                INSERT INTO daily_totals (user_id, local_day, actions, minutes_added)
+                SELECT t.user_id, t.local_day, COUNT(*), SUM(t.minutes_added)
+                FROM users u
+                JOIN time_actions t ON t.user_id = u.id AND t.local_day = ?
+                WHERE ({where})
+                GROUP BY t.user_id
+                ON CONFLICT(user_id, local_day) DO UPDATE SET
+                    actions = excluded.actions,
+                    minutes_added = excluded.minutes_added,
+                    closed_at = CURRENT_TIMESTAMP
+            ''', [local_day, *timezones])
+            closed = cursor.rowcount
+            conn.commit()
+            return closed
+        finally:
+            conn.close()
+
+    def close_user_days(self, user_id, local_days):
+        conn = self.connect()
+        try:
+            self._rollup_user_days(conn.cursor(), user_id, local_days)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def list_daily_totals(self, user_id, before_day=None, limit=None):
+        query = '''
+            SELECT local_day, actions, minutes_added, closed_at
+            FROM daily_totals
+            WHERE user_id = ?
+        '''
+        params = [user_id]
+        if before_day is not None:
+            query += ' AND local_day < ?'
+            params.append(before_day)
+        query += ' ORDER BY local_day DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        conn = self.connect_readonly()
+        try:
+            return conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+
+    def read_changes(self, user_id, since):
+        conn = self.connect_readonly()
+        try:
+            cursor = conn.cursor()
+            # One read transaction so the log and the rows are a consistent snapshot
+            cursor.execute('BEGIN')
+
+            # The AUTOINCREMENT counter, which survives the log being pruned empty
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'change_log'")
+            latest = cursor.fetchone()[0]
+            cursor.execute('SELECT MIN(seq) FROM change_log')
+            oldest = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT seq, entity, entity_key, op
+                FROM change_log
+                WHERE user_id = ? AND seq > ? AND seq <= ?
+                ORDER BY seq ASC
+            ''', (user_id, since, latest))
+            full, invalidated, last_ops = collapse_changes(
+                since, cursor.fetchall(), latest if oldest is None else oldest - 1)
+
+            upserted = {}
+            if full:
+                cursor.execute('''
+                    SELECT id, action, minutes_added, created_at
+                    FROM time_actions WHERE user_id = ? ORDER BY id ASC
+                ''', (user_id,))
+                upserted['time_action'] = cursor.fetchall()
+                cursor.execute('SELECT action_text FROM deleted_actions WHERE user_id = ?', (user_id,))
+                upserted['deleted_action'] = cursor.fetchall()
+                cursor.execute('SELECT * FROM edited_actions WHERE user_id = ?', (user_id,))
+                upserted['edited_action'] = cursor.fetchall()
+                cursor.execute('SELECT * FROM custom_actions WHERE user_id = ? ORDER BY created_at ASC',
+                               (user_id,))
+                upserted['custom_action'] = cursor.fetchall()
+            else:
+                upserted['time_action'] = self._fetch_by_keys(cursor, '''
+                    SELECT id, action, minutes_added, created_at
+                    FROM time_actions WHERE user_id = ? AND id IN ({placeholders}) ORDER BY id ASC
+                ''', user_id, [int(key) for key in keys_with_op(last_ops, 'time_action', 'upsert')])
+                upserted['deleted_action'] = self._fetch_by_keys(cursor, '''
+                    SELECT action_text FROM deleted_actions
+                    WHERE user_id = ? AND action_text IN ({placeholders})
+                ''', user_id, keys_with_op(last_ops, 'deleted_action', 'upsert'))
+                upserted['edited_action'] = self._fetch_by_keys(cursor, '''
+                    SELECT * FROM edited_actions
+                    WHERE user_id = ? AND original_text IN ({placeholders})
+                ''', user_id, keys_with_op(last_ops, 'edited_action', 'upsert'))
+                upserted['custom_action'] = self._fetch_by_keys(cursor, '''
+                    SELECT * FROM custom_actions
+                    WHERE user_id = ? AND text IN ({placeholders}) ORDER BY created_at ASC
+                ''', user_id, keys_with_op(last_ops, 'custom_action', 'upsert'))
+
+            conn.commit()
+        finally:
+            conn.close()
+
+        return {
+            'seq': latest,
+            'full': full,
+            'invalidated': invalidated,
+            'profile_changed': full or ('profile', None) in last_ops,
+            'upserted': upserted,
+            'deleted': {entity: [] if full else keys_with_op(last_ops, entity, 'delete')
+                        for entity in SYNC_ENTITIES},
+        }
+
+    def prune_change_log(self):
+        conn = self.connect()
+        try:
+            pruned = 0
+            while True:
+                rows = self._prune_change_log(conn.cursor())
+                conn.commit()
+                pruned += rows
+                if not rows:
+                    return pruned
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    # Catalog overrides
+
+    def get_catalog_overlay(self, user_id):
+        conn = self.connect_readonly()
+        try:
+            deleted = {row['action_text'] for row in conn.execute('''
+                SELECT action_text
+                FROM deleted_actions
+                WHERE user_id = ?
+            ''', (user_id,))}
+            edited = conn.execute('''
+                SELECT original_text, text, minutes, similar_to, is_repeatable_daily,
+                       must_be_logged_at_end_of_day, warning
+                FROM edited_actions
+                WHERE user_id = ?
+            ''', (user_id,)).fetchall()
+            custom = conn.execute('''
+                SELECT text, minutes, similar_to, is_repeatable_daily,
+                       must_be_logged_at_end_of_day, warning
+                FROM custom_actions
+                WHERE user_id = ?
+                ORDER BY created_at ASC
+            ''', (user_id,)).fetchall()
+            return deleted, edited, custom
+        finally:
+            conn.close()
+
+    def get_override_minutes(self, user_id, text):
+        conn = self.connect_readonly()
+        try:
+            for table in ('edited_actions', 'custom_actions'):
+                row = conn.execute(f'''
+                    SELECT minutes
+                    FROM {table}
+                    WHERE user_id = ? AND text = ?
+                ''', (user_id, text)).fetchone()
+                if row:
+                    return row['minutes']
+            return None
+        finally:
+            conn.close()
+
+    def delete_default_action(self, user_id, text):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO deleted_actions (user_id, action_text)
+                VALUES (?, ?)
+            ''', (user_id, text))
+            self._log_change(cursor, user_id, 'deleted_action', text, 'upsert')
+
+            # If this action was edited, remove the edit
+            cursor.execute('''
+                DELETE FROM edited_actions
+                WHERE user_id = ? AND original_text = ?
+            ''', (user_id, text))
+            if cursor.rowcount:
+                self._log_change(cursor, user_id, 'edited_action', text, 'delete')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def edit_default_action(self, user_id, original_text, fields):
+        columns = override_columns(fields)
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM deleted_actions
+                WHERE user_id = ? AND action_text = ?
+            ''', (user_id, original_text))
+            if cursor.rowcount:
+                self._log_change(cursor, user_id, 'deleted_action', original_text, 'delete')
+
+            cursor.execute('''
+                INSERT OR REPLACE INTO edited_actions
+                (user_id, original_text, text, minutes, similar_to, is_repeatable_daily,
+                 must_be_logged_at_end_of_day, warning, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (
+                user_id,
+                original_text,
+                columns['text'],
+                columns['minutes'],
+                columns['similar_to'],
+                columns['is_repeatable_daily'],
+                columns['must_be_logged_at_end_of_day'],
+                columns['warning'],
+            ))
+            self._log_change(cursor, user_id, 'edited_action', original_text, 'upsert')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def restore_default_action(self, user_id, text):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM deleted_actions
+                WHERE user_id = ? AND action_text = ?
+            ''', (user_id, text))
+            if cursor.rowcount:
+                self._log_change(cursor, user_id, 'deleted_action', text, 'delete')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def create_custom_action(self, user_id, fields):
+        columns = override_columns(fields)
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id FROM custom_actions
+                WHERE user_id = ? AND text = ?
+            ''', (user_id, columns['text']))
+            if cursor.fetchone():
+                return False
+
+            cursor.execute('''
+                INSERT INTO custom_actions
+                (user_id, text, minutes, similar_to, is_repeatable_daily,
+                 must_be_logged_at_end_of_day, warning)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_id,
+                columns['text'],
+                columns['minutes'],
+                columns['similar_to'],
+                columns['is_repeatable_daily'],
+                columns['must_be_logged_at_end_of_day'],
+                columns['warning'],
+            ))
+            self._log_change(cursor, user_id, 'custom_action', columns['text'], 'upsert')
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+
+    def update_custom_action(self, user_id, original_text, fields):
+        columns = override_columns(fields)
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE custom_actions
+                SET text = ?, minutes = ?, similar_to = ?, is_repeatable_daily = ?,
+                    must_be_logged_at_end_of_day = ?, warning = ?
+                WHERE user_id = ? AND text = ?
+            ''', (
+                columns['text'],
+                columns['minutes'],
+                columns['similar_to'],
+                columns['is_repeatable_daily'],
+                columns['must_be_logged_at_end_of_day'],
+                columns['warning'],
+                user_id,
+                original_text,
+            ))
+            if not cursor.rowcount:
+                return False
+            if columns['text'] != original_text:
+                self._log_change(cursor, user_id, 'custom_action', original_text, 'delete')
+            self._log_change(cursor, user_id, 'custom_action', columns['text'], 'upsert')
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+
+    def delete_custom_action(self, user_id, text):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM custom_actions
+                WHERE user_id = ? AND text = ?
+            ''', (user_id, text))
+            if cursor.rowcount:
+                self._log_change(cursor, user_id, 'custom_action', text, 'delete')
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Action popularity
+
+    def get_action_stats(self, day=None, limit=None):
+        query = '''
+            SELECT action, SUM(count) AS count, SUM(minutes_added) AS minutes_added
+            FROM action_stats
+        '''
+        params = []
+        if day is not None:
+            query += ' WHERE day = ?'
+            params.append(day)
+        query += ' GROUP BY action ORDER BY count DESC, action ASC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        conn = self.connect_readonly()
+        try:
+            return conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+
+    def rebuild_action_stats(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            rows = rebuild_action_stats(cursor)
+            conn.commit()
+            return rows
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def check_action_stats(self):
+        conn = self.connect_readonly()
+        try:
+            # One read transaction so the counters and history are the same snapshot
+            conn.execute('BEGIN')
+            stored = {(row['day'], row['action']): (row['count'], row['minutes_added'])
+                      for row in conn.execute('SELECT day, action, count, minutes_added FROM action_stats')}
+            expected = {(row['day'], row['action']): (row['count'], row['minutes_added'])
+                        for row in conn.execute(ACTION_STATS_SOURCE)}
+            conn.rollback()
+            return action_stats_drift(stored, expected)
+        finally:
+            conn.close()
+
+    # Maintenance
+
+    def compact_history(self, cutoff, archive_path=None):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            if archive_path:
+                cursor.execute('ATTACH DATABASE ? AS archive', (str(archive_path),))
+                cursor.execute(ARCHIVE_TIME_ACTIONS.format(schema='archive.'))
+                conn.commit()
+
+            cursor.execute('SELECT DISTINCT user_id FROM time_actions WHERE created_at < ?', (cutoff,))
+            user_ids = [row['user_id'] for row in cursor.fetchall()]
+
+            rows_compacted = 0
+            for user_id in user_ids:
+                cursor.execute('''
+                    INSERT INTO daily_action_summaries (user_id, day, action, count, minutes_added)
+                    SELECT user_id, date(created_at), action, COUNT(*), SUM(minutes_added)
+                    FROM time_actions
+                    WHERE user_id = ? AND created_at < ?
+                    GROUP BY date(created_at), action
+                    ON CONFLICT(user_id, day, action) DO UPDATE SET
+                        count = count + excluded.count,
+                        minutes_added = minutes_added + excluded.minutes_added
+                ''', (user_id, cutoff))
+
+                if archive_path:
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO archive.time_actions
+                        (id, user_id, action, minutes_added, created_at)
+                        SELECT id, user_id, action, minutes_added, created_at
+                        FROM time_actions
+                        WHERE user_id = ? AND created_at < ?
+                    ''', (user_id, cutoff))
+
+                cursor.execute('DELETE FROM time_actions WHERE user_id = ? AND created_at < ?', (user_id, cutoff))
+                rows_compacted += cursor.rowcount
+                self._log_change(cursor, user_id, 'time_action', None, 'invalidate')
+                conn.commit()
+
+            if archive_path:
+                cursor.execute('DETACH DATABASE archive')
+            return {'users': len(user_ids), 'rows_compacted': rows_compacted}
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def reclaim_space(self):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] == 2:
+                # Incremental mode: release free pages without rewriting the file
+                cursor.execute('PRAGMA incremental_vacuum')
+                cursor.fetchall()
+            else:
+                # One full rewrite switches the file to incremental mode for next time
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM')
+        finally:
+            conn.close()
+
+    # Health
+
+    def ping(self):
+        conn = self.connect_readonly()
+        try:
+            # Reads the schema page, so a missing or unreadable file fails here
+            conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+        finally:
+            conn.close()
+
+
+class MemoryRepository(Repository):
+    """Repository kept entirely in process memory
+
+    Rows are dicts shaped like the SQLite tables. Nothing is persisted and
+    nothing is shared between processes, so it's meant for tests and
+    benchmarks (and as a building block for a read-through cache).
+    """
+
+    CHANGE_LOG_PRUNE_EVERY = 500  # Logged changes between prunes of expired entries
+
+    def __init__(self, idempotency_ttl, change_log_retention=None):
+        self.idempotency_ttl = idempotency_ttl
+        self.change_log_retention = change_log_retention  # Seconds; None keeps every entry
+        self._lock = threading.RLock()
+        self._users = {}  # id -> users row
+        self._time_actions = {}  # id -> time_actions row
+        self._summaries = {}  # user_id -> [daily_action_summaries rows]
+        self._deleted = {}  # user_id -> {action_text}
+        self._edited = {}  # user_id -> {original_text: edited_actions row}
+        self._custom = {}  # user_id -> OrderedDict(text -> custom_actions row), oldest first
+        self._idempotency = {}  # (user_id, key) -> {'created_at', 'response_status', 'response_body'}
+        self._change_log = []
+        self._action_stats = {}  # (day, action) -> [count, minutes_added]
+        self._daily_totals = {}  # (user_id, local_day) -> daily_totals row
+        self._next_id = {'users': 1, 'time_actions': 1, 'daily_action_summaries': 1}
+        self._next_seq = 1
+
+    @staticmethod
+    def _now():
+        return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+    def _new_id(self, table):
+        new_id = self._next_id[table]
+        self._next_id[table] += 1
+        return new_id
+
+    def _log_change(self, user_id, entity, key, op):
+        self._change_log.append({
+            'seq': self._next_seq,
+            'user_id': user_id,
+            'entity': entity,
+            'entity_key': None if key is None else str(key),
+            'op': op,
+            'created_at': time.time(),
+        })
+        self._next_seq += 1
+        if self._next_seq % self.CHANGE_LOG_PRUNE_EVERY == 0:
+            self.prune_change_log()
+
+    def _bump_action_stats(self, day, action, count, minutes):
+        stats = self._action_stats.setdefault((day, action), [0, 0])
+        stats[0] += count
+        stats[1] += minutes
+        if stats[0] <= 0:
+            del self._action_stats[(day, action)]
+
+    def _rollup_user_days(self, user_id, local_days):
+        local_days = set(local_days)
+        local_days -= compacted_local_days(local_days, [row['day'] for row in self._summaries.get(user_id, [])])
+        for key in [key for key in self._daily_totals if key[0] == user_id and key[1] in local_days]:
+            del self._daily_totals[key]
+        for row in self._time_actions.values():
+            if row['user_id'] == user_id and row['local_day'] in local_days:
+                totals = self._daily_totals.setdefault((user_id, row['local_day']), {
+                    'local_day': row['local_day'], 'actions': 0, 'minutes_added': 0, 'closed_at': self._now()})
+                totals['actions'] += 1
+                totals['minutes_added'] += row['minutes_added']
+
+    def _expected_action_stats(self):
+        expected = {}
+        rows = [(row['created_at'][:10], row['action'], 1, row['minutes_added'])
+                for row in self._time_actions.values()]
+        rows += [(row['day'], row['action'], row['count'], row['minutes_added'])
+                 for summaries in self._summaries.values() for row in summaries]
+        for day, action, count, minutes in rows:
+            have = expected.get((day, action), (0, 0))
+            expected[(day, action)] = (have[0] + count, have[1] + minutes)
+        return expected
+
+    # Users
+
+    def get_user(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            if not user:
+                return None
+            return {key: user[key] for key in
+                    ('id', 'username', 'email', 'display_name', 'profile_picture', 'timezone',
+                     'total_minutes')}
+
+    def get_user_for_login(self, username):
+        with self._lock:
+            for user in self._users.values():
+                if user['username'] == username:
+                    return {key: user[key] for key in
+                            ('id', 'username', 'email', 'display_name', 'profile_picture', 'timezone',
+                             'password_hash')}
+            return None
+
+    def is_username_or_email_taken(self, username, email):
+        with self._lock:
+            return any(user['username'] == username or user['email'] == email
+                       for user in self._users.values())
+
+    def create_user(self, username, email, password_hash, display_name, profile_picture=None,
+                    timezone=None):
+        with self._lock:
+            if self.is_username_or_email_taken(username, email):
+                raise ValueError('Username or email already exists')
+            user_id = self._new_id('users')
+            self._users[user_id] = {
+                'id': user_id,
+                'username': username,
+                'email': email,
+                'password_hash': password_hash,
+                'display_name': display_name,
+                'profile_picture': profile_picture,
+                'timezone': timezone,
+                'total_minutes': 0,
+                'created_at': self._now(),
+            }
+            return user_id
+
+    def update_user(self, user_id, email, display_name, password_hash, profile_picture):
+        with self._lock:
+            user = self._users.get(user_id)
+            if not user:
+                return
+            user.update(email=email, display_name=display_name, profile_picture=profile_picture)
+            if password_hash is not None:
+                user['password_hash'] = password_hash
+            self._log_change(user_id, 'profile', None, 'upsert')
+
+    def set_user_timezone(self, user_id, timezone, restamp=None):
+        with self._lock:
+            user = self._users.get(user_id)
+            if not user:
+                return
+            user['timezone'] = timezone
+            if restamp is not None:
+                affected = set()
+                for row in self._time_actions.values():
+                    if row['user_id'] == user_id:
+                        affected.add(row['local_day'])
+                        row['local_day'] = restamp(row['created_at'])
+                        affected.add(row['local_day'])
+                self._rollup_user_days(user_id, affected)
+                self._log_change(user_id, 'time_action', None, 'invalidate')
+            self._log_change(user_id, 'profile', None, 'upsert')
+
+    def list_users(self):
+        with self._lock:
+            users = sorted(self._users.values(), key=lambda user: (user['created_at'], user['id']),
+                           reverse=True)
+            return [{key: user[key] for key in ('id', 'username', 'email', 'display_name',
+                                                'profile_picture', 'total_minutes', 'created_at')}
+                    for user in users]
+
+    def user_exists(self, user_id):
+        with self._lock:
+            return user_id in self._users
+
+    def referenced_profile_pictures(self):
+        with self._lock:
+            return {user['profile_picture'] for user in self._users.values() if user['profile_picture']}
+
+    def reset_user(self, user_id):
+        with self._lock:
+            for row in self._time_actions.values():
+                if row['user_id'] == user_id:
+                    self._bump_action_stats(row['created_at'][:10], row['action'], -1, -row['minutes_added'])
+            for row in self._summaries.get(user_id, []):
+                self._bump_action_stats(row['day'], row['action'], -row['count'], -row['minutes_added'])
+            self._time_actions = {action_id: row for action_id, row in self._time_actions.items()
+                                  if row['user_id'] != user_id}
+            for overrides in (self._summaries, self._deleted, self._edited, self._custom):
+                overrides.pop(user_id, None)
+            self._daily_totals = {key: row for key, row in self._daily_totals.items() if key[0] != user_id}
+            self._idempotency = {key: claim for key, claim in self._idempotency.items() if key[0] != user_id}
+            if user_id in self._users:
+                self._users[user_id]['total_minutes'] = 0
+            self._change_log = [change for change in self._change_log if change['user_id'] != user_id]
+            self._log_change(user_id, 'user', None, 'reset')
+
+    # Time actions
+
+    def add_time_action(self, user_id, action, minutes, idempotency_key=None, render=None,
+                        local_day=None):
+        with self._lock:
+            if idempotency_key is not None:
+                claimed = self._idempotency.get((user_id, idempotency_key))
+                if claimed and claimed['created_at'] >= time.time() - self.idempotency_ttl:
+                    raise IdempotencyKeyTaken(idempotency_key)
+
+            user = self._users.get(user_id)
+            if user:
+                user['total_minutes'] += minutes
+            action_id = self._new_id('time_actions')
+            created_at = self._now()
+            self._time_actions[action_id] = {
+                'id': action_id,
+                'user_id': user_id,
+                'action': action,
+                'minutes_added': minutes,
+                'created_at': created_at,
+                'local_day': local_day or created_at[:10],
+            }
+            self._log_change(user_id, 'time_action', action_id, 'upsert')
+            self._bump_action_stats(created_at[:10], action, 1, minutes)
+            total_minutes = user['total_minutes'] if user else 0
+
+            if idempotency_key is not None:
+                status, body = render(total_minutes)
+                self._idempotency[(user_id, idempotency_key)] = {
+                    'created_at': time.time(),
+                    'response_status': status,
+                    'response_body': body,
+                }
+            return total_minutes
+
+    def get_idempotent_response(self, user_id, key):
+        with self._lock:
+            claimed = self._idempotency.get((user_id, key))
+            if not claimed or claimed['created_at'] < time.time() - self.idempotency_ttl:
+                return None
+            return claimed['response_status'], claimed['response_body']
+
+    def _user_time_actions(self, user_id):
+        return [dict(row) for row in self._time_actions.values() if row['user_id'] == user_id]
+
+    def list_time_actions(self, user_id):
+        with self._lock:
+            rows = self._user_time_actions(user_id)
+        rows.sort(key=lambda row: (row['created_at'], row['id']), reverse=True)
+        return [{key: row[key] for key in ('id', 'action', 'minutes_added', 'created_at')} for row in rows]
+
+    def list_time_actions_for_day(self, user_id, local_day):
+        with self._lock:
+            rows = [dict(row) for row in self._time_actions.values()
+                    if row['user_id'] == user_id and row['local_day'] == local_day]
+        rows.sort(key=lambda row: (row['created_at'], row['id']), reverse=True)
+        return [{key: row[key] for key in ('id', 'action', 'minutes_added', 'created_at')} for row in rows]
+
+    def list_daily_summaries(self, user_id):
+        with self._lock:
+            summaries = [{key: row[key] for key in ('id', 'day', 'action', 'count', 'minutes_added')}
+                         for row in self._summaries.get(user_id, [])]
+        summaries.sort(key=lambda row: row['action'])
+        summaries.sort(key=lambda row: row['day'], reverse=True)
+        return summaries
+
+    def delete_time_actions(self, user_id, action_ids):
+        with self._lock:
+            minutes = 0
+            for action_id in action_ids:
+                row = self._time_actions.get(action_id)
+                if row and row['user_id'] == user_id:
+                    minutes += row['minutes_added'] or 0
+                    self._bump_action_stats(row['created_at'][:10], row['action'], -1, -row['minutes_added'])
+                    del self._time_actions[action_id]
+                self._log_change(user_id, 'time_action', action_id, 'delete')
+            user = self._users.get(user_id)
+            if user and minutes > 0:
+                user['total_minutes'] = max(0, user['total_minutes'] - minutes)
+            return minutes
+
+    def iter_history(self, user_id, start=None, end=None, batch_size=500):
+        with self._lock:
+            summaries = [
+                {'id': None, 'action': row['action'], 'minutes_added': row['minutes_added'],
+                 'created_at': f"{row['day']} 00:00:00", 'count': row['count']}
+                for row in self._summaries.get(user_id, [])
+                if (not start or row['day'] >= start[:10]) and (not end or row['day'] <= end[:10])
+            ]
+            actions = [
+                {'id': row['id'], 'action': row['action'], 'minutes_added': row['minutes_added'],
+                 'created_at': row['created_at'], 'count': 1}
+                for row in self._time_actions.values()
+                if row['user_id'] == user_id
+                and (not start or row['created_at'] >= start) and (not end or row['created_at'] <= end)
+            ]
+        summaries.sort(key=lambda row: (row['created_at'], row['action']))
+        actions.sort(key=lambda row: (row['created_at'], row['id']))
+        for rows in (summaries, actions):
+            for i in range(0, len(rows), batch_size):
+                yield rows[i:i + batch_size]
+
+    def insert_time_actions(self, user_id, rows):
+        with self._lock:
+            for action, minutes, created_at, local_day in rows:
+                action_id = self._new_id('time_actions')
+                self._time_actions[action_id] = {
+                    'id': action_id,
+                    'user_id': user_id,
+                    'action': action,
+                    'minutes_added': minutes,
+                    'created_at': created_at,
+                    'local_day': local_day,
+                }
+                self._bump_action_stats(created_at[:10], action, 1, minutes)
+
+    def recompute_total_minutes(self, user_id):
+        with self._lock:
+            self._log_change(user_id, 'time_action', None, 'invalidate')
+            user = self._users.get(user_id)
+            if not user:
+                return 0
+            user['total_minutes'] = self._expected_total(user_id)
+            return user['total_minutes']
+
+    def _expected_total(self, user_id):
+        return (sum(row['minutes_added'] or 0 for row in self._time_actions.values() if row['user_id'] == user_id)
+                + sum(row['minutes_added'] for row in self._summaries.get(user_id, [])))
+
+    def reweight_history(self, default_minutes, user_id=None, dry_run=False, chunk_size=5000, on_chunk=None):
+        report = ReweightReport(dry_run)
+        with self._lock:
+            # Same precedence as the SQLite temp tables: later sources win
+            overrides = {}
+            for override_user_id, texts in self._deleted.items():
+                overrides.update(((override_user_id, text), None) for text in texts)
+            for override_user_id, edits in self._edited.items():
+                overrides.update(((override_user_id, original), row['minutes']) for original, row in edits.items())
+            for override_user_id, custom in self._custom.items():
+                overrides.update(((override_user_id, text), row['minutes']) for text, row in custom.items())
+            for override_user_id, edits in self._edited.items():
+                overrides.update(((override_user_id, row['text']), row['minutes']) for row in edits.values())
+
+            def tally(table, rows, count):
+                changes = {}
+                for row in rows:
+                    if user_id is not None and row['user_id'] != user_id:
+                        continue
+                    key = (row['user_id'], row['action'])
+                    minutes = overrides[key] if key in overrides else default_minutes.get(row['action'])
+                    new_minutes = None if minutes is None else count(row) * minutes
+                    if new_minutes is None or new_minutes == row['minutes_added']:
+                        continue
+                    change = (row['user_id'], row['action'], row['minutes_added'], new_minutes)
+                    changes[change] = changes.get(change, 0) + 1
+                    if not dry_run:
+                        row['minutes_added'] = new_minutes
+                report.add(table, [dict(zip(('user_id', 'action', 'old_minutes', 'new_minutes'), change), rows=n)
+                                   for change, n in changes.items()])
+                max_id = max((row['id'] for row in rows), default=0)
+                if on_chunk and max_id:
+                    on_chunk(table, max_id, max_id)
+
+            tally('time_actions', list(self._time_actions.values()), lambda row: 1)
+            tally('daily_action_summaries', [row for rows in self._summaries.values() for row in rows],
+                  lambda row: row['count'])
+
+            if not dry_run:
+                for changed_user_id in report.user_ids:
+                    self._users[changed_user_id]['total_minutes'] = self._expected_total(changed_user_id)
+                    closed = {day for (totals_user_id, day) in self._daily_totals if totals_user_id == changed_user_id}
+                    days_with_rows = {row['local_day'] for row in self._time_actions.values()
+                                      if row['user_id'] == changed_user_id}
+                    self._rollup_user_days(changed_user_id, closed & days_with_rows)
+                    self._log_change(changed_user_id, 'time_action', None, 'invalidate')
+                self._action_stats = {key: list(value) for key, value in self._expected_action_stats().items()}
+                report.recomputed_users = sorted(report.user_ids)
+            return report.result()
+
+    def reconcile_totals(self, after_user_id=0, limit=100, repair=False):
+        with self._lock:
+            user_ids = sorted(user_id for user_id in self._users if user_id > after_user_id)[:limit]
+            drift = []
+            for user_id in user_ids:
+                user = self._users[user_id]
+                expected = self._expected_total(user_id)
+                if user['total_minutes'] != expected:
+                    drift.append({'user_id': user_id, 'total_minutes': user['total_minutes'],
+                                  'expected_total_minutes': expected})
+                    if repair:
+                        user['total_minutes'] = expected
+            return {'checked': len(user_ids), 'last_user_id': user_ids[-1] if user_ids else None, 'drift': drift}
+
+    def list_timezones(self):
+        with self._lock:
+            return {user['timezone'] for user in self._users.values() if user['timezone']}
+
+    def close_day(self, local_day, timezones, include_unzoned=False):
+        timezones = set(timezones)
+        with self._lock:
+            user_ids = {user_id for user_id, user in self._users.items()
+                        if user['timezone'] in timezones or (include_unzoned and not user['timezone'])}
+            active = {row['user_id'] for row in self._time_actions.values()
+                      if row['user_id'] in user_ids and row['local_day'] == local_day}
+            for user_id in active:
+                self._rollup_user_days(user_id, [local_day])
+            return len(active)
+
+    def close_user_days(self, user_id, local_days):
+        with self._lock:
+            self._rollup_user_days(user_id, local_days)
+
+    def list_daily_totals(self, user_id, before_day=None, limit=None):
+        with self._lock:
+            rows = [dict(row) for (row_user_id, day), row in self._daily_totals.items()
+                    if row_user_id == user_id and (before_day is None or day < before_day)]
+        rows.sort(key=lambda row: row['local_day'], reverse=True)
+        return rows if limit is None else rows[:limit]
+
+    def read_changes(self, user_id, since):
+        with self._lock:
+            latest = self._next_seq - 1
+            oldest = self._change_log[0]['seq'] if self._change_log else latest + 1
+            changes = [change for change in self._change_log
+                       if change['user_id'] == user_id and change['seq'] > since]
+            full, invalidated, last_ops = collapse_changes(since, changes, oldest - 1)
+
+            custom = list(self._custom.get(user_id, {}).values())
+            edited = list(self._edited.get(user_id, {}).values())
+            deleted = self._deleted.get(user_id, set())
+            time_actions = sorted(self._user_time_actions(user_id), key=lambda row: row['id'])
+            if not full:
+                wanted = {entity: set(keys_with_op(last_ops, entity, 'upsert')) for entity in SYNC_ENTITIES}
+                time_actions = [row for row in time_actions if str(row['id']) in wanted['time_action']]
+                deleted = [text for text in deleted if text in wanted['deleted_action']]
+                edited = [row for row in edited if row['original_text'] in wanted['edited_action']]
+                custom = [row for row in custom if row['text'] in wanted['custom_action']]
+
+            return {
+                'seq': latest,
+                'full': full,
+                'invalidated': invalidated,
+                'profile_changed': full or ('profile', None) in last_ops,
+                'upserted': {
+                    'time_action': [{key: row[key] for key in ('id', 'action', 'minutes_added', 'created_at')}
+                                    for row in time_actions],
+                    'deleted_action': [{'action_text': text} for text in deleted],
+                    'edited_action': [dict(row) for row in edited],
+                    'custom_action': [dict(row) for row in custom],
+                },
+                'deleted': {entity: [] if full else keys_with_op(last_ops, entity, 'delete')
+                            for entity in SYNC_ENTITIES},
+            }
+
+    def prune_change_log(self):
+        if not self.change_log_retention:
+            return 0
+        with self._lock:
+            cutoff = time.time() - self.change_log_retention
+            # Appended in seq order, so the expired entries are a prefix
+            expired = next((i for i, change in enumerate(self._change_log) if change['created_at'] >= cutoff),
+                           len(self._change_log))
+            del self._change_log[:expired]
+            return expired
+
+    # Catalog overrides
+
+    def get_catalog_overlay(self, user_id):
+        with self._lock:
+            return (
+                set(self._deleted.get(user_id, set())),
+                [dict(row) for row in self._edited.get(user_id, {}).values()],
+                [dict(row) for row in self._custom.get(user_id, {}).values()],
+            )
+
+    def get_override_minutes(self, user_id, text):
+        with self._lock:
+            for overrides in (self._edited, self._custom):
+                for row in overrides.get(user_id, {}).values():
+                    if row['text'] == text:
+                        return row['minutes']
+            return None
+
+    def delete_default_action(self, user_id, text):
+        with self._lock:
+            self._deleted.setdefault(user_id, set()).add(text)
+            self._log_change(user_id, 'deleted_action', text, 'upsert')
+            if self._edited.get(user_id, {}).pop(text, None) is not None:
+                self._log_change(user_id, 'edited_action', text, 'delete')
+
+    def edit_default_action(self, user_id, original_text, fields):
+        with self._lock:
+            deleted = self._deleted.get(user_id, set())
+            if original_text in deleted:
+                deleted.discard(original_text)
+                self._log_change(user_id, 'deleted_action', original_text, 'delete')
+            self._edited.setdefault(user_id, {})[original_text] = {
+                'user_id': user_id,
+                'original_text': original_text,
+                **override_columns(fields),
+                'updated_at': self._now(),
+            }
+            self._log_change(user_id, 'edited_action', original_text, 'upsert')
+
+    def restore_default_action(self, user_id, text):
+        with self._lock:
+            deleted = self._deleted.get(user_id, set())
+            if text in deleted:
+                deleted.discard(text)
+                self._log_change(user_id, 'deleted_action', text, 'delete')
+
+    def create_custom_action(self, user_id, fields):
+        columns = override_columns(fields)
+        with self._lock:
+            custom = self._custom.setdefault(user_id, OrderedDict())
+            if columns['text'] in custom:
+                return False
+            custom[columns['text']] = {'user_id': user_id, **columns, 'created_at': self._now()}
+            self._log_change(user_id, 'custom_action', columns['text'], 'upsert')
+            return True
+
+    def update_custom_action(self, user_id, original_text, fields):
+        columns = override_columns(fields)
+        with self._lock:
+            custom = self._custom.get(user_id, OrderedDict())
+            if original_text not in custom:
+                return False
+            # Rebuild to keep the action's position when its text changes
+            self._custom[user_id] = OrderedDict(
+                (columns['text'], {**row, **columns}) if text == original_text else (text, row)
+                for text, row in custom.items()
+            )
+            if columns['text'] != original_text:
+                self._log_change(user_id, 'custom_action', original_text, 'delete')
+            self._log_change(user_id, 'custom_action', columns['text'], 'upsert')
+            return True
+
+    def delete_custom_action(self, user_id, text):
+        with self._lock:
+            if self._custom.get(user_id, {}).pop(text, None) is not None:
+                self._log_change(user_id, 'custom_action', text, 'delete')
+
+    # Action popularity
+
+    def get_action_stats(self, day=None, limit=None):
+        with self._lock:
+            totals = {}
+            for (stats_day, action), (count, minutes) in self._action_stats.items():
+                if day is None or stats_day == day:
+                    have = totals.get(action, (0, 0))
+                    totals[action] = (have[0] + count, have[1] + minutes)
+        rows = [{'action': action, 'count': count, 'minutes_added': minutes}
+                for action, (count, minutes) in totals.items()]
+        rows.sort(key=lambda row: (-row['count'], row['action']))
+        return rows if limit is None else rows[:limit]
+
+    def rebuild_action_stats(self):
+        with self._lock:
+            self._action_stats = {key: list(value) for key, value in self._expected_action_stats().items()}
+            return len(self._action_stats)
+
+    def check_action_stats(self):
+        with self._lock:
+            stored = {key: tuple(value) for key, value in self._action_stats.items()}
+            return action_stats_drift(stored, self._expected_action_stats())
+
+    # Maintenance
+
+    def compact_history(self, cutoff, archive_path=None):
+        with self._lock:
+            old = sorted((row for row in self._time_actions.values() if row['created_at'] < cutoff),
+                         key=lambda row: row['id'])
+            if archive_path:
+                archive = sqlite3.connect(archive_path)
+                try:
+                    archive.execute(ARCHIVE_TIME_ACTIONS.format(schema=''))
+                    archive.executemany('''
+                        INSERT OR IGNORE INTO time_actions (id, user_id, action, minutes_added, created_at)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', [(row['id'], row['user_id'], row['action'], row['minutes_added'], row['created_at'])
+                          for row in old])
+                    archive.commit()
+                finally:
+                    archive.close()
+
+            user_ids = sorted({row['user_id'] for row in old})
+            for row in old:
+                summaries = self._summaries.setdefault(row['user_id'], [])
+                day = row['created_at'][:10]
+                summary = next((summary for summary in summaries
+                                if summary['day'] == day and summary['action'] == row['action']), None)
+                if summary is None:
+                    summary = {'id': self._new_id('daily_action_summaries'), 'user_id': row['user_id'],
+                               'day': day, 'action': row['action'], 'count': 0, 'minutes_added': 0}
+                    summaries.append(summary)
+                summary['count'] += 1
+                summary['minutes_added'] += row['minutes_added']
+                del self._time_actions[row['id']]
+            for user_id in user_ids:
+                self._log_change(user_id, 'time_action', None, 'invalidate')
+            return {'users': len(user_ids), 'rows_compacted': len(old)}
+
+    def reclaim_space(self):
+        pass
+
+    # Health
+
+    def ping(self):
+        with self._lock:  # A writer wedged while holding the lock would hang here
+            pass
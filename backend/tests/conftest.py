@@ -0,0 +1,55 @@
+"""Fixtures that run each storage test against both engines
+
+app.py builds its schema and config at import, so the
+environment is pinned to a scratch directory (with the schedulers off)
+before it's imported. Every SQLite test then gets a freshly initialized
+database file of its own.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+_scratch = tempfile.mkdtemp(prefix='fivemore-tests-')
+os.environ.update({
+    'FIVEMORE_DB_PATH': os.path.join(_scratch, 'import.db'),
+    'FIVEMORE_RATE_LIMIT_DB_PATH': os.path.join(_scratch, 'ratelimit.db'),
+    'FIVEMORE_BACKUP_INTERVAL_HOURS': '0',
+    'FIVEMORE_UPLOAD_SWEEP_INTERVAL_HOURS': '0',
+    'FIVEMORE_DAY_ROLLOVER': '0',
+    'FIVEMORE_ACCESS_LOG_SAMPLE': '0',
+})
+
+import app as app_module  # noqa: E402
+from storage import MemoryRepository, SQLiteRepository  # noqa: E402
+
+IDEMPOTENCY_TTL = 60
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def repo(request, tmp_path, monkeypatch):
+    """A Repository of each engine, empty"""
+    if request.param == 'memory':
+        return MemoryRepository(idempotency_ttl=IDEMPOTENCY_TTL)
+    monkeypatch.setattr(app_module, 'DATABASE', tmp_path / 'test.db')
+    app_module.init_db()
+    return SQLiteRepository(app_module.get_db, idempotency_ttl=IDEMPOTENCY_TTL,
+                            connect_readonly=app_module.get_db_readonly)
+
+
+@pytest.fixture
+def make_user(repo):
+    """Create users with unique names and return their ids"""
+    created = []
+
+    def make(name=None):
+        name = name or f'user{len(created) + 1}'
+        created.append(repo.create_user(name, f'{name}@example.com', 'x', name.title()))
+        return created[-1]
+
+    return make
@@ -0,0 +1,299 @@
+"""Contract tests for the Repository interface, run against both engines"""
+import pytest
+
+from storage import IdempotencyKeyTaken, MemoryRepository
+
+
+def set_total(repo, user_id, total):
+    """Overwrite a user's stored total behind the repository's back"""
+    if isinstance(repo, MemoryRepository):
+        repo._users[user_id]['total_minutes'] = total
+        return
+    conn = repo.connect()
+    conn.execute('UPDATE users SET total_minutes = ? WHERE id = ?', (total, user_id))
+    conn.commit()
+    conn.close()
+
+
+def set_stat_count(repo, action, count):
+    """Overwrite every action_stats counter of one action behind the repository's back"""
+    if isinstance(repo, MemoryRepository):
+        for (day, stat_action), stats in repo._action_stats.items():
+            if stat_action == action:
+                stats[0] = count
+        return
+    conn = repo.connect()
+    conn.execute('UPDATE action_stats SET count = ? WHERE action = ?', (count, action))
+    conn.commit()
+    conn.close()
+
+
+def age_change_log(repo, days):
+    """Backdate every change log entry by `days`"""
+    if isinstance(repo, MemoryRepository):
+        for change in repo._change_log:
+            change['created_at'] -= days * 24 * 60 * 60
+        return
+    conn = repo.connect()
+    conn.execute("UPDATE change_log SET created_at = datetime(created_at, ?)", (f'-{days} days',))
+    conn.commit()
+    conn.close()
+
+
+def history_actions(repo, user_id):
+    return sorted((row['action'], row['minutes_added']) for row in repo.list_time_actions(user_id))
+
+
+# Time actions and idempotency
+
+def test_add_time_action_returns_running_total(repo, make_user):
+    user_id = make_user()
+    assert repo.add_time_action(user_id, 'skipped a drink!', 22) == 22
+    assert repo.add_time_action(user_id, 'meditated!', 60) == 82
+    assert repo.get_user(user_id)['total_minutes'] == 82
+    assert history_actions(repo, user_id) == [('meditated!', 60), ('skipped a drink!', 22)]
+
+
+def test_idempotency_key_applies_once_and_replays_response(repo, make_user):
+    user_id = make_user()
+    render = lambda total: (200, f'{{"total_minutes": {total}}}')  # noqa: E731
+
+    assert repo.add_time_action(user_id, 'skipped a drink!', 22, idempotency_key='k1', render=render) == 22
+    with pytest.raises(IdempotencyKeyTaken):
+        repo.add_time_action(user_id, 'skipped a drink!', 22, idempotency_key='k1', render=render)
+
+    status, body = repo.get_idempotent_response(user_id, 'k1')
+    assert (status, body) == (200, '{"total_minutes": 22}')
+    assert repo.get_user(user_id)['total_minutes'] == 22
+    assert len(repo.list_time_actions(user_id)) == 1
+
+
+def test_idempotency_keys_are_per_user(repo, make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    render = lambda total: (200, str(total))  # noqa: E731
+
+    repo.add_time_action(alice, 'meditated!', 60, idempotency_key='same', render=render)
+    repo.add_time_action(bob, 'meditated!', 60, idempotency_key='same', render=render)
+
+    assert repo.get_idempotent_response(bob, 'same')[1] == '60'
+    assert repo.get_idempotent_response(alice, 'unused') is None
+
+
+def test_reset_user_forgets_idempotency_keys(repo, make_user):
+    user_id = make_user()
+    render = lambda total: (200, str(total))  # noqa: E731
+    repo.add_time_action(user_id, 'meditated!', 60, idempotency_key='k1', render=render)
+
+    repo.reset_user(user_id)
+
+    assert repo.get_idempotent_response(user_id, 'k1') is None
+    assert repo.add_time_action(user_id, 'meditated!', 60, idempotency_key='k1', render=render) == 60
+
+
+# Sync deltas
+
+def test_read_changes_from_zero_is_a_full_sync(repo, make_user):
+    user_id = make_user()
+    repo.add_time_action(user_id, 'meditated!', 60)
+
+    changes = repo.read_changes(user_id, 0)
+    assert changes['full'] is True
+    assert [row['action'] for row in changes['upserted']['time_action']] == ['meditated!']
+
+
+def test_read_changes_returns_only_what_changed_since(repo, make_user):
+    user_id, other = make_user(), make_user()
+    repo.add_time_action(user_id, 'meditated!', 60)
+    since = repo.read_changes(user_id, 0)['seq']
+
+    repo.add_time_action(user_id, 'skipped a drink!', 22)
+    repo.add_time_action(other, 'skipped a drink!', 22)
+    repo.create_custom_action(user_id, {'text': 'walked the dog', 'minutes': 10})
+
+    changes = repo.read_changes(user_id, since)
+    assert changes['full'] is False
+    assert [row['action'] for row in changes['upserted']['time_action']] == ['skipped a drink!']
+    assert [row['text'] for row in changes['upserted']['custom_action']] == ['walked the dog']
+    assert all(not keys for keys in changes['deleted'].values())
+    assert changes['seq'] > since
+
+    kept_id = changes['upserted']['time_action'][0]['id']
+    since = changes['seq']
+    repo.delete_time_actions(user_id, [kept_id])
+    repo.delete_custom_action(user_id, 'walked the dog')
+
+    changes = repo.read_changes(user_id, since)
+    assert changes['upserted']['time_action'] == []
+    assert changes['deleted']['time_action'] == [str(kept_id)]
+    assert changes['deleted']['custom_action'] == ['walked the dog']
+
+
+def test_read_changes_after_reset_is_a_full_sync(repo, make_user):
+    user_id = make_user()
+    repo.add_time_action(user_id, 'meditated!', 60)
+    since = repo.read_changes(user_id, 0)['seq']
+
+    repo.reset_user(user_id)
+
+    changes = repo.read_changes(user_id, since)
+    assert changes['full'] is True
+    assert changes['upserted']['time_action'] == []
+
+
+def test_read_changes_names_bulk_invalidations_like_the_sync_entity(repo, make_user):
+    user_id = make_user()
+    repo.insert_time_actions(user_id, [('meditated!', 60, '2020-01-01 10:00:00', '2020-01-01')])
+    since = repo.read_changes(user_id, 0)['seq']
+
+    repo.compact_history('2021-01-01 00:00:00')
+
+    assert repo.read_changes(user_id, since)['invalidated'] == ['time_action']
+
+
+def test_pruned_change_log_forces_a_full_sync(repo, make_user):
+    repo.change_log_retention = 7 * 24 * 60 * 60
+    user_id = make_user()
+    repo.add_time_action(user_id, 'meditated!', 60)
+    stale = repo.read_changes(user_id, 0)['seq']
+    repo.add_time_action(user_id, 'meditated!', 60)
+    age_change_log(repo, 30)
+    repo.add_time_action(user_id, 'skipped a drink!', 22)
+    current = repo.read_changes(user_id, 0)['seq']
+
+    assert repo.prune_change_log() == 2
+    assert repo.read_changes(user_id, stale)['full'] is True
+    changes = repo.read_changes(user_id, current - 1)
+    assert changes['full'] is False
+    assert [row['action'] for row in changes['upserted']['time_action']] == ['skipped a drink!']
+    assert repo.read_changes(user_id, current)['seq'] == current
+
+
+# Action popularity
+
+def test_action_stats_follow_writes(repo, make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    for _ in range(3):
+        repo.add_time_action(alice, 'skipped a drink!', 22)
+    repo.add_time_action(bob, 'meditated!', 60)
+
+    stats = [(row['action'], row['count'], row['minutes_added']) for row in repo.get_action_stats()]
+    assert stats == [('skipped a drink!', 3, 66), ('meditated!', 1, 60)]
+
+    repo.delete_time_actions(alice, [row['id'] for row in repo.list_time_actions(alice)][:1])
+    assert repo.get_action_stats()[0]['count'] == 2
+    assert repo.check_action_stats() == []
+
+
+def test_check_action_stats_reports_and_rebuild_repairs_drift(repo, make_user):
+    user_id = make_user()
+    repo.add_time_action(user_id, 'meditated!', 60)
+    repo.add_time_action(user_id, 'meditated!', 60)
+    set_stat_count(repo, 'meditated!', 99)
+
+    drift = repo.check_action_stats()
+    assert len(drift) == 1
+    assert (drift[0]['action'], drift[0]['count'], drift[0]['expected_count']) == ('meditated!', 99, 2)
+
+    repo.rebuild_action_stats()
+    assert repo.check_action_stats() == []
+
+
+def test_compaction_keeps_totals_and_stats(repo, make_user):
+    user_id = make_user()
+    repo.insert_time_actions(user_id, [
+        ('skipped a drink!', 22, '2020-01-01 10:00:00', '2020-01-01'),
+        ('skipped a drink!', 22, '2020-01-01 11:00:00', '2020-01-01'),
+        ('meditated!', 60, '2020-01-02 09:00:00', '2020-01-02'),
+    ])
+    repo.recompute_total_minutes(user_id)
+    repo.add_time_action(user_id, 'meditated!', 60)
+
+    result = repo.compact_history('2021-01-01 00:00:00')
+    assert result == {'users': 1, 'rows_compacted': 3}
+    summaries = [(row['day'], row['action'], row['count'], row['minutes_added'])
+                 for row in repo.list_daily_summaries(user_id)]
+    assert summaries == [('2020-01-02', 'meditated!', 1, 60), ('2020-01-01', 'skipped a drink!', 2, 44)]
+    assert history_actions(repo, user_id) == [('meditated!', 60)]
+    assert repo.get_user(user_id)['total_minutes'] == 164
+    assert repo.check_action_stats() == []
+    assert repo.reconcile_totals()['drift'] == []
+    assert repo.compact_history('2021-01-01 00:00:00') == {'users': 0, 'rows_compacted': 0}
+
+
+def test_rollup_after_compaction_keeps_compacted_days(repo, make_user):
+    user_id = make_user()
+    repo.insert_time_actions(user_id, [
+        ('meditated!', 60, '2020-01-01 10:00:00', '2020-01-01'),
+        ('meditated!', 60, '2020-01-02 23:30:00', '2020-01-03'),
+        ('skipped a drink!', 22, '2020-03-01 10:00:00', '2020-03-01'),
+    ])
+    for day in ('2020-01-01', '2020-01-03', '2020-03-01'):
+        repo.close_day(day, [], include_unzoned=True)
+    repo.compact_history('2020-02-01 00:00:00')
+
+    repo.insert_time_actions(user_id, [
+        ('meditated!', 60, '2020-01-03 09:00:00', '2020-01-03'),
+        ('skipped a drink!', 22, '2020-03-01 11:00:00', '2020-03-01'),
+    ])
+    repo.close_user_days(user_id, ['2020-01-01', '2020-01-03', '2020-03-01'])
+
+    days = {row['local_day']: (row['actions'], row['minutes_added']) for row in repo.list_daily_totals(user_id)}
+    assert days == {'2020-01-01': (1, 60), '2020-01-03': (1, 60), '2020-03-01': (2, 44)}
+
+def test_reconcile_totals_reports_and_repairs_drift(repo, make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    repo.add_time_action(alice, 'meditated!', 60)
+    repo.add_time_action(bob, 'skipped a drink!', 22)
+    set_total(repo, bob, 5)
+
+    batch = repo.reconcile_totals()
+    assert batch['checked'] == 2
+    assert batch['drift'] == [{'user_id': bob, 'total_minutes': 5, 'expected_total_minutes': 22}]
+
+    repo.reconcile_totals(repair=True)
+    assert repo.get_user(bob)['total_minutes'] == 22
+    assert repo.reconcile_totals()['drift'] == []
+
+
+def test_reconcile_totals_pages_by_user_id(repo, make_user):
+    user_ids = [make_user() for _ in range(3)]
+
+    first = repo.reconcile_totals(limit=2)
+    assert (first['checked'], first['last_user_id']) == (2, user_ids[1])
+    rest = repo.reconcile_totals(first['last_user_id'], limit=2)
+    assert rest['checked'] == 1
+
+
+# Re-pricing history
+
+def test_reweight_history_reprices_rows_totals_and_stats(repo, make_user):
+    user_id = make_user()
+    repo.add_time_action(user_id, 'skipped a drink!', 22)
+    repo.add_time_action(user_id, 'skipped a drink!', 22)
+    repo.create_custom_action(user_id, {'text': 'walked the dog', 'minutes': 10})
+    repo.add_time_action(user_id, 'walked the dog', 10)
+    repo.update_custom_action(user_id, 'walked the dog', {'text': 'walked the dog', 'minutes': 15})
+    defaults = {'skipped a drink!': 30}
+
+    preview = repo.reweight_history(defaults, dry_run=True)
+    assert (preview['rows'], preview['minutes_delta']) == (3, 21)
+    assert repo.get_user(user_id)['total_minutes'] == 54
+
+    result = repo.reweight_history(defaults)
+    assert (result['rows'], result['minutes_delta'], result['recomputed_users']) == (3, 21, [user_id])
+    assert history_actions(repo, user_id) == [('skipped a drink!', 30), ('skipped a drink!', 30),
+                                              ('walked the dog', 15)]
+    assert repo.get_user(user_id)['total_minutes'] == 75
+    assert repo.check_action_stats() == []
+    assert repo.reconcile_totals()['drift'] == []
+
+    assert repo.reweight_history(defaults)['rows'] == 0
+
+
+def test_reweight_history_leaves_deleted_actions_alone(repo, make_user):
+    user_id = make_user()
+    repo.add_time_action(user_id, 'skipped a drink!', 22)
+    repo.delete_default_action(user_id, 'skipped a drink!')
+
+    assert repo.reweight_history({'skipped a drink!': 30})['rows'] == 0
+    assert history_actions(repo, user_id) == [('skipped a drink!', 22)]
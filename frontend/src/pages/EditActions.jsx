@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react'
 import { useNavigate } from 'react-router-dom'
+import { fetchButtonActions } from '../utils/buttonActions'
 import './EditActions.css'
 
 function EditActions() {
@@ -21,13 +22,7 @@ function EditActions() {
 
   const fetchActions = async () => {
     try {
-      const response = await fetch('/api/button-actions', {
-        credentials: 'include',
-      })
-      if (response.ok) {
-        const data = await response.json()
-        setActions(data.actions || [])
-      }
+      setActions(await fetchButtonActions())
     } catch (error) {
       console.error('Failed to fetch actions:', error)
     } finally {
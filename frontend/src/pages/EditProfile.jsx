@@ -36,6 +36,7 @@ function EditProfile({ user, onUpdate }) {
       const formDataToSend = new FormData()
       formDataToSend.append('email', formData.email)
       formDataToSend.append('display_name', formData.displayName)
+      formDataToSend.append('timezone', Intl.DateTimeFormat().resolvedOptions().timeZone)
       if (formData.password) {
         formDataToSend.append('password', formData.password)
       }
@@ -102,14 +103,14 @@ function EditProfile({ user, onUpdate }) {
   const handleResetToday = async () => {
     setResettingToday(true)
     try {
-      const timezoneOffset = new Date().getTimezoneOffset() * -1
+      const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone
       const response = await fetch('/api/actions/today/reset', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
         credentials: 'include',
-        body: JSON.stringify({ timezone_offset: timezoneOffset }),
+        body: JSON.stringify({ timezone }),
       })
 
       const data = await response.json()
@@ -1,6 +1,7 @@
 import { useState, useEffect } from 'react'
 import { useNavigate } from 'react-router-dom'
 import { useTheme } from '../contexts/ThemeContext'
+import { fetchButtonActions, searchActions } from '../utils/buttonActions'
 import './Home.css'
 import '../pages/Auth.css'
 
@@ -26,6 +27,7 @@ function Home({ user, onLogout }) {
     warning: '',
   })
   const [creatingAction, setCreatingAction] = useState(false)
+  const [actionSuggestions, setActionSuggestions] = useState([])
   const [showResetTodayModal, setShowResetTodayModal] = useState(false)
   const [resettingToday, setResettingToday] = useState(false)
   const [holdTimer, setHoldTimer] = useState(null)
@@ -43,6 +45,28 @@ function Home({ user, onLogout }) {
     fetchTodayActions()
   }, [])
 
+  useEffect(() => {
+    // Show existing actions that look like the one being typed (debounced)
+    const query = customActionForm.text.trim()
+    if (!showCustomActionForm || query.length < 2) {
+      setActionSuggestions([])
+      return
+    }
+    let cancelled = false
+    const timer = setTimeout(async () => {
+      try {
+        const results = await searchActions(query)
+        if (!cancelled) setActionSuggestions(results)
+      } catch (error) {
+        console.error('Failed to search actions:', error)
+      }
+    }, 200)
+    return () => {
+      cancelled = true
+      clearTimeout(timer)
+    }
+  }, [customActionForm.text, showCustomActionForm])
+
   useEffect(() => {
     // Cleanup timer on unmount or when holdTimer changes
     return () => {
@@ -54,21 +78,10 @@ function Home({ user, onLogout }) {
 
   const loadButtonActions = async () => {
     try {
-      const response = await fetch('/api/button-actions')
-      if (response.ok) {
-        const data = await response.json()
-        // Sort actions by minutes (ascending - least to most)
-        const sortedActions = (data.actions || []).sort((a, b) => (a.minutes || 0) - (b.minutes || 0))
-        setButtonActions(sortedActions)
-      } else {
-        // Fallback to default actions
-        const fallbackActions = [
-          { text: 'skipped a meal!', minutes: 30 },
-          { text: 'skipped a drink!', minutes: 15 },
-          { text: 'went running!', minutes: 45 }
-        ]
-        setButtonActions(fallbackActions.sort((a, b) => a.minutes - b.minutes))
-      }
+      const actions = await fetchButtonActions()
+      // Sort actions by minutes (ascending - least to most)
+      const sortedActions = actions.sort((a, b) => (a.minutes || 0) - (b.minutes || 0))
+      setButtonActions(sortedActions)
     } catch (error) {
       console.error('Failed to load button actions:', error)
       // Fallback to default actions
@@ -83,9 +96,9 @@ function Home({ user, onLogout }) {
 
   const fetchTodayActions = async () => {
     try {
-      // Get timezone offset in minutes
-      const timezoneOffset = new Date().getTimezoneOffset() * -1
-      const response = await fetch(`/api/actions/today?timezone_offset=${timezoneOffset}`, {
+      // The server keeps the user's timezone; this only fills it in if missing
+      const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone
+      const response = await fetch(`/api/actions/today?timezone=${encodeURIComponent(timezone)}`, {
         credentials: 'include',
       })
       if (response.ok) {
@@ -114,9 +127,8 @@ function Home({ user, onLogout }) {
 
   const fetchTodayTime = async () => {
     try {
-      // Get timezone offset in minutes
-      const timezoneOffset = new Date().getTimezoneOffset() * -1
-      const response = await fetch(`/api/time/today?timezone_offset=${timezoneOffset}`, {
+      const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone
+      const response = await fetch(`/api/time/today?timezone=${encodeURIComponent(timezone)}`, {
         credentials: 'include',
       })
       if (response.ok) {
@@ -168,14 +180,14 @@ function Home({ user, onLogout }) {
   const handleResetToday = async () => {
     setResettingToday(true)
     try {
-      const timezoneOffset = new Date().getTimezoneOffset() * -1
+      const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone
       const response = await fetch('/api/actions/today/reset', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
         credentials: 'include',
-        body: JSON.stringify({ timezone_offset: timezoneOffset }),
+        body: JSON.stringify({ timezone }),
       })
 
       const data = await response.json()
@@ -234,17 +246,35 @@ function Home({ user, onLogout }) {
     })
   }
 
+  const newIdempotencyKey = () => {
+    if (window.crypto && window.crypto.randomUUID) {
+      return window.crypto.randomUUID()
+    }
+    // randomUUID needs a secure context (e.g. not plain-http LAN access)
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`
+  }
+
   const addTime = async (buttonText) => {
     setLoading(true)
+    // One key per tap: the server applies it once, however often it is sent
+    const idempotencyKey = newIdempotencyKey()
+    const postAction = () => fetch('/api/time/add', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Idempotency-Key': idempotencyKey,
+      },
+      credentials: 'include',
+      body: JSON.stringify({ action: buttonText }),
+    })
     try {
-      const response = await fetch('/api/time/add', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        credentials: 'include',
-        body: JSON.stringify({ action: buttonText }),
-      })
+      let response
+      try {
+        response = await postAction()
+      } catch (networkError) {
+        // Safe to retry once with the same key after a dropped connection
+        response = await postAction()
+      }
       if (response.ok) {
         const data = await response.json()
         setTimeData(data)
@@ -642,6 +672,12 @@ function Home({ user, onLogout }) {
                     className="auth-input"
                     style={{ width: '100%', marginBottom: '12px' }}
                   />
+                  {actionSuggestions.length > 0 && (
+                    <div className="warning-message-small">
+                      Already in your list:{' '}
+                      {actionSuggestions.map((suggestion) => `"${suggestion.text}" (${suggestion.minutes} min)`).join(', ')}
+                    </div>
+                  )}
                 </div>
                 <div style={{ marginBottom: '16px' }}>
                   <label style={{ 
@@ -33,6 +33,7 @@ function Register({ onLogin }) {
       formDataToSend.append('email', formData.email)
       formDataToSend.append('display_name', formData.displayName)
       formDataToSend.append('password', formData.password)
+      formDataToSend.append('timezone', Intl.DateTimeFormat().resolvedOptions().timeZone)
       if (formData.profilePicture) {
         formDataToSend.append('profile_picture', formData.profilePicture)
       }
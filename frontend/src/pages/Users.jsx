@@ -239,7 +239,10 @@ function Users() {
                         {actions.map((action) => (
                           <div key={action.id} className="action-item">
                             <div className="action-main">
-                              <span className="action-text">{action.action}</span>
+                              <span className="action-text">
+                                {action.action}
+                                {action.count > 1 && ` ×${action.count}`}
+                              </span>
                               <span className="action-minutes">+{action.minutes_added} min</span>
                             </div>
                             <div className="action-time">
@@ -0,0 +1,69 @@
+// Button actions are the default catalog plus the user's overlay (deletions,
+// edits and custom actions). The default catalog is fetched from a versioned
+// URL that the server marks immutable, so the browser downloads it once per
+// catalog change and each request only transfers the overlay.
+
+export function mergeButtonActions(defaultActions, overlay) {
+  const deleted = new Set(overlay.deleted || [])
+  const edited = overlay.edited || {}
+  const actions = [...(overlay.custom || [])]
+
+  defaultActions.forEach((action) => {
+    const originalText = action.text
+
+    // Skip if deleted
+    if (deleted.has(originalText)) {
+      return
+    }
+
+    // Use edited version if exists, otherwise use default
+    if (edited[originalText]) {
+      actions.push({
+        ...action,
+        ...edited[originalText],
+        original_text: originalText,
+        is_edited: true,
+      })
+    } else {
+      actions.push({
+        ...action,
+        original_text: originalText,
+        is_edited: false,
+      })
+    }
+  })
+
+  return actions
+}
+
+export async function fetchButtonActions() {
+  const overlayResponse = await fetch('/api/button-actions?mode=overlay', {
+    credentials: 'include',
+  })
+  if (!overlayResponse.ok) {
+    throw new Error(`Failed to load action overlay: ${overlayResponse.status}`)
+  }
+  const overlay = await overlayResponse.json()
+
+  const defaultsResponse = await fetch(
+    `/api/button-actions/defaults?v=${encodeURIComponent(overlay.defaults_version)}`
+  )
+  if (!defaultsResponse.ok) {
+    throw new Error(`Failed to load default actions: ${defaultsResponse.status}`)
+  }
+  const defaults = await defaultsResponse.json()
+
+  return mergeButtonActions(defaults.actions || [], overlay)
+}
+
+export async function searchActions(query, limit = 5) {
+  const params = new URLSearchParams({ q: query, limit: String(limit) })
+  const response = await fetch(`/api/actions/search?${params}`, {
+    credentials: 'include',
+  })
+  if (!response.ok) {
+    throw new Error(`Failed to search actions: ${response.status}`)
+  }
+  const data = await response.json()
+  return data.results || []
+}